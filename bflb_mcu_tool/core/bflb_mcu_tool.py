@@ -7,6 +7,8 @@ import time
 import zipfile
 import shutil
 import binascii
+import glob
+import fnmatch
 import argparse
 import traceback
 from importlib import reload
@@ -23,10 +25,12 @@ import config as gol
 from libs import bflb_eflash_loader
 from libs import bflb_efuse_boothd_create
 from libs import bflb_img_create
+from libs import bflb_img_layout
 from libs import bflb_img_loader
 from libs import bflb_flash_select
 from libs import bflb_utils
-from libs import bflb_interface_jlink
+from libs import bflb_chip_registry
+from libs import bflb_artifact_store
 from libs.bflb_utils import verify_hex_num, get_eflash_loader, get_serial_ports, convert_path
 from libs.bflb_configobj import BFConfigParser
 import libs.bflb_ro_params_device_tree as bl_ro_device_tree
@@ -123,6 +127,7 @@ class BflbMcuTool(object):
         self.config = {}
         self.efuse_load_en = False
         self._password = None
+        self.eflash_loader_args = None
         self.eflash_loader_cfg = os.path.join(chip_path, chipname, "eflash_loader/eflash_loader_cfg.conf")
         self.eflash_loader_cfg_tmp = os.path.join(chip_path, chipname, "eflash_loader/eflash_loader_cfg.ini")
         self.eflash_loader_bin = os.path.join(chip_path, chipname, "eflash_loader/eflash_loader_40m.bin")
@@ -180,12 +185,6 @@ class BflbMcuTool(object):
         cfg.set("LOAD_CFG", "speed_jlink", rate)
         cfg.write(f, "w")
 
-    def bl_create_flash_default_data(self, length):
-        datas = bytearray(length)
-        for i in range(length):
-            datas[i] = 0xFF
-        return datas
-
     def bl_get_file_data(self, files):
         datas = []
         for file in files:
@@ -491,23 +490,16 @@ class BflbMcuTool(object):
                     img_file = self.img_create_path + "/img_cpu1.bin"
                     img_output_file = self.img_create_path + "/whole_img_cpu1.bin"
                 if values["img_type"] == "SingleCPU":
-                    dummy_data = bytearray(8192)
+                    img_addr = 8192
                 else:
-                    dummy_data = bytearray(4096)
-                for i in range(len(dummy_data)):
-                    dummy_data[i] = 0xFF
-                fp = open(bootinfo_file, "rb")
-                data0 = fp.read() + bytearray(0)
-                fp.close()
-                fp = open(img_file, "rb")
-                data1 = fp.read() + bytearray(0)
-                fp.close()
-                fp = open(img_output_file, "wb+")
-                if data0[0:4] == data1[0:4]:
-                    fp.write(data1)
+                    img_addr = 4096
+                layout = bflb_img_layout.BflbImgLayout()
+                if bflb_img_layout.read_file_head(bootinfo_file) == bflb_img_layout.read_file_head(img_file):
+                    layout.add_file(0, img_file)
                 else:
-                    fp.write(data0 + dummy_data[0 : len(dummy_data) - len(data0)] + data1)
-                fp.close()
+                    bootinfo_len = layout.add_file(0, bootinfo_file)
+                    layout.add_file(max(img_addr, bootinfo_len), img_file)
+                layout.write(img_output_file)
                 bflb_utils.printf("Output:", img_output_file)
             else:
                 group0_bootinfo_file = self.img_create_path + "/bootinfo_group0.bin"
@@ -526,29 +518,22 @@ class BflbMcuTool(object):
                     whole_img_len = group0_img_offset + group0_img_len
                 else:
                     whole_img_len = group1_img_offset + group1_img_len
-                whole_img_data = self.bl_create_flash_default_data(whole_img_len)
-                group0_bootinfo_filedata = self.bl_get_file_data([group0_bootinfo_file])[0]
-                whole_img_data[0 : len(group0_bootinfo_filedata)] = group0_bootinfo_filedata
-
-                group1_bootinfo_filedata = self.bl_get_file_data([group1_bootinfo_file])[0]
-                whole_img_data[0x1000 : len(group1_bootinfo_filedata)] = group1_bootinfo_filedata
-                filedata = self.bl_get_file_data([group0_img_output_file])[0]
-                if group0_img_len != len(filedata):
-                    bflb_utils.printf("group0 img len error, get %d except %d" % (group0_img_len, len(filedata)))
-                if group0_bootinfo_filedata[0:4] == filedata[0:4]:
-                    whole_img_data = filedata
-                else:
-                    whole_img_data[group0_img_offset : group0_img_offset + len(filedata)] = filedata
-                filedata = self.bl_get_file_data([group1_img_output_file])[0]
-                if group1_img_len != len(filedata):
-                    bflb_utils.printf("group1 img len error, get %d except %d" % (group1_img_len, len(filedata)))
-                if group1_bootinfo_filedata[0:4] == filedata[0:4]:
-                    whole_img_data = filedata
-                else:
-                    whole_img_data[group1_img_offset : group1_img_offset + len(filedata)] = filedata
-                fp = open(whole_img_output_file, "wb+")
-                fp.write(whole_img_data)
-                fp.close()
+                layout = bflb_img_layout.BflbImgLayout(whole_img_len)
+                layout.add_file(0, group0_bootinfo_file)
+                layout.add_file(0x1000, group1_bootinfo_file)
+                for bootinfo_file, img_file, img_offset, img_len, name in (
+                    (group0_bootinfo_file, group0_img_output_file, group0_img_offset, group0_img_len, "group0"),
+                    (group1_bootinfo_file, group1_img_output_file, group1_img_offset, group1_img_len, "group1"),
+                ):
+                    file_len = os.path.getsize(img_file)
+                    if img_len != file_len:
+                        bflb_utils.printf("%s img len error, get %d except %d" % (name, img_len, file_len))
+                    if bflb_img_layout.read_file_head(bootinfo_file) == bflb_img_layout.read_file_head(img_file):
+                        layout.reset()
+                        layout.add_file(0, img_file)
+                    else:
+                        layout.add_file(img_offset, img_file)
+                layout.write(whole_img_output_file)
                 bflb_utils.printf("Output:", whole_img_output_file)
         except Exception as e:
             bflb_utils.printf("烧写执行出错:", e)
@@ -2061,6 +2046,8 @@ class BflbMcuTool(object):
                         return error
                     bflb_utils.printf("========= Interface is JLink =========")
                     # self.bl60x_mfg_flasher_jlink_cfg(rate=jlink_brd)
+                    from libs import bflb_interface_jlink
+
                     self._bflb_com_if = bflb_interface_jlink.BflbJLinkPort()
                     self._bflb_com_if.if_init(values["dl_comport"], int(jlink_brd), self.chiptype, self.chipname)
                     self._bflb_com_if.reset_cpu()
@@ -2073,8 +2060,8 @@ class BflbMcuTool(object):
                     # eflash_loader.bin has 192 bytes bootheader and seg header
                     fw_data = bytearray(imge_fp.read())[192:] + bytearray(0)
                     imge_fp.close()
-                    sub_module = __import__("libs." + self.chiptype, fromlist=[self.chiptype])
-                    load_addr = sub_module.jlink_load_cfg.jlink_load_addr
+                    chip = bflb_chip_registry.get_chip(self.chiptype)
+                    load_addr = chip.jlink.load_addr
                     self._bflb_com_if.if_raw_write(load_addr, fw_data)
                     pc = fw_data[4:8]
                     pc = bytes([pc[3], pc[2], pc[1], pc[0]])
@@ -2106,6 +2093,11 @@ class BflbMcuTool(object):
                     bflb_utils.update_cfg(cfg, "LOAD_CFG", "verify", "1")
                 else:
                     bflb_utils.update_cfg(cfg, "LOAD_CFG", "verify", "0")
+            if "dl_delta" in values.keys():
+                if values["dl_delta"] == "True":
+                    bflb_utils.update_cfg(cfg, "LOAD_CFG", "delta_write", "true")
+                else:
+                    bflb_utils.update_cfg(cfg, "LOAD_CFG", "delta_write", "false")
 
             eflash_loader_bin = os.path.join(
                 chip_path, self.chipname, "eflash_loader/" + get_eflash_loader(values["dl_xtal"])
@@ -2123,22 +2115,17 @@ class BflbMcuTool(object):
                 fw_with_bootinfo = False
                 if bind_bootinfo is True:
                     img_addr = int(values["img_addr"].replace("0x", ""), 16)
-                    bootinfo_filedata = self.bl_get_file_data([bootinfo_file])[0]
-                    filedata = self.bl_get_file_data([img_output_file])[0]
-                    if bootinfo_filedata[0:4] == filedata[0:4]:
-                        whole_img_len = os.path.getsize(os.path.join(app_path, img_output_file))
-                        whole_img_data = self.bl_create_flash_default_data(whole_img_len)
-                        whole_img_data = filedata
+                    layout = bflb_img_layout.BflbImgLayout()
+                    img_path = os.path.join(app_path, img_output_file)
+                    bootinfo_path = os.path.join(app_path, bootinfo_file)
+                    if bflb_img_layout.read_file_head(bootinfo_path) == bflb_img_layout.read_file_head(img_path):
+                        layout.add_file(0, img_path)
                         fw_with_bootinfo = True
                     else:
-                        whole_img_len = img_addr + os.path.getsize(os.path.join(app_path, img_output_file))
-                        whole_img_data = self.bl_create_flash_default_data(whole_img_len)
-                        whole_img_data[0 : len(bootinfo_filedata)] = bootinfo_filedata
-                        whole_img_data[img_addr : img_addr + len(filedata)] = filedata
+                        layout.add_file(0, bootinfo_path)
+                        layout.add_file(img_addr, img_path)
                         fw_with_bootinfo = False
-                    fp = open(os.path.join(app_path, whole_img_output_file), "wb+")
-                    fp.write(whole_img_data)
-                    fp.close()
+                    layout.write(os.path.join(app_path, whole_img_output_file))
                     # bflb_utils.update_cfg(cfg, "FLASH_CFG", "file", convert_path(whole_img_output_file))
                     # bflb_utils.update_cfg(cfg, "FLASH_CFG", "address", values["bootinfo_addr"].replace("0x", ""))
                 if fw_with_bootinfo is True:
@@ -2238,6 +2225,7 @@ class BflbMcuTool(object):
             error = '{"ErrorCode":"FFFF","ErrorMsg":"BFLB INTERFACE HAS NO COM PORT"}'
             bflb_utils.printf(error)
             return error
+        self.eflash_loader_args = (options, eflash_loader_bin)
         if act == "download":
             args = parser_eflash.parse_args(options)
             ret = self.eflash_loader_thread(
@@ -2249,8 +2237,9 @@ class BflbMcuTool(object):
                 publickey_str=values["publickey"],
             )
             return ret
+        return True
 
-    def program_bl808_bl628_img(self, values, callback=None):
+    def program_bl808_bl628_img(self, values, callback=None, act="download"):
         options = ""
         ret = None
         create_output_path = os.path.relpath(self.img_create_path, app_path)
@@ -2377,6 +2366,11 @@ class BflbMcuTool(object):
                 bflb_utils.update_cfg(cfg, "LOAD_CFG", "verify", "1")
             else:
                 bflb_utils.update_cfg(cfg, "LOAD_CFG", "verify", "0")
+        if "dl_delta" in values.keys():
+            if values["dl_delta"] == "True":
+                bflb_utils.update_cfg(cfg, "LOAD_CFG", "delta_write", "true")
+            else:
+                bflb_utils.update_cfg(cfg, "LOAD_CFG", "delta_write", "false")
 
         eflash_loader_bin = os.path.join(
             chip_path, self.chipname, "eflash_loader/" + get_eflash_loader(values["dl_xtal"])
@@ -2410,55 +2404,47 @@ class BflbMcuTool(object):
                     whole_img_len = group1_img_offset + group1_img_len + group1_img_start
                 else:
                     whole_img_len = group0_img_offset + group0_img_len + group0_img_start
-                whole_img_data = self.bl_create_flash_default_data(whole_img_len)
+                layout = bflb_img_layout.BflbImgLayout(whole_img_len)
+                group0_bootinfo_path = os.path.join(app_path, group0_bootinfo_file)
+                group0_img_path = os.path.join(app_path, group0_img_output_file)
+                group1_bootinfo_path = os.path.join(app_path, group1_bootinfo_file)
+                group1_img_path = os.path.join(app_path, group1_img_output_file)
 
                 if group0_img_len > 0:
-                    group0_bootinfo_filedata = self.bl_get_file_data([group0_bootinfo_file])[0]
-
-                if group1_img_len > 0:
-                    group1_bootinfo_filedata = self.bl_get_file_data([group1_bootinfo_file])[0]
-
-                if group0_img_len > 0:
-                    group0_filedata = self.bl_get_file_data([group0_img_output_file])[0]
-                    if group0_img_len != len(group0_filedata):
+                    group0_filedata_len = os.path.getsize(group0_img_path)
+                    if group0_img_len != group0_filedata_len:
                         bflb_utils.printf(
-                            "group0 img len error, get %d except %d" % (group0_img_len, len(group0_filedata))
+                            "group0 img len error, get %d except %d" % (group0_img_len, group0_filedata_len)
                         )
-                    if group0_bootinfo_filedata[0:4] == group0_filedata[0:4]:
-                        whole_img_data = group0_filedata
+                    if bflb_img_layout.read_file_head(group0_bootinfo_path) == bflb_img_layout.read_file_head(
+                        group0_img_path
+                    ):
+                        layout.reset()
+                        layout.add_file(0, group0_img_path)
                         group0_fw_with_bootinfo = True
                     else:
-                        whole_img_data[0 : len(group0_bootinfo_filedata)] = group0_bootinfo_filedata
-                        whole_img_data[
-                            group0_img_offset
-                            + group0_img_start : group0_img_offset
-                            + len(group0_filedata)
-                            + group0_img_start
-                        ] = group0_filedata
+                        layout.add_file(0, group0_bootinfo_path)
+                        layout.add_file(group0_img_offset + group0_img_start, group0_img_path)
                         group0_fw_with_bootinfo = False
 
                 if group1_img_len > 0:
-                    group1_filedata = self.bl_get_file_data([group1_img_output_file])[0]
-                    if group1_img_len != len(group1_filedata):
+                    group1_filedata_len = os.path.getsize(group1_img_path)
+                    if group1_img_len != group1_filedata_len:
                         bflb_utils.printf(
-                            "group1 img len error, get %d except %d" % (group1_img_len, len(group1_filedata))
+                            "group1 img len error, get %d except %d" % (group1_img_len, group1_filedata_len)
                         )
-                    if group1_bootinfo_filedata[0:4] == group1_filedata[0:4]:
-                        whole_img_data = group1_filedata
+                    if bflb_img_layout.read_file_head(group1_bootinfo_path) == bflb_img_layout.read_file_head(
+                        group1_img_path
+                    ):
+                        layout.reset()
+                        layout.add_file(0, group1_img_path)
                         group1_fw_with_bootinfo = True
                     else:
-                        whole_img_data[0x1000 : 0x1000 + len(group1_bootinfo_filedata)] = group1_bootinfo_filedata
-                        whole_img_data[
-                            group1_img_offset
-                            + group1_img_start : group1_img_offset
-                            + len(group1_filedata)
-                            + group1_img_start
-                        ] = group1_filedata
+                        layout.add_file(0x1000, group1_bootinfo_path)
+                        layout.add_file(group1_img_offset + group1_img_start, group1_img_path)
                         group1_fw_with_bootinfo = False
 
-                fp = open(os.path.join(app_path, whole_img_output_file), "wb+")
-                fp.write(whole_img_data)
-                fp.close()
+                layout.write(os.path.join(app_path, whole_img_output_file))
                 # bflb_utils.update_cfg(cfg, "FLASH_CFG", "file", convert_path(whole_img_output_file))
                 # bflb_utils.update_cfg(cfg, "FLASH_CFG", "address", "00000000")
             file_list = ""
@@ -2564,6 +2550,9 @@ class BflbMcuTool(object):
             error = '{"ErrorCode":"FFFF","ErrorMsg":"BFLB INTERFACE HAS NO COM PORT"}'
             bflb_utils.printf(error)
             return error
+        self.eflash_loader_args = (options, eflash_loader_bin)
+        if act != "download":
+            return True
         args = parser_eflash.parse_args(options)
         ret = self.eflash_loader_thread(
             args,
@@ -2575,7 +2564,7 @@ class BflbMcuTool(object):
         )
         return ret
 
-    def program_bl616_img(self, values, callback=None):
+    def program_bl616_img(self, values, callback=None, act="download"):
         options = ""
         ret = None
         create_output_path = os.path.relpath(self.img_create_path, app_path)
@@ -2637,6 +2626,11 @@ class BflbMcuTool(object):
                 bflb_utils.update_cfg(cfg, "LOAD_CFG", "verify", "1")
             else:
                 bflb_utils.update_cfg(cfg, "LOAD_CFG", "verify", "0")
+        if "dl_delta" in values.keys():
+            if values["dl_delta"] == "True":
+                bflb_utils.update_cfg(cfg, "LOAD_CFG", "delta_write", "true")
+            else:
+                bflb_utils.update_cfg(cfg, "LOAD_CFG", "delta_write", "false")
 
         eflash_loader_bin = os.path.join(
             chip_path, self.chipname, "eflash_loader/" + get_eflash_loader(values["dl_xtal"])
@@ -2661,25 +2655,21 @@ class BflbMcuTool(object):
             bind_bootinfo = True
             fw_with_bootinfo = False
             if bind_bootinfo is True:
-                bootinfo_filedata = self.bl_get_file_data([group0_bootinfo_file])[0]
-                filedata = self.bl_get_file_data([group0_img_output_file])[0]
-                if group0_img_len != len(filedata):
-                    bflb_utils.printf("group0 img len error, get %d except %d" % (group0_img_len, len(filedata)))
-                if bootinfo_filedata[0:4] == filedata[0:4]:
-                    whole_img_len = group0_img_len
-                    whole_img_data = self.bl_create_flash_default_data(whole_img_len)
-                    whole_img_data = filedata
+                bootinfo_path = os.path.join(app_path, group0_bootinfo_file)
+                img_path = os.path.join(app_path, group0_img_output_file)
+                filedata_len = os.path.getsize(img_path)
+                if group0_img_len != filedata_len:
+                    bflb_utils.printf("group0 img len error, get %d except %d" % (group0_img_len, filedata_len))
+                if bflb_img_layout.read_file_head(bootinfo_path) == bflb_img_layout.read_file_head(img_path):
+                    layout = bflb_img_layout.BflbImgLayout()
+                    layout.add_file(0, img_path)
                     fw_with_bootinfo = True
                 else:
-                    whole_img_len = group0_img_offset + group0_img_len
-                    whole_img_data = self.bl_create_flash_default_data(whole_img_len)
-                    whole_img_data[0 : len(bootinfo_filedata)] = bootinfo_filedata
-                    whole_img_data[group0_img_offset : group0_img_offset + len(filedata)] = filedata
+                    layout = bflb_img_layout.BflbImgLayout(group0_img_offset + group0_img_len)
+                    layout.add_file(0, bootinfo_path)
+                    layout.add_file(group0_img_offset, img_path)
                     fw_with_bootinfo = False
-
-                fp = open(os.path.join(app_path, whole_img_output_file), "wb+")
-                fp.write(whole_img_data)
-                fp.close()
+                layout.write(os.path.join(app_path, whole_img_output_file))
                 # bflb_utils.update_cfg(cfg, "FLASH_CFG", "file", convert_path(whole_img_output_file))
                 # bflb_utils.update_cfg(cfg, "FLASH_CFG", "address", "00000000")
             if fw_with_bootinfo is True:
@@ -2733,6 +2723,9 @@ class BflbMcuTool(object):
             error = '{"ErrorCode":"FFFF","ErrorMsg":"BFLB INTERFACE HAS NO COM PORT"}'
             bflb_utils.printf(error)
             return error
+        self.eflash_loader_args = (options, eflash_loader_bin)
+        if act != "download":
+            return True
         args = parser_eflash.parse_args(options)
         ret = self.eflash_loader_thread(
             args,
@@ -2782,9 +2775,9 @@ class BflbMcuTool(object):
             ):
                 ret = self.program_default_img(values, callback, act=act)
             elif self.chiptype == "bl808" or self.chiptype == "bl628":
-                ret = self.program_bl808_bl628_img(values, callback)
+                ret = self.program_bl808_bl628_img(values, callback, act=act)
             else:
-                ret = self.program_bl616_img(values, callback)
+                ret = self.program_bl616_img(values, callback, act=act)
         except Exception as e:
             ret = str(e)
             traceback.print_exc(limit=5, file=sys.stdout)
@@ -2810,6 +2803,199 @@ class BflbMcuTool(object):
             return False, ret
 
 
+def get_program_ports(port):
+    # port can be "all", a glob pattern or a comma separated list of ports
+    ports = []
+    if not port:
+        return ports
+    if port.lower() == "all":
+        for item in get_serial_ports() or []:
+            ports.append(item["port"])
+    else:
+        for item in port.split(","):
+            item = item.strip()
+            if not item:
+                continue
+            if re.search("[*?\\[]", item):
+                found = [dev["port"] for dev in get_serial_ports() or []] + glob.glob(item)
+                ports.extend(sorted([dev for dev in set(found) if fnmatch.fnmatch(dev, item)]))
+            else:
+                ports.append(item)
+    result = []
+    for item in ports:
+        if item not in result:
+            result.append(item)
+    return result
+
+
+program_port_lock = None
+# chip tables of config (from changeconf when present) and the chip picked on
+# the command line, workers that are spawned rather than forked get them from
+# the parent instead of whatever their own import of config produces
+program_port_gol_keys = (
+    "chip_name",
+    "dict_chip",
+    "dict_chip_cmd",
+    "list_chip",
+    "type_chip",
+    "flash_dict",
+    "bl_factory_params_file_prefix",
+)
+
+
+def get_program_port_gol_state():
+    return dict([(key, getattr(gol, key)) for key in program_port_gol_keys if hasattr(gol, key)])
+
+
+def program_port_init(lock, gol_state=None):
+    global program_port_lock
+    program_port_lock = lock
+    for key, value in (gol_state or {}).items():
+        setattr(gol, key, value)
+
+
+def program_ports_prepare(cfg_file):
+    # decompress write streams are built once here, the workers find the
+    # files in the artifact store by path instead of compressing them again
+    cfg = BFConfigParser()
+    cfg.read(cfg_file)
+    if not cfg.has_option("FLASH_CFG", "decompress_write") or cfg.get("FLASH_CFG", "decompress_write") != "true":
+        return
+    store = bflb_artifact_store.get_artifact_store()
+    for file in re.compile("\\s+").split(cfg.get("FLASH_CFG", "file")):
+        path = os.path.join(app_path, file)
+        if file and os.path.isfile(path):
+            store.register(path)
+
+
+def program_port(chipname, chiptype, values, options, eflash_loader_bin, port):
+    start_time = time.time()
+    values = dict(values)
+    values["dl_comport"] = port
+    obj_mcu = BflbMcuTool(chipname, chiptype)
+    obj_mcu.config = values
+    # every port gets its own eflash loader cfg and loads its own copy of the
+    # image files
+    port_name = re.sub("[\\\\/:]", "_", port)
+    cfg_file = os.path.join(chip_path, chipname, "eflash_loader", "eflash_loader_cfg_" + port_name + ".ini")
+    shutil.copyfile(obj_mcu.eflash_loader_cfg_tmp, cfg_file)
+    obj_mcu.eflash_loader_cfg_tmp = cfg_file
+    cfg = BFConfigParser()
+    cfg.read(cfg_file)
+    bflb_utils.update_cfg(cfg, "LOAD_CFG", "device", port)
+    # flash_update_para rewrites the flash para file with the para of the
+    # flash found on the port, so every port needs its own copy
+    flash_para_file = None
+    if cfg.has_option("FLASH_CFG", "flash_para"):
+        flash_para = cfg.get("FLASH_CFG", "flash_para")
+        filename, ext = os.path.splitext(flash_para)
+        flash_para_file = os.path.join(app_path, filename + "_" + port_name + ext)
+        if os.path.isfile(os.path.join(app_path, flash_para)):
+            shutil.copyfile(os.path.join(app_path, flash_para), flash_para_file)
+        bflb_utils.update_cfg(cfg, "FLASH_CFG", "flash_para", flash_para_file)
+    # a port whose flash does not match the built boot header recreates the
+    # images in the shared img_create_mcu folder, copies of them keep the
+    # other ports from loading files that are being rewritten
+    port_dir = os.path.join(obj_mcu.img_create_path, "port_" + port_name)
+    port_files = {}
+    for file in re.compile("\\s+").split(cfg.get("FLASH_CFG", "file")):
+        path = os.path.abspath(os.path.join(app_path, file))
+        if file and file not in port_files and os.path.dirname(path) == os.path.abspath(obj_mcu.img_create_path):
+            port_files[file] = os.path.join(port_dir, os.path.basename(file))
+    os.makedirs(port_dir, exist_ok=True)
+    with program_port_lock:
+        for file, port_file in port_files.items():
+            shutil.copyfile(os.path.join(app_path, file), port_file)
+    if port_files:
+        files = re.compile("\\s+").split(cfg.get("FLASH_CFG", "file"))
+        bflb_utils.update_cfg(cfg, "FLASH_CFG", "file", " ".join([port_files.get(file, file) for file in files]))
+    cfg.write(cfg_file, "w+")
+    program_ports_prepare(cfg_file)
+    options = list(options)
+    if "-p" in options:
+        options[options.index("-p") + 1] = port
+    options[options.index("-c") + 1] = cfg_file
+
+    def create_img_callback():
+        # recreated in the shared img_create_mcu folder and copied while the
+        # lock is held, so no other port can rewrite them in between
+        with program_port_lock:
+            error = obj_mcu.create_img_callback()
+            for file, port_file in port_files.items():
+                shutil.copyfile(os.path.join(app_path, file), port_file)
+        program_ports_prepare(cfg_file)
+        return error
+
+    args = parser_eflash.parse_args(options)
+    ret = obj_mcu.eflash_loader_thread(
+        args,
+        eflash_loader_bin,
+        None,
+        create_img_callback,
+        privatekey_str=values["privatekey"],
+        publickey_str=values["publickey"],
+    )
+    for file in (cfg_file, flash_para_file):
+        try:
+            if file:
+                os.remove(file)
+        except OSError:
+            pass
+    shutil.rmtree(port_dir, ignore_errors=True)
+    return port, ret, time.time() - start_time
+
+
+def program_ports(obj_mcu, values, ports, jobs=None):
+    # create image and whole_img.pack once, then download to every port in parallel
+    import multiprocessing
+    import concurrent.futures
+
+    ret = obj_mcu.program_img_thread(values, act="build")
+    if ret is not True or obj_mcu.eflash_loader_args is None:
+        bflb_utils.printf(ret)
+        return False
+    options, eflash_loader_bin = obj_mcu.eflash_loader_args
+    program_ports_prepare(obj_mcu.eflash_loader_cfg_tmp)
+    if not jobs:
+        jobs = len(ports)
+    start_time = time.time()
+    results = {}
+    lock = multiprocessing.Lock()
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=min(jobs, len(ports)),
+        initializer=program_port_init,
+        initargs=(lock, get_program_port_gol_state()),
+    ) as executor:
+        futures = [
+            executor.submit(
+                program_port, obj_mcu.chipname, obj_mcu.chiptype, values, options, eflash_loader_bin, port
+            )
+            for port in ports
+        ]
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                port, ret, time_cost = future.result()
+            except Exception as e:
+                traceback.print_exc(limit=5, file=sys.stdout)
+                port, ret, time_cost = ports[futures.index(future)], str(e), 0
+            results[port] = (ret, time_cost)
+    success = 0
+    bflb_utils.printf("==================================================")
+    bflb_utils.printf("%-24s %-8s %-10s %s" % ("port", "result", "time(s)", "error"))
+    for port in ports:
+        ret, time_cost = results[port]
+        if ret is True:
+            success += 1
+            bflb_utils.printf("%-24s %-8s %-10.2f" % (port, "OK", time_cost))
+        else:
+            bflb_utils.printf("%-24s %-8s %-10.2f %s" % (port, "FAIL", time_cost, ret))
+    bflb_utils.printf(
+        "%d/%d ports programmed, total time(s): %.2f" % (success, len(ports), time.time() - start_time)
+    )
+    bflb_utils.printf("==================================================")
+    return success == len(ports)
+
+
 def get_value(args):
     if args.firmware:
         firmware = args.firmware.replace("~", expanduser("~"))
@@ -3048,25 +3234,35 @@ def get_value(args):
         config["dl_chiperase"] = "True"
     else:
         config["dl_chiperase"] = "False"
+    if args.delta:
+        config["dl_delta"] = "True"
+    else:
+        config["dl_delta"] = "False"
     return config
 
 
-def run(argv):
-    port = None
+def get_default_port():
     ports = []
-    for item in get_serial_ports():
+    for item in get_serial_ports() or []:
         ports.append(item["port"])
-    if ports:
-        try:
-            port = sorted(ports, key=lambda x: int(re.match("COM(\\d+)", x).group(1)))[0]
-        except Exception:
-            port = sorted(ports)[0]
+    if not ports:
+        return None
+    try:
+        return sorted(ports, key=lambda x: int(re.match("COM(\\d+)", x).group(1)))[0]
+    except Exception:
+        return sorted(ports)[0]
+
+
+def run(argv):
     #firmware_default = os.path.join(app_path, "img/project.bin")
     parser = argparse.ArgumentParser(description="mcu-tool")
     parser.add_argument("--chipname", required=True, help="chip name")
     parser.add_argument("--interface", dest="interface", default="uart", help="interface to use")
     parser.add_argument("--bootsrc", dest="bootsrc", default="Flash", help="boot source select")
-    parser.add_argument("--port", dest="port", default=port, help="serial port to use")
+    parser.add_argument(
+        "--port", dest="port", help="serial port to use, a comma separated list, a glob pattern or all"
+    )
+    parser.add_argument("--jobs", dest="jobs", type=int, help="max ports programmed in parallel")
     parser.add_argument("--baudrate", dest="baudrate", default=115200, type=int, help="the speed at which to communicate",)
     parser.add_argument("--xtal", dest="xtal", help="xtal type")
     parser.add_argument("--flashclk", dest="flashclk", help="flash clock")
@@ -3076,6 +3272,7 @@ def run(argv):
     parser.add_argument("--dts", dest="dts", help="device tree")
     parser.add_argument("--build", dest="build", action="store_true", help="build image")
     parser.add_argument("--erase", dest="erase", action="store_true", help="chip erase")
+    parser.add_argument("--delta", dest="delta", action="store_true", help="only write changed flash sectors")
     parser.add_argument("--log", dest="log", action="store_true", help="enable logging")
     parser.add_argument("--key", dest="key", help="aes key")
     parser.add_argument("--iv", dest="iv", help="aes iv")
@@ -3093,10 +3290,17 @@ def run(argv):
     gol.chip_name = args.chipname
     if conf_sign:
         reload(cgc)
-    if args.port:
+    # ports are only enumerated when --port was not given
+    if not args.port:
+        args.port = get_default_port()
+    program_ports_list = get_program_ports(args.port)
+    if len(program_ports_list) > 1:
+        bflb_utils.printf("Serial ports are " + ", ".join(program_ports_list))
+    elif program_ports_list:
+        args.port = program_ports_list[0]
+        bflb_utils.printf("Serial port is " + args.port)
+    elif args.port:
         bflb_utils.printf("Serial port is " + args.port)
-    elif port:
-        bflb_utils.printf("Serial port is " + port)
     else:
         bflb_utils.printf("Serial port is not found")
     bflb_utils.printf("Baudrate is " + str(args.baudrate))
@@ -3116,6 +3320,11 @@ def run(argv):
                 f_org = os.path.join(chip_path, args.chipname, "img_create_mcu", "whole_img.bin")
                 f = "firmware.bin"
                 shutil.copyfile(f_org, f)
+        elif len(program_ports_list) > 1:
+            act = "download"
+            config["dl_comport"] = program_ports_list[0]
+            if program_ports(obj_mcu, config, program_ports_list, args.jobs) is not True:
+                sys.exit(1)
         else:
             act = "download"
             obj_mcu.program_img_thread(config, act=act)
@@ -1,33 +1,49 @@
 # -*- coding:utf-8 -*-
 
-import serial
-import pylink
-import telnetlib
-import portalocker
+# submodules and chip packages are imported on first use, a cli run only pays
+# for the interfaces and crypto backends the selected chip and port need
+__all__ = [
+    "bflb_version",
+    "bflb_utils",
+    "bflb_interface_uart",
+    "bflb_interface_jlink",
+    "bflb_interface_cklink",
+    "bflb_interface_sdio",
+    "bflb_interface_openocd",
+    "bflb_eflash_loader",
+    "bflb_efuse_boothd_create",
+    "bflb_flash_select",
+    "bflb_img_create",
+    "bflb_img_loader",
+    "bflb_img_encrypt_sign",
+    "bflb_ro_params_device_tree",
+    "bflb_ro_params_gen",
+    "bflb_pt_creater",
+    "bflb_configobj",
+    "bflb_ecdh",
+    "bflb_fdt",
+    "bflb_xz_cache",
+    "bflb_metrics",
+    "bflb_riscv_bcj",
+    "bflb_aes_xts",
+    "bflb_aes_stream",
+    "bflb_img_cache",
+    "bflb_img_layout",
+    "bflb_cfg_codec",
+    "bflb_flash_index",
+    "bflb_chip_registry",
+    "bflb_artifact_store",
+    "bflb_device_ledger",
+    "bflb_session",
+    "bl602",
+    "bl702",
+    "bl702l",
+    "bl808",
+    "bl616",
+]
 
-from . import bflb_version
-from . import bflb_utils
-from . import bflb_interface_uart
-from . import bflb_interface_jlink
-from . import bflb_interface_cklink
-from . import bflb_interface_sdio
-from . import bflb_interface_openocd
-from . import bflb_eflash_loader
-from . import bflb_efuse_boothd_create
-from . import bflb_flash_select
-from . import bflb_img_create
-from . import bflb_img_loader
-from . import bflb_img_encrypt_sign
-from . import bflb_ro_params_device_tree
-from . import bflb_ro_params_gen
-from . import bflb_pt_creater
-from . import bflb_configobj
-from . import bflb_ecdh
-from . import bflb_fdt
-
-from . import bl602
-from . import bl702
-from . import bl702l
-from . import bl808
-from . import bl616
 
+def __getattr__(name):
+    if name in __all__:
+        return __import__(__name__ + "." + name, fromlist=[name])
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -0,0 +1,433 @@
+# -*- coding: utf-8 -*-
+#  Copyright (C) 2016- BOUFFALO LAB (NANJING) CO., LTD.
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+
+import os
+import sys
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+import tracemalloc
+import concurrent.futures
+
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+from libs import bflb_utils
+from libs import bflb_aes_xts
+
+STREAM_CHUNK_SIZE = 1024 * 1024
+# below this size a parallel ctr/xts run costs more than it saves
+STREAM_PARALLEL_MIN = 8 * 1024 * 1024
+AES_BLOCK_LEN = 16
+MFG_START = 0x1000
+MFG_END = 0x2000
+
+
+def ctr_iv_add(iv_bytearray, blocks):
+    # counter block of aes ctr after blocks blocks, it is one 128 bit big endian number
+    value = (int.from_bytes(iv_bytearray, "big") + blocks) & ((1 << 128) - 1)
+    return value.to_bytes(16, "big")
+
+
+class BflbGroupImgReader(object):
+    # the group image of img_get_one_group_img read piece by piece: files
+    # placed at their boot entry, gaps filled with 0xff and the end zero
+    # padded to the aes block size. nothing is kept in memory
+    def __init__(self, addrs, files):
+        self._segments = []
+        min_addr = 0x3FFFFFF
+        max_addr = 0
+        max_len = 0
+        for addr, file in zip(addrs, files):
+            if file == "UNUSED":
+                continue
+            addr &= 0x3FFFFFF
+            size = os.path.getsize(file)
+            if addr >= max_addr:
+                max_addr = addr
+                max_len = size
+            if addr <= min_addr:
+                min_addr = addr
+            self._segments.append([addr, file, size])
+        raw_length = 0
+        if max_addr or max_len:
+            raw_length = (max_addr + max_len - min_addr) & 0x3FFFFFF
+        for segment in self._segments:
+            segment[0] -= min_addr
+            # a lower file may run past the last one, the image grows with it
+            raw_length = max(raw_length, segment[0] + segment[2])
+        self.raw_length = raw_length
+        self.length = (raw_length + AES_BLOCK_LEN - 1) // AES_BLOCK_LEN * AES_BLOCK_LEN
+
+    def read(self, offset, size):
+        size = max(0, min(size, self.length - offset))
+        data = bytearray(b"\xff") * min(size, max(0, self.raw_length - offset))
+        data += bytearray(size - len(data))
+        end = offset + size
+        for start, file, file_size in self._segments:
+            lo = max(start, offset)
+            hi = min(start + file_size, end)
+            if lo >= hi:
+                continue
+            with open(file, "rb") as fp:
+                fp.seek(lo - start)
+                data[lo - offset : hi - offset] = fp.read(hi - lo)
+        return data
+
+
+class BflbAesStream(object):
+    # aes over an image given as consecutive chunks. mode is "cbc", "ctr" or
+    # "xts", offset is where the first chunk starts in the image so ctr and
+    # xts can begin anywhere, cbc only at 0. chunks are multiples of the
+    # block (xts: data unit) size except the last one
+    def __init__(self, mode, key, iv_bytearray, offset=0, encrypt=True):
+        self._mode = mode
+        self._offset = offset
+        self._xts = None
+        if mode == "xts":
+            if offset % bflb_aes_xts.XTS_UNIT_LEN:
+                raise ValueError("xts stream must start on a data unit")
+            self._xts = bflb_aes_xts.BflbAesXts(key, iv_bytearray)
+            return
+        if offset % AES_BLOCK_LEN:
+            raise ValueError("aes stream must start on a block")
+        if mode == "cbc":
+            if offset:
+                raise ValueError("cbc stream must start at 0")
+            cipher = Cipher(algorithms.AES(bytes(key)), modes.CBC(bytes(iv_bytearray)))
+        elif mode == "ctr":
+            cipher = Cipher(algorithms.AES(bytes(key)), modes.CTR(ctr_iv_add(iv_bytearray, offset // AES_BLOCK_LEN)))
+        else:
+            raise ValueError("unknown aes stream mode %s" % mode)
+        self._cipher = cipher.encryptor() if encrypt else cipher.decryptor()
+
+    def update(self, data):
+        if self._xts is not None:
+            out = self._xts.encrypt(data, self._offset // bflb_aes_xts.XTS_UNIT_LEN)
+        else:
+            out = self._cipher.update(bytes(data))
+        self._offset += len(data)
+        return out
+
+
+def img_stream_mode(flash_img, xts_mode):
+    if xts_mode:
+        return "xts"
+    if flash_img == 0:
+        return "cbc"
+    return "ctr"
+
+
+def img_stream_plain_ranges(reader, encrypt):
+    # mfg data at 0x1000 is left unencrypted, same as img_creat_process
+    if encrypt and reader.length >= MFG_END and reader.read(MFG_START, 4) == bytearray(b"0mfg"):
+        return [(MFG_START, MFG_END)]
+    return []
+
+
+def img_stream_range(reader, outputs, stream, start, end, plain_ranges=(), hashers=(), chunk_size=STREAM_CHUNK_SIZE):
+    # read [start, end) of reader, encrypt it when stream is given, write it to
+    # every output and feed every hasher. one chunk is in memory at a time
+    offset = start
+    while offset < end:
+        size = min(chunk_size, end - offset)
+        plain = reader.read(offset, size)
+        data = plain
+        if stream is not None:
+            data = bytearray(stream.update(plain))
+            for lo, hi in plain_ranges:
+                lo = max(lo, offset)
+                hi = min(hi, offset + size)
+                if lo < hi:
+                    data[lo - offset : hi - offset] = plain[lo - offset : hi - offset]
+        for fp in outputs:
+            fp.write(data)
+        for hasher in hashers:
+            hasher.update(data)
+        offset += size
+    return offset - start
+
+
+def img_stream_range_worker(addrs, files, dst_file, mode, key, iv_bytearray, start, end, plain_ranges, chunk_size):
+    reader = BflbGroupImgReader(addrs, files)
+    stream = BflbAesStream(mode, key, iv_bytearray, start)
+    with open(dst_file, "r+b") as fp:
+        fp.seek(start)
+        return img_stream_range(reader, [fp], stream, start, end, plain_ranges, (), chunk_size)
+
+
+def img_stream_split(length, jobs, align):
+    step = (length + jobs - 1) // jobs
+    step = max(align, (step + align - 1) // align * align)
+    return [(start, min(start + step, length)) for start in range(0, length, step)]
+
+
+def img_stream_encrypt(
+    reader,
+    dst_file,
+    mode=None,
+    key=None,
+    iv_bytearray=None,
+    hash_prefix=bytearray(0),
+    dst_hash_file=None,
+    jobs=1,
+    chunk_size=STREAM_CHUNK_SIZE,
+):
+    # write the (encrypted) image of reader to dst_file and, when given,
+    # dst_hash_file as the same data followed by its sha256.
+    # returns length, sha256(hash_prefix + data), sha256(data)
+    img_hasher = hashlib.sha256()
+    img_hasher.update(hash_prefix)
+    fw_hasher = hashlib.sha256()
+    length = reader.length
+    plain_ranges = img_stream_plain_ranges(reader, mode is not None)
+    if mode in ("ctr", "xts") and jobs > 1 and length >= STREAM_PARALLEL_MIN:
+        # every range is an independent ctr/xts stream, workers read the
+        # source files and write their part of dst_file themselves
+        with open(dst_file, "wb") as fp:
+            fp.truncate(length)
+        addrs = [segment[0] for segment in reader._segments]
+        files = [segment[1] for segment in reader._segments]
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            tasks = [
+                executor.submit(
+                    img_stream_range_worker,
+                    addrs,
+                    files,
+                    dst_file,
+                    mode,
+                    bytes(key),
+                    bytes(iv_bytearray),
+                    start,
+                    end,
+                    plain_ranges,
+                    chunk_size,
+                )
+                for start, end in img_stream_split(length, jobs, chunk_size)
+            ]
+            for task in tasks:
+                task.result()
+        # hash what the workers wrote, copying it to the hash file on the way
+        outputs = []
+        if dst_hash_file:
+            outputs.append(open(dst_hash_file, "wb"))
+        try:
+            img_stream_range(
+                BflbGroupImgReader([0], [dst_file]), outputs, None, 0, length, (), [img_hasher, fw_hasher], chunk_size
+            )
+            fw_hash = fw_hasher.digest()
+            for fp in outputs:
+                fp.write(fw_hash)
+        finally:
+            for fp in outputs:
+                fp.close()
+        return length, img_hasher.digest(), fw_hasher.digest()
+    stream = None
+    if mode is not None:
+        stream = BflbAesStream(mode, key, iv_bytearray)
+    outputs = [open(dst_file, "wb")]
+    if dst_hash_file:
+        outputs.append(open(dst_hash_file, "wb"))
+    try:
+        img_stream_range(reader, outputs, stream, 0, length, plain_ranges, [img_hasher, fw_hasher], chunk_size)
+        fw_hash = fw_hasher.digest()
+        for fp in outputs[1:]:
+            fp.write(fw_hash)
+    finally:
+        for fp in outputs:
+            fp.close()
+    return length, img_hasher.digest(), fw_hasher.digest()
+
+
+def img_stream_encrypt_file(src_file, dst_file, key_bytearray, iv_bytearray, flash_img, jobs=1):
+    # file to file version of img_create_encrypt_data, returns sha256 of dst_file
+    mode = img_stream_mode(flash_img, 0)
+    length, img_hash, fw_hash = img_stream_encrypt(
+        BflbGroupImgReader([0], [src_file]), dst_file, mode, key_bytearray, iv_bytearray, jobs=jobs
+    )
+    return fw_hash
+
+
+def img_stream_sha256_file(file, hash_prefix=bytearray(0), chunk_size=STREAM_CHUNK_SIZE):
+    hasher = hashlib.sha256()
+    hasher.update(hash_prefix)
+    with open(file, "rb") as fp:
+        while True:
+            data = fp.read(chunk_size)
+            if not data:
+                break
+            hasher.update(data)
+    return hasher.digest()
+
+
+def img_stream_cfg(cfg, cfg_section):
+    # encrypt_jobs and stream_chunk_size of the img create cfg section
+    jobs = 1
+    chunk_size = STREAM_CHUNK_SIZE
+    if cfg.has_option(cfg_section, "encrypt_jobs"):
+        jobs = int(cfg.get(cfg_section, "encrypt_jobs"))
+        if jobs <= 0:
+            jobs = os.cpu_count() or 1
+    if cfg.has_option(cfg_section, "stream_chunk_size"):
+        chunk_size = int(cfg.get(cfg_section, "stream_chunk_size"), 0)
+        chunk_size = max(bflb_aes_xts.XTS_UNIT_LEN, chunk_size // bflb_aes_xts.XTS_UNIT_LEN * bflb_aes_xts.XTS_UNIT_LEN)
+    return jobs, chunk_size
+
+
+def img_memory_encrypt(addrs, files, mode, key, iv_bytearray, encrypt=1):
+    # what img_creat_process does in memory, kept to check the stream against
+    min_addr = min(addr & 0x3FFFFFF for addr, file in zip(addrs, files) if file != "UNUSED")
+    data = bytearray(0)
+    for addr, file in zip(addrs, files):
+        if file == "UNUSED":
+            continue
+        with open(file, "rb") as fp:
+            file_data = fp.read()
+        start = (addr & 0x3FFFFFF) - min_addr
+        if len(data) < start:
+            data += bytearray(b"\xff") * (start - len(data))
+        data[start : start + len(file_data)] = file_data
+    if len(data) % AES_BLOCK_LEN:
+        data += bytearray(AES_BLOCK_LEN - len(data) % AES_BLOCK_LEN)
+    mfg = bytearray(0)
+    if len(data) >= MFG_END and data[MFG_START : MFG_START + 4] == bytearray(b"0mfg"):
+        mfg = data[MFG_START:MFG_END]
+    if mode == "xts":
+        data = bflb_aes_xts.img_create_encrypt_data_xts(data, key, iv_bytearray, encrypt)
+    else:
+        data = bflb_utils.img_create_encrypt_data(data, key, iv_bytearray, 0 if mode == "cbc" else 1)
+    if mfg:
+        data = data[0:MFG_START] + mfg + data[MFG_END:]
+    return bytes(data)
+
+
+def run(argv):
+    parser = argparse.ArgumentParser(description="aes stream check and benchmark")
+    parser.add_argument("--size", dest="size", default=32 * 1024 * 1024, type=int, help="image size")
+    parser.add_argument("--jobs", dest="jobs", default=os.cpu_count() or 1, type=int, help="ctr/xts worker count")
+    parser.add_argument("--mode", dest="mode", default="ctr", choices=["ctr", "cbc", "xts"], help="aes mode")
+    parser.add_argument("--dir", dest="dir", help="work dir, a temporary one is used and removed if not set")
+    args = parser.parse_args(argv)
+    if args.dir:
+        os.makedirs(args.dir, exist_ok=True)
+        return stream_check(args)
+    args.dir = tempfile.mkdtemp(prefix="stream_test_")
+    try:
+        return stream_check(args)
+    finally:
+        shutil.rmtree(args.dir, ignore_errors=True)
+
+
+def stream_check(args):
+    key = bytes.fromhex("fffefdfcfbfaf9f8f7f6f5f4f3f2f1f0000102030405060708090a0b0c0d0e0f")
+    iv = bytes.fromhex("000102030405060708090a0bfffffffe")
+    dst = os.path.join(args.dir, "out.bin")
+    result = True
+
+    def write(name, data):
+        path = os.path.join(args.dir, name)
+        with open(path, "wb") as fp:
+            fp.write(data)
+        return path
+
+    bflb_utils.printf("========= aes stream check =========")
+    mfg = bytearray(os.urandom(0x3000))
+    mfg[MFG_START : MFG_START + 4] = b"0mfg"
+    cases = [
+        ("one file", [0x58000000], [write("a.bin", os.urandom(100003))]),
+        ("mfg", [0x58000000], [write("mfg.bin", mfg)]),
+        ("gap", [0x58000000, 0x58021000], [write("b.bin", os.urandom(5000)), write("c.bin", os.urandom(777))]),
+        ("unused", [0x58000000, 0, 0x58002000], [write("d.bin", os.urandom(33)), "UNUSED", write("e.bin", b"\x01")]),
+    ]
+    for name, addrs, files in cases:
+        for mode in ("ctr", "cbc", "xts"):
+            mode_key = key if mode == "xts" else key[0:16]
+            ref = img_memory_encrypt(addrs, files, mode, mode_key, iv)
+            stream_key = mode_key
+            if mode == "xts":
+                stream_key = bflb_aes_xts.img_create_xts_key(mode_key, 1)
+            same = True
+            for jobs, chunk_size in ((1, STREAM_CHUNK_SIZE), (1, 64), (3, 96)):
+                reader = BflbGroupImgReader(addrs, files)
+                if jobs > 1 and mode != "cbc":
+                    # force the parallel path on small data
+                    pieces = img_stream_split(reader.length, jobs, chunk_size)
+                    with open(dst, "wb") as fp:
+                        fp.truncate(reader.length)
+                    for start, end in pieces:
+                        img_stream_range_worker(
+                            addrs,
+                            files,
+                            dst,
+                            mode,
+                            stream_key,
+                            iv,
+                            start,
+                            end,
+                            img_stream_plain_ranges(reader, True),
+                            chunk_size,
+                        )
+                    out_hash = img_stream_sha256_file(dst)
+                else:
+                    length, img_hash, out_hash = img_stream_encrypt(
+                        reader, dst, mode, stream_key, iv, b"prefix", dst + ".hash", jobs, chunk_size
+                    )
+                    with open(dst + ".hash", "rb") as fp:
+                        same = same and fp.read() == ref + out_hash
+                    same = same and img_hash == hashlib.sha256(b"prefix" + ref).digest()
+                with open(dst, "rb") as fp:
+                    same = same and fp.read() == ref and out_hash == hashlib.sha256(ref).digest()
+            result = result and same
+            bflb_utils.printf("%-10s%-5s%s" % (name, mode, "same" if same else "DIFFERENT"))
+
+    src = os.path.join(args.dir, "big.bin")
+    with open(src, "wb") as fp:
+        for i in range(0, args.size, STREAM_CHUNK_SIZE):
+            fp.write(os.urandom(min(STREAM_CHUNK_SIZE, args.size - i)))
+    bflb_utils.printf("%-12s%12s%12s%12s" % ("function", "time(ms)", "MB/s", "peak(KB)"))
+    ref_hash = None
+    bench_key = key if args.mode == "xts" else key[0:16]
+    stream_key = bench_key
+    if args.mode == "xts":
+        stream_key = bflb_aes_xts.img_create_xts_key(bench_key, 1)
+    for name, jobs in (("memory", 0), ("stream", 1), ("stream x%d" % args.jobs, args.jobs)):
+        tracemalloc.start()
+        start = time.time()
+        if jobs == 0:
+            out_hash = hashlib.sha256(img_memory_encrypt([0], [src], args.mode, bench_key, iv)).digest()
+        else:
+            out_hash = img_stream_encrypt(BflbGroupImgReader([0], [src]), dst, args.mode, stream_key, iv, jobs=jobs)[2]
+        cost = time.time() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        ref_hash = ref_hash or out_hash
+        result = result and out_hash == ref_hash
+        bflb_utils.printf(
+            "%-12s%12.1f%12.1f%12d" % (name, cost * 1000, args.size / cost / 1024 / 1024, peak // 1024)
+        )
+    bflb_utils.printf("output %s" % ("same" if result else "DIFFERENT"))
+    return result
+
+
+if __name__ == "__main__":
+    sys.exit(0 if run(sys.argv[1:]) else 1)
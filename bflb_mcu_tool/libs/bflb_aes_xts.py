@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+#  Copyright (C) 2016- BOUFFALO LAB (NANJING) CO., LTD.
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+import os
+import sys
+import time
+import array
+import struct
+import argparse
+
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+from libs import bflb_utils
+
+XTS_UNIT_LEN = 32
+XTS_SPAN_UNITS = 4096
+
+
+def img_create_encrypt_data_xts_reference(data_bytearray, key, iv_bytearray):
+    # one xts cipher per data unit, kept to check BflbAesXts against
+    counter = bytes(iv_bytearray[4:16])
+    total_len = len(data_bytearray)
+    ciphertext = bytearray(0)
+    deal_len = 0
+    data_unit_number = 0
+    while deal_len < total_len:
+        tweak = bytes.fromhex(bflb_utils.string_number_reverse("%08x" % data_unit_number).rjust(8, "0")) + counter
+        encryptor = Cipher(algorithms.AES(key), modes.XTS(tweak)).encryptor()
+        if 32 + deal_len <= total_len:
+            cur_block = data_bytearray[0 + deal_len : 32 + deal_len]
+            ciphertext += encryptor.update(cur_block) + encryptor.finalize()
+        else:
+            cur_block = data_bytearray[0 + deal_len : 16 + deal_len] + bytearray(16)
+            ciphertext += (encryptor.update(cur_block) + encryptor.finalize())[0:16]
+        deal_len += 32
+        data_unit_number += 1
+    return ciphertext
+
+
+def xts_double_lanes(value, lanes):
+    # multiply every 16 byte lane of a little endian integer by alpha in GF(2^128)
+    lane_start = int.from_bytes(b"\x01" + bytes(15), "little")
+    lane_mask = int.from_bytes((b"\x01" + bytes(15)) * lanes, "little")
+    top = (value >> 127) & lane_mask
+    return ((value << 1) ^ (top << 128)) ^ (top * 0x87 * lane_start)
+
+
+class BflbAesXts(object):
+    # aes xts over 32 byte data units where unit n uses the tweak
+    # le32(n) + iv[4:16]. a span of units is done with one ecb call for the
+    # tweaks and one for the data instead of a cipher object per unit
+    def __init__(self, key, iv_bytearray, span_units=XTS_SPAN_UNITS):
+        key = bytes(key)
+        # same key checks and errors as the xts mode of cryptography
+        Cipher(algorithms.AES(key), modes.XTS(bytes(16)))
+        self._key = key
+        self._counter = bytes(iv_bytearray[4:16])
+        self._span_units = span_units
+        half = len(key) // 2
+        self._data_cipher = Cipher(algorithms.AES(key[:half]), modes.ECB()).encryptor()
+        self._tweak_cipher = Cipher(algorithms.AES(key[half:]), modes.ECB()).encryptor()
+
+    def tweak(self, unit):
+        if unit > 0xFFFFFFFF:
+            return bytes(4) + self._counter
+        return struct.pack("<I", unit) + self._counter
+
+    def tweaks(self, start_unit, count):
+        # encrypted tweaks of the first and second block of every unit
+        tweak_blocks = bytearray(self._counter.rjust(16, b"\0") * count)
+        if start_unit + count - 1 <= 0xFFFFFFFF:
+            units = array.array("I", range(start_unit, start_unit + count))
+            if sys.byteorder == "big":
+                units.byteswap()
+            memoryview(tweak_blocks).cast("I")[0::4] = units
+        else:
+            for i in range(count):
+                tweak_blocks[i * 16 : i * 16 + 16] = self.tweak(start_unit + i)
+        first = self._tweak_cipher.update(bytes(tweak_blocks))
+        second = xts_double_lanes(int.from_bytes(first, "little"), count).to_bytes(count * 16, "little")
+        return first, second
+
+    def encrypt_units_into(self, data, output, offset, start_unit, count):
+        # data holds count full units, the result is written to output[offset:]
+        first, second = self.tweaks(start_unit, count)
+        mask = bytearray(count * XTS_UNIT_LEN)
+        mask_view = memoryview(mask).cast("Q")
+        first_view = memoryview(first).cast("Q")
+        second_view = memoryview(second).cast("Q")
+        mask_view[0::4] = first_view[0::2]
+        mask_view[1::4] = first_view[1::2]
+        mask_view[2::4] = second_view[0::2]
+        mask_view[3::4] = second_view[1::2]
+        mask_int = int.from_bytes(mask, "little")
+        length = count * XTS_UNIT_LEN
+        plain = (int.from_bytes(data, "little") ^ mask_int).to_bytes(length, "little")
+        cipher = int.from_bytes(self._data_cipher.update(plain), "little") ^ mask_int
+        output[offset : offset + length] = cipher.to_bytes(length, "little")
+
+    def encrypt(self, data_bytearray, start_unit=0):
+        # start_unit lets a stream encrypt an image piece by piece
+        total_len = len(data_bytearray)
+        units = total_len // XTS_UNIT_LEN
+        tail_len = total_len - units * XTS_UNIT_LEN
+        output = bytearray(units * XTS_UNIT_LEN + (16 if tail_len else 0))
+        data_view = memoryview(data_bytearray)
+        for start in range(0, units, self._span_units):
+            count = min(self._span_units, units - start)
+            offset = start * XTS_UNIT_LEN
+            self.encrypt_units_into(
+                data_view[offset : offset + count * XTS_UNIT_LEN], output, offset, start_unit + start, count
+            )
+        if tail_len:
+            # a short last unit is zero padded and cut to 16 bytes, ciphertext
+            # stealing may apply so it goes through the xts mode itself
+            offset = units * XTS_UNIT_LEN
+            encryptor = Cipher(algorithms.AES(self._key), modes.XTS(self.tweak(start_unit + units))).encryptor()
+            cur_block = bytes(data_bytearray[offset : offset + 16]) + bytes(16)
+            output[offset:] = (encryptor.update(cur_block) + encryptor.finalize())[0:16]
+        return output
+
+
+def img_create_xts_key(key_bytearray, encrypt):
+    key = key_bytearray[0:16] + key_bytearray[16:32]
+    if encrypt == 2 or encrypt == 3:
+        key = key_bytearray + key_bytearray
+    return key
+
+
+def img_create_encrypt_data_xts(data_bytearray, key_bytearray, iv_bytearray, encrypt):
+    return BflbAesXts(img_create_xts_key(key_bytearray, encrypt), iv_bytearray).encrypt(data_bytearray)
+
+
+def run(argv):
+    parser = argparse.ArgumentParser(description="aes xts check and benchmark")
+    parser.add_argument("--size", dest="size", default=4 * 1024 * 1024, type=int, help="data size")
+    args = parser.parse_args(argv)
+    key = bytes.fromhex("fffefdfcfbfaf9f8f7f6f5f4f3f2f1f0000102030405060708090a0b0c0d0e0f")
+    iv = bytes.fromhex("00000000000000000000000000000001")
+    result = True
+    bflb_utils.printf("========= aes xts check =========")
+    for size in [0, 8, 16, 20, 31, 32, 48, 4096, 4096 + 16, XTS_SPAN_UNITS * 32 + 24]:
+        data = os.urandom(size)
+        same = img_create_encrypt_data_xts(data, key, iv, 1) == img_create_encrypt_data_xts_reference(data, key, iv)
+        result = result and same
+        bflb_utils.printf("size %-10d %s" % (size, "same" if same else "DIFFERENT"))
+    data = os.urandom(args.size)
+    start = time.time()
+    ref = img_create_encrypt_data_xts_reference(data, key, iv)
+    ref_cost = time.time() - start
+    start = time.time()
+    out = img_create_encrypt_data_xts(data, key, iv, 1)
+    cost = time.time() - start
+    result = result and ref == out
+    bflb_utils.printf("%-12s%12s%12s" % ("function", "time(ms)", "MB/s"))
+    for name, cost in (("reference", ref_cost), ("batched", cost)):
+        bflb_utils.printf("%-12s%12.1f%12.1f" % (name, cost * 1000, args.size / cost / 1024 / 1024))
+    bflb_utils.printf("output %s" % ("same" if ref == out else "DIFFERENT"))
+    return result
+
+
+if __name__ == "__main__":
+    sys.exit(0 if run(sys.argv[1:]) else 1)
@@ -0,0 +1,416 @@
+# -*- coding: utf-8 -*-
+#  Copyright (C) 2016- BOUFFALO LAB (NANJING) CO., LTD.
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+import os
+import sys
+import json
+import lzma
+import mmap
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+import threading
+
+try:
+    import bflb_path
+except ImportError:
+    from libs import bflb_path
+from libs import bflb_utils
+from libs.bflb_utils import app_path
+
+ARTIFACT_DIR = os.path.join(app_path, "cache", "artifact")
+ARTIFACT_MAX_SIZE = 1024 * 1024 * 1024
+ARTIFACT_SECTOR_SIZE = 4096
+ARTIFACT_VERSION = 1
+# same stream as BflbEflashLoader.flash_load_xz_compress builds
+XZ_FILTERS = [{"id": lzma.FILTER_LZMA2, "dict_size": 32768}]
+XZ_CHECK = lzma.CHECK_CRC32
+
+
+def map_file(path):
+    # read only mapping shared with every process that maps the same file
+    with open(path, "rb") as fp:
+        if os.fstat(fp.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def data_segments(data, block_size):
+    # (offset, length) runs that are not entirely 0xFF, like flash_data_segments
+    segments = []
+    seg_start = None
+    for i in range(0, len(data), block_size):
+        block = data[i : i + block_size]
+        if block.count(0xFF) == len(block):
+            if seg_start is not None:
+                segments.append((seg_start, i - seg_start))
+                seg_start = None
+        elif seg_start is None:
+            seg_start = i
+    if seg_start is not None:
+        segments.append((seg_start, len(data) - seg_start))
+    return segments
+
+
+class BflbArtifact(object):
+    # one stored image, its raw data, xz stream and per sector sha-256 are
+    # mapped read only on first use
+    def __init__(self, entry_dir, meta):
+        self.entry_dir = entry_dir
+        self.meta = meta
+        self.sha256 = meta["sha256"]
+        self.size = meta["size"]
+        self.sector_size = meta["sector_size"]
+        self.segments = [tuple(item) for item in meta["segments"]]
+        self._maps = {}
+
+    def _map(self, name):
+        data = self._maps.get(name)
+        if data is None:
+            data = map_file(os.path.join(self.entry_dir, name))
+            self._maps[name] = data
+        return data
+
+    @property
+    def path(self):
+        return os.path.join(self.entry_dir, "image.bin")
+
+    @property
+    def data(self):
+        return self._map("image.bin")
+
+    @property
+    def xz(self):
+        return self._map("image.xz")
+
+    def digest(self):
+        return bytes(bytearray.fromhex(self.sha256))
+
+    def sector_sha256(self, offset, length, sector_size):
+        # digest of one whole sector, or of the last partial one
+        if sector_size != self.sector_size or offset % sector_size != 0 or offset >= self.size:
+            return None
+        if length != sector_size and offset + length != self.size:
+            return None
+        if length > sector_size:
+            return None
+        index = offset // sector_size
+        return bytes(self._map("sectors.sha")[index * 32 : index * 32 + 32])
+
+
+class BflbArtifactStore(object):
+    # content addressed images prepared once and shared by all workers:
+    #   <sha256>/image.bin, image.xz, sectors.sha, meta.json
+    #   xz/<sha256 of segment>.xz  xz stream of every non 0xFF segment
+    #   paths/<hash of path>.json  registered path -> sha256, size and mtime
+    # entries are built in a temp dir and renamed in place, so readers only
+    # ever see complete entries and no lock is needed between processes
+    def __init__(self, store_dir=ARTIFACT_DIR, max_size=ARTIFACT_MAX_SIZE):
+        self._store_dir = store_dir
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._artifacts = {}
+        self._xz_maps = {}
+        self.hits = 0
+
+    def enabled(self):
+        return os.path.isdir(self._store_dir)
+
+    def _entry_dir(self, sha256):
+        return os.path.join(self._store_dir, sha256)
+
+    def _path_index(self, path):
+        key = hashlib.sha256(os.path.normcase(os.path.abspath(path)).encode("utf-8")).hexdigest()[0:16]
+        return os.path.join(self._store_dir, "paths", key + ".json")
+
+    @staticmethod
+    def _write_file(dirname, name, data):
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                fp.write(data)
+            os.replace(tmp_path, os.path.join(dirname, name))
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    def put(self, data, name=""):
+        sha256 = hashlib.sha256(data).hexdigest()
+        entry_dir = self._entry_dir(sha256)
+        if os.path.exists(os.path.join(entry_dir, "meta.json")):
+            os.utime(entry_dir, None)
+            return sha256
+        start_time = time.time()
+        os.makedirs(os.path.join(self._store_dir, "xz"), exist_ok=True)
+        xz_data = lzma.compress(data, check=XZ_CHECK, filters=XZ_FILTERS)
+        segments = data_segments(data, ARTIFACT_SECTOR_SIZE)
+        for offset, length in segments:
+            if offset == 0 and length == len(data):
+                continue
+            segment = data[offset : offset + length]
+            xz_path = os.path.join(self._store_dir, "xz", hashlib.sha256(segment).hexdigest() + ".xz")
+            if not os.path.exists(xz_path):
+                self._write_file(
+                    os.path.dirname(xz_path),
+                    os.path.basename(xz_path),
+                    lzma.compress(segment, check=XZ_CHECK, filters=XZ_FILTERS),
+                )
+        sectors = bytearray()
+        for i in range(0, len(data), ARTIFACT_SECTOR_SIZE):
+            sectors += hashlib.sha256(data[i : i + ARTIFACT_SECTOR_SIZE]).digest()
+        meta = {
+            "version": ARTIFACT_VERSION,
+            "sha256": sha256,
+            "name": name,
+            "size": len(data),
+            "xz_size": len(xz_data),
+            "sector_size": ARTIFACT_SECTOR_SIZE,
+            "segments": segments,
+            "created": time.time(),
+        }
+        tmp_dir = tempfile.mkdtemp(dir=self._store_dir, suffix=".tmp")
+        try:
+            with open(os.path.join(tmp_dir, "image.bin"), "wb") as fp:
+                fp.write(data)
+            with open(os.path.join(tmp_dir, "image.xz"), "wb") as fp:
+                fp.write(xz_data)
+            with open(os.path.join(tmp_dir, "sectors.sha"), "wb") as fp:
+                fp.write(sectors)
+            with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as fp:
+                json.dump(meta, fp)
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # another process stored the same image first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            if not os.path.exists(os.path.join(entry_dir, "meta.json")):
+                raise
+        bflb_utils.printf(
+            "artifact {0} stored, size {1}, xz {2}, time cost(ms): {3}".format(
+                sha256[0:16], len(data), len(xz_data), round((time.time() - start_time) * 1000, 3)
+            )
+        )
+        self.evict()
+        return sha256
+
+    def register(self, path):
+        # store the file and remember it by path, jobs that load this path
+        # use the artifact as long as the file is not changed
+        with open(path, "rb") as fp:
+            st = os.fstat(fp.fileno())
+            data = fp.read()
+        sha256 = self.put(data, os.path.basename(path))
+        index_path = self._path_index(path)
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        index = {"path": os.path.abspath(path), "size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": sha256}
+        self._write_file(os.path.dirname(index_path), os.path.basename(index_path), json.dumps(index).encode("utf-8"))
+        return sha256
+
+    def get(self, sha256):
+        with self._lock:
+            artifact = self._artifacts.get(sha256)
+        if artifact is not None:
+            if os.path.isdir(artifact.entry_dir):
+                return artifact
+            # evicted by another process, read it again if it was stored again
+            with self._lock:
+                self._artifacts.pop(sha256, None)
+        entry_dir = self._entry_dir(sha256)
+        try:
+            with open(os.path.join(entry_dir, "meta.json"), "r", encoding="utf-8") as fp:
+                meta = json.load(fp)
+        except (IOError, OSError, ValueError):
+            return None
+        if meta.get("version") != ARTIFACT_VERSION:
+            return None
+        artifact = BflbArtifact(entry_dir, meta)
+        with self._lock:
+            self._artifacts[sha256] = artifact
+        return artifact
+
+    def lookup(self, path):
+        # artifact of a registered path or of an image inside the store
+        if not path or not self.enabled():
+            return None
+        path = os.path.abspath(path)
+        if os.path.dirname(os.path.dirname(path)) == os.path.abspath(self._store_dir):
+            if os.path.basename(path) == "image.bin":
+                return self.get(os.path.basename(os.path.dirname(path)))
+        try:
+            st = os.stat(path)
+            with open(self._path_index(path), "r", encoding="utf-8") as fp:
+                index = json.load(fp)
+        except (IOError, OSError, ValueError):
+            return None
+        if index["path"] != path or index["size"] != st.st_size or index["mtime_ns"] != st.st_mtime_ns:
+            return None
+        return self.get(index["sha256"])
+
+    def get_xz(self, data, path=None):
+        # prepared xz stream of data, found by path or by content
+        if not self.enabled():
+            return None
+        artifact = self.lookup(path)
+        if artifact is None:
+            sha256 = hashlib.sha256(data).hexdigest()
+            artifact = self.get(sha256)
+        if artifact is not None:
+            if artifact.size != len(data):
+                return None
+            try:
+                # touch entry to keep it at the head of the lru
+                os.utime(artifact.entry_dir, None)
+            except OSError:
+                pass
+            with self._lock:
+                self.hits += 1
+            return artifact.xz
+        xz_path = os.path.join(self._store_dir, "xz", sha256 + ".xz")
+        try:
+            os.utime(xz_path, None)
+        except OSError:
+            with self._lock:
+                self._xz_maps.pop(sha256, None)
+            return None
+        with self._lock:
+            xz_data = self._xz_maps.get(sha256)
+        if xz_data is None:
+            try:
+                xz_data = map_file(xz_path)
+            except (IOError, OSError):
+                return None
+            with self._lock:
+                self._xz_maps[sha256] = xz_data
+        with self._lock:
+            self.hits += 1
+        return xz_data
+
+    def list(self):
+        artifacts = []
+        try:
+            names = os.listdir(self._store_dir)
+        except OSError:
+            return artifacts
+        for name in sorted(names):
+            if len(name) == 64:
+                artifact = self.get(name)
+                if artifact is not None:
+                    artifacts.append(artifact.meta)
+        return artifacts
+
+    def _list_files(self, name, suffix):
+        dirname = os.path.join(self._store_dir, name)
+        try:
+            names = os.listdir(dirname)
+        except OSError:
+            return []
+        return [os.path.join(dirname, item) for item in names if item.endswith(suffix)]
+
+    def evict(self):
+        # drop the least recently stored or used images and segment streams
+        # over max_size, a worker that still maps one keeps its data until it
+        # lets go
+        entries = []
+        total = 0
+        for meta in self.list():
+            entry_dir = self._entry_dir(meta["sha256"])
+            try:
+                mtime = os.stat(entry_dir).st_mtime
+            except OSError:
+                continue
+            entries.append((mtime, meta["size"] * 2 + meta["xz_size"], entry_dir))
+            total += meta["size"] * 2 + meta["xz_size"]
+        for path in self._list_files("xz", ".xz") + self._list_files("paths", ".json"):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self._max_size:
+                break
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+                with self._lock:
+                    self._artifacts.pop(os.path.basename(path), None)
+            else:
+                try:
+                    os.remove(path)
+                except OSError:
+                    # already evicted by another process
+                    pass
+                if path.endswith(".xz"):
+                    with self._lock:
+                        self._xz_maps.pop(os.path.basename(path)[0:-3], None)
+            total -= size
+        # path indexes of evicted images only lead to misses
+        for path in self._list_files("paths", ".json"):
+            try:
+                with open(path, "r", encoding="utf-8") as fp:
+                    sha256 = json.load(fp)["sha256"]
+            except (IOError, OSError, ValueError, KeyError):
+                continue
+            if not os.path.isdir(self._entry_dir(sha256)):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+_artifact_stores = {}
+_artifact_stores_lock = threading.Lock()
+
+
+def get_artifact_store(store_dir=None, max_size=None):
+    # one store per directory, the size limit of the latest caller wins
+    store_dir = os.path.abspath(store_dir or ARTIFACT_DIR)
+    with _artifact_stores_lock:
+        artifact_store = _artifact_stores.get(store_dir)
+        if artifact_store is None:
+            artifact_store = BflbArtifactStore(store_dir)
+            _artifact_stores[store_dir] = artifact_store
+        artifact_store._max_size = max_size or ARTIFACT_MAX_SIZE
+    return artifact_store
+
+
+def run(argv):
+    parser = argparse.ArgumentParser(description="bouffalolab image artifact store")
+    parser.add_argument("--dir", dest="dir", default=ARTIFACT_DIR, help="artifact store directory")
+    parser.add_argument("--register", dest="register", nargs="*", default=[], help="image files to register")
+    parser.add_argument("--list", dest="list", action="store_true", help="list stored images")
+    args = parser.parse_args(argv)
+    store = BflbArtifactStore(args.dir)
+    for path in args.register:
+        bflb_utils.printf("{0} {1}".format(store.register(path), path))
+    if args.list:
+        for meta in store.list():
+            bflb_utils.printf(
+                "%s %10d %10d %4d %s"
+                % (meta["sha256"], meta["size"], meta["xz_size"], len(meta["segments"]), meta["name"])
+            )
+    return True
+
+
+if __name__ == "__main__":
+    sys.exit(0 if run(sys.argv[1:]) else 1)
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+#  Copyright (C) 2016- BOUFFALO LAB (NANJING) CO., LTD.
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+
+import sys
+import time
+import struct
+import argparse
+import importlib
+
+from libs import bflb_utils
+from libs.bflb_configobj import BFConfigParser
+
+CFG_WORD = struct.Struct("<I")
+CFG_WORD_MASK = 0xFFFFFFFF
+
+_codec_cache = {}
+
+
+def get_int_mask(pos, length):
+    ones = "1" * 32
+    zeros = "0" * 32
+    mask = ones[0 : 32 - pos - length] + zeros[0:length] + ones[0:pos]
+    return int(mask, 2)
+
+
+def cfg_value_to_int(val):
+    if val.startswith("0x"):
+        return int(val, 16)
+    return int(val, 10)
+
+
+class BflbCfgCodec(object):
+    # bootheader/efuse/flash field table (key -> offset, pos, bitlen as strings)
+    # compiled once into integer masks. fields of the tables are little endian
+    # 32 bit words on 4 byte aligned offsets, so packing works on a dict of
+    # words and the buffer is written in one pass at the end
+    def __init__(self, config_keys):
+        self.fields = {}
+        max_offset = 0
+        for key, item in config_keys.items():
+            offset = int(item["offset"], 10)
+            pos = int(item["pos"], 10)
+            bitlen = int(item["bitlen"], 10)
+            clear_mask = get_int_mask(pos, bitlen) & CFG_WORD_MASK
+            self.fields[key] = (offset, pos, clear_mask, ~clear_mask & CFG_WORD_MASK)
+            if offset > max_offset:
+                max_offset = offset
+        self.length = max_offset + 4
+
+    def has_key(self, key):
+        return key in self.fields
+
+    def offset(self, key):
+        return self.fields[key][0]
+
+    def values_from_cfg(self, cfg, section, verbose=True, warning="%s does not exist"):
+        items = [(key, cfg.get(section, key)) for key in cfg.options(section)]
+        return self.values_from_items(items, verbose, warning)
+
+    def values_from_items(self, items, verbose=True, warning="%s does not exist"):
+        # keep the option order of the section, later fields in the same word
+        # are applied on top of earlier ones like the table walk used to do
+        values = []
+        for key, val in items:
+            if key not in self.fields:
+                if verbose:
+                    bflb_utils.printf(warning % key)
+                continue
+            values.append((key, cfg_value_to_int(val)))
+        return values
+
+    def span(self, keys):
+        offsets = [self.fields[key][0] for key in keys if key in self.fields]
+        if not offsets:
+            return 0, 4
+        return min(offsets), max(offsets) - min(offsets) + 4
+
+    def pack(self, values, base=0, length=None):
+        words = {}
+        masks = {}
+        for key, val in values:
+            offset, pos, clear_mask, field_mask = self.fields[key]
+            offset -= base
+            words[offset] = ((words.get(offset, 0) & clear_mask) + (val << pos)) & CFG_WORD_MASK
+            if val != 0:
+                masks[offset] = masks.get(offset, 0) | field_mask
+            else:
+                masks.setdefault(offset, 0)
+        if length is None:
+            length = self.length - base
+        data = bytearray(length)
+        data_mask = bytearray(length)
+        for offset in sorted(words):
+            if offset + 4 > len(data):
+                data.extend(bytearray(offset + 4 - len(data)))
+                data_mask.extend(bytearray(offset + 4 - len(data_mask)))
+            CFG_WORD.pack_into(data, offset, words[offset])
+            CFG_WORD.pack_into(data_mask, offset, masks[offset])
+        return data, data_mask
+
+    def unpack(self, data, base=0, keys=None):
+        words = {}
+        values = {}
+        for key in keys or self.fields:
+            offset, pos, clear_mask, field_mask = self.fields[key]
+            offset -= base
+            if offset < 0 or offset + 4 > len(data):
+                continue
+            if offset not in words:
+                words[offset] = CFG_WORD.unpack_from(data, offset)[0]
+            values[key] = (words[offset] & field_mask) >> pos
+        return values
+
+    def pack_cfg(self, config_file, section, base=0, length=None):
+        cfg = BFConfigParser()
+        cfg.read(config_file)
+        return self.pack(self.values_from_cfg(cfg, section), base, length)
+
+
+def compile_cfg_keys(config_keys):
+    # cache keyed by the table object, the table is kept alive with its codec
+    item = _codec_cache.get(id(config_keys))
+    if item is None or item[0] is not config_keys:
+        item = (config_keys, BflbCfgCodec(config_keys))
+        _codec_cache[id(config_keys)] = item
+    return item[1]
+
+
+def get_cfg_codec(chiptype, table="bootheader"):
+    module = importlib.import_module("libs.%s.%s_cfg_keys" % (chiptype, table))
+    return compile_cfg_keys(getattr(module, table + "_cfg_keys"))
+
+
+def run(argv):
+    parser = argparse.ArgumentParser(description="cfg codec check and benchmark")
+    parser.add_argument("--chip", dest="chip", default="bl808", help="chip type")
+    parser.add_argument("--count", dest="count", default=200, type=int, help="pack count")
+    args = parser.parse_args(argv)
+    same = True
+    bflb_utils.printf("%-12s%8s%14s%14s" % ("table", "fields", "walk(us)", "codec(us)"))
+    for table in ("bootheader", "efuse"):
+        codec = get_cfg_codec(args.chip, table)
+        config_keys = importlib.import_module("libs.%s.%s_cfg_keys" % (args.chip, table))
+        config_keys = getattr(config_keys, table + "_cfg_keys")
+        values = []
+        for i, key in enumerate(config_keys):
+            offset, pos, clear_mask, field_mask = codec.fields[key]
+            values.append((key, (i * 0x9E3779B1) & (field_mask >> pos)))
+
+        # the per field read-modify-write update_data_from_cfg used to do
+        start = time.time()
+        for i in range(args.count):
+            data = bytearray(codec.length)
+            data_mask = bytearray(codec.length)
+            for key, val in values:
+                offset = int(config_keys.get(key)["offset"], 10)
+                pos = int(config_keys.get(key)["pos"], 10)
+                bitlen = int(config_keys.get(key)["bitlen"], 10)
+                oldval = bflb_utils.bytearray_to_int(bflb_utils.bytearray_reverse(data[offset : offset + 4]))
+                oldval_mask = bflb_utils.bytearray_to_int(bflb_utils.bytearray_reverse(data_mask[offset : offset + 4]))
+                newval = (oldval & get_int_mask(pos, bitlen)) + (val << pos)
+                if val != 0:
+                    oldval_mask = oldval_mask | (~get_int_mask(pos, bitlen))
+                data[offset : offset + 4] = bflb_utils.int_to_4bytearray_l(newval)
+                data_mask[offset : offset + 4] = bflb_utils.int_to_4bytearray_l(oldval_mask)
+        ref_cost = (time.time() - start) / args.count
+
+        start = time.time()
+        for i in range(args.count):
+            new_data, new_mask = codec.pack(values)
+        cost = (time.time() - start) / args.count
+        if new_data != data or new_mask != data_mask:
+            same = False
+        unpacked = codec.unpack(new_data)
+        packed, tmp = codec.pack(list(unpacked.items()))
+        if packed != new_data:
+            same = False
+        bflb_utils.printf("%-12s%8d%14.1f%14.1f" % (table, len(values), ref_cost * 1e6, cost * 1e6))
+    bflb_utils.printf("output %s" % ("same" if same else "DIFFERENT"))
+    return same
+
+
+if __name__ == "__main__":
+    sys.exit(0 if run(sys.argv[1:]) else 1)
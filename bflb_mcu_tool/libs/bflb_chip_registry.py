@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+#  Copyright (C) 2016- BOUFFALO LAB (NANJING) CO., LTD.
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+
+import threading
+
+from libs import bflb_cfg_codec
+
+# boot header load command of each chip type, chips not listed use "load_boot_header"
+CHIP_BOOT_HEADER_SECTIONS = {
+    "bl808": "808_load_boot_header",
+    "bl628": "628_load_boot_header",
+    "bl616": "616_load_boot_header",
+    "wb03": "616_load_boot_header",
+    "bl702l": "702l_load_boot_header",
+    "bl616l": "616l_load_boot_header",
+    "bl616d": "616d_load_boot_header",
+}
+# segment count offset in each boot header load command, used for chips without
+# a libs package
+CHIP_SEGCNT_OFFSETS = {
+    "load_boot_header": 120,
+    "808_load_boot_header": 140,
+    "628_load_boot_header": 136,
+    "616_load_boot_header": 132,
+    "702l_load_boot_header": 120,
+}
+# chips whose bootrom needs register writes in front of run_image
+CHIP_RUN_IMAGE_PATCH = ["bl702"]
+
+_chips = {}
+_chips_lock = threading.Lock()
+
+
+class BflbLoadCfg(object):
+    # jlink/openocd/cklink load addresses of a chip, from <chip>/<name>_load_cfg.py
+    def __init__(self, module, prefix):
+        self.shake_hand_addr = getattr(module, prefix + "_shake_hand_addr")
+        self.data_addr = getattr(module, prefix + "_data_addr")
+        self.load_addr = getattr(module, prefix + "_load_addr")
+        self.core_type = getattr(module, prefix + "_core_type")
+        self.set_tif = getattr(module, prefix + "_set_tif")
+        self.run_addr = getattr(module, prefix + "_run_addr")
+
+
+class BflbChip(object):
+    # modules and constants of one chip type, resolved once by get_chip. chip
+    # types without a libs package only get the boot rom constants
+    def __init__(self, chiptype):
+        self.chiptype = chiptype
+        self.boot_header_section = CHIP_BOOT_HEADER_SECTIONS.get(chiptype, "load_boot_header")
+        self.segcnt_offset = CHIP_SEGCNT_OFFSETS.get(self.boot_header_section)
+        self.run_image_predata = None
+        try:
+            self.module = __import__("libs." + chiptype, fromlist=[chiptype])
+        except ImportError:
+            self.module = None
+            return
+        module = self.module
+        self.flash_select_do = module.flash_select_do
+        self.img_create_do = module.img_create_do
+        self.efuse_create_do = module.efuse_create_do
+        self.partition_cfg_do = module.partition_cfg_do
+        self.chiptype_patch = module.chiptype_patch
+        self.bootheader_cfg_keys = module.bootheader_cfg_keys
+        self.efuse_cfg_keys = module.efuse_cfg_keys
+        self.jlink_load_cfg = module.jlink_load_cfg
+        self.openocd_load_cfg = module.openocd_load_cfg
+        self.cklink_load_cfg = module.cklink_load_cfg
+
+        self.bootheader_len = module.bootheader_cfg_keys.bootheader_len
+        self.bootheader_codec = bflb_cfg_codec.compile_cfg_keys(module.bootheader_cfg_keys.bootheader_cfg_keys)
+        self.efuse_codec = bflb_cfg_codec.compile_cfg_keys(module.efuse_cfg_keys.efuse_cfg_keys)
+        self.efuse_mac_slot_offset = module.efuse_cfg_keys.efuse_mac_slot_offset
+        self.partition1_addr = module.partition_cfg_do.partition1_addr
+        self.partition2_addr = module.partition_cfg_do.partition2_addr
+        self.fireware_name = module.partition_cfg_do.fireware_name
+        self.jlink = BflbLoadCfg(module.jlink_load_cfg, "jlink")
+        self.openocd = BflbLoadCfg(module.openocd_load_cfg, "openocd")
+        self.cklink = BflbLoadCfg(module.cklink_load_cfg, "cklink")
+        # segment count follows the image length word in older boot headers
+        for key in ("img_len_cnt", "img_len"):
+            if self.bootheader_codec.has_key(key):
+                self.segcnt_offset = self.bootheader_codec.offset(key)
+                break
+        if chiptype in CHIP_RUN_IMAGE_PATCH:
+            self.run_image_predata = bytes(module.chiptype_patch.img_load_create_predata_before_run_img())
+
+
+def get_chip(chiptype):
+    chip = _chips.get(chiptype)
+    if chip is None:
+        with _chips_lock:
+            chip = _chips.get(chiptype)
+            if chip is None:
+                chip = BflbChip(chiptype)
+                _chips[chiptype] = chip
+    return chip
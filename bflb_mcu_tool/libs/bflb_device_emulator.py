@@ -0,0 +1,490 @@
+# -*- coding: utf-8 -*-
+#  Copyright (C) 2016- BOUFFALO LAB (NANJING) CO., LTD.
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+import os
+import sys
+import tty
+import time
+import lzma
+import struct
+import random
+import select
+import hashlib
+import binascii
+import argparse
+import tempfile
+import threading
+import collections
+
+try:
+    import bflb_path
+except ImportError:
+    from libs import bflb_path
+
+# emulated bootrom + eflash loader behind a linux pty, speaks the same framing
+# as BflbUartPort.if_deal_ack/if_deal_response and com_process_one_cmd:
+#   request:  cmd_id(1) + checksum(1) + len(2, le) + data
+#   ack:      "OK" | "PD" | "FL" + err_code(2, le)
+#   response: "OK" + len(2, le) + data
+
+ACK_OK = b"OK"
+ACK_PENDING = b"PD"
+ERR_CHECKSUM = 0x0103
+ERR_FLASH_WRITE = 0x000C
+ERR_UNKNOWN_CMD = 0x0102
+
+SECTOR_SIZE = 4096
+PAGE_SIZE = 256
+
+
+class BflbDeviceEmulator(object):
+    def __init__(
+        self,
+        baudrate=2000000,
+        latency=0.0,
+        error_rate=0.0,
+        drop_rate=0.0,
+        flash_size=4 * 1024 * 1024,
+        efuse_size=512,
+        page_program_time=0.0007,
+        sector_erase_time=0.03,
+        jedec_id="ef4016",
+        mac_addr="b40ecf000001",
+        seed=None,
+    ):
+        self.baudrate = baudrate
+        # fixed turnaround added to every reply, usb-uart latency timer etc
+        self.latency = latency
+        # probability of a checksum NAK / of no reply at all for data frames
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.page_program_time = page_program_time
+        self.sector_erase_time = sector_erase_time
+        self.flash = bytearray(b"\xff" * flash_size)
+        self.efuse = bytearray(efuse_size)
+        self.jedec_id = bytearray.fromhex(jedec_id)
+        self.mac_addr = bytearray.fromhex(mac_addr)
+        self.bootinfo = bytearray.fromhex("02000000" + "00000000" + "00000000") + self.mac_addr + bytearray(6)
+        self.port = None
+        self.stats = collections.Counter()
+        self._random = random.Random(seed)
+        self._master_fd = None
+        self._slave_fd = None
+        self._running = False
+        self._rx_queue = collections.deque()
+        self._rx_cond = threading.Condition()
+        self._threads = []
+        self._decompressor = None
+        self._decompress_addr = 0
+        # emulated timeline: when the rx line and the device become free
+        self._rx_free = 0.0
+        self._dev_free = 0.0
+
+    def start(self):
+        self._master_fd, self._slave_fd = os.openpty()
+        # keep our own slave fd open so the host can close/reopen the port
+        tty.setraw(self._slave_fd)
+        self.port = os.ttyname(self._slave_fd)
+        self._running = True
+        for target in (self._reader, self._processor):
+            th = threading.Thread(target=target)
+            th.daemon = True
+            th.start()
+            self._threads.append(th)
+        return self.port
+
+    def stop(self):
+        self._running = False
+        with self._rx_cond:
+            self._rx_cond.notify_all()
+        for th in self._threads:
+            th.join(1)
+        for fd in (self._master_fd, self._slave_fd):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def wire_time(self, length):
+        # 8N1, 10 bits per byte
+        return length * 10.0 / self.baudrate
+
+    def _reader(self):
+        while self._running:
+            try:
+                r, w, e = select.select([self._master_fd], [], [], 0.05)
+                if not r:
+                    continue
+                data = os.read(self._master_fd, 65536)
+            except OSError:
+                time.sleep(0.01)
+                continue
+            with self._rx_cond:
+                self._rx_queue.append((time.time(), data))
+                self._rx_cond.notify()
+
+    def _next_chunk(self, timeout):
+        with self._rx_cond:
+            if not self._rx_queue:
+                self._rx_cond.wait(timeout)
+            if not self._rx_queue:
+                return None, None
+            return self._rx_queue.popleft()
+
+    def _processor(self):
+        buf = bytearray(0)
+        arrival = 0.0
+        sync = False
+        while self._running:
+            if len(buf) and buf[0] == 0x55:
+                del buf[: len(buf) - len(buf.lstrip(b"\x55"))]
+                sync = True
+                continue
+            if len(buf) >= 4 and len(buf) >= 4 + (buf[2] | (buf[3] << 8)):
+                length = 4 + (buf[2] | (buf[3] << 8))
+                frame = bytes(buf[:length])
+                del buf[:length]
+                if sync:
+                    sync = False
+                    self.stats["handshake"] += 1
+                    self._send(ACK_OK, arrival)
+                self._handle_frame(frame, arrival)
+                continue
+            stamp, data = self._next_chunk(0.01)
+            if data is None:
+                if sync:
+                    # sync burst finished
+                    sync = False
+                    self.stats["handshake"] += 1
+                    self._send(ACK_OK, time.time())
+                continue
+            arrival = stamp
+            buf += data
+
+    def _schedule(self, arrival, rx_len, process_time):
+        rx_done = max(self._rx_free, arrival) + self.wire_time(rx_len)
+        self._rx_free = rx_done
+        start = max(rx_done, self._dev_free)
+        self._dev_free = start + process_time
+        return self._dev_free
+
+    def _send(self, data, ready_at):
+        send_at = ready_at + self.latency + self.wire_time(len(data))
+        delay = send_at - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        os.write(self._master_fd, data)
+
+    @staticmethod
+    def _nak(err_code):
+        return b"FL" + struct.pack("<H", err_code)
+
+    @staticmethod
+    def _response(data):
+        return ACK_OK + struct.pack("<H", len(data)) + bytes(data)
+
+    def _handle_frame(self, frame, arrival):
+        cmd = frame[0]
+        chk = frame[1]
+        data = frame[4:]
+        self.stats["frames"] += 1
+        self.stats["rx_bytes"] += len(frame)
+        process_time = 0.0
+        # eflash loader commands carry a real checksum, bootrom ones send 0
+        if cmd >= 0x30 and cmd not in (0x50, 0x51):
+            if (sum(frame[2:]) & 0xFF) != chk:
+                self.stats["checksum_errors"] += 1
+                self._send(self._nak(ERR_CHECKSUM), self._schedule(arrival, len(frame), 0))
+                return
+        if cmd in (0x31, 0x3F):
+            if self.drop_rate and self._random.random() < self.drop_rate:
+                self.stats["dropped"] += 1
+                self._schedule(arrival, len(frame), 0)
+                return
+            if self.error_rate and self._random.random() < self.error_rate:
+                self.stats["injected_errors"] += 1
+                self._send(self._nak(ERR_CHECKSUM), self._schedule(arrival, len(frame), 0))
+                return
+        try:
+            reply, process_time = self._dispatch(cmd, data, arrival)
+        except Exception as e:
+            sys.stdout.write("emulator: cmd %02x failed: %s\n" % (cmd, e))
+            reply = self._nak(ERR_UNKNOWN_CMD)
+        if reply is None:
+            return
+        self.stats["tx_bytes"] += len(reply)
+        self._send(reply, self._schedule(arrival, len(frame), process_time))
+
+    def _flash_program(self, addr, data):
+        end = addr + len(data)
+        if self.flash.count(0xFF, addr, end) == len(data):
+            self.flash[addr:end] = data
+        else:
+            # nor flash can only clear bits
+            self.flash[addr:end] = bytes(a & b for a, b in zip(self.flash[addr:end], data))
+        self.stats["flash_written"] += len(data)
+        return (len(data) + PAGE_SIZE - 1) // PAGE_SIZE * self.page_program_time
+
+    def _dispatch(self, cmd, data, arrival):
+        if cmd == 0x10:
+            return self._response(self.bootinfo), 0
+        if cmd == 0x17:
+            # bootrom echoes the (decrypted) segment header
+            return self._response(data), 0
+        if cmd == 0x20:
+            # change rate: host reopens the port before it reads the ack
+            self.baudrate = struct.unpack("<I", data[4:8])[0]
+            time.sleep(0.05)
+            return ACK_OK, 0
+        if cmd == 0x30:
+            start, end = struct.unpack("<II", data[:8])
+            start = start // SECTOR_SIZE * SECTOR_SIZE
+            end = (end // SECTOR_SIZE + 1) * SECTOR_SIZE
+            self.flash[start:end] = b"\xff" * (end - start)
+            erase_time = (end - start) // SECTOR_SIZE * self.sector_erase_time
+            self._erase_pending(arrival, len(data) + 4, erase_time)
+            return ACK_OK, 0
+        if cmd == 0x3C:
+            self.flash[:] = b"\xff" * len(self.flash)
+            self._erase_pending(arrival, 4, len(self.flash) // SECTOR_SIZE * self.sector_erase_time / 16)
+            return ACK_OK, 0
+        if cmd == 0x31:
+            addr = struct.unpack("<I", data[:4])[0]
+            return ACK_OK, self._flash_program(addr, data[4:])
+        if cmd == 0x3F:
+            addr = struct.unpack("<I", data[:4])[0]
+            if addr & 0x80000000:
+                self._decompressor = lzma.LZMADecompressor()
+                self._decompress_addr = addr & 0x7FFFFFFF
+            if self._decompressor is None:
+                return self._nak(ERR_FLASH_WRITE), 0
+            out = self._decompressor.decompress(data[4:])
+            process_time = self._flash_program(self._decompress_addr, out)
+            self._decompress_addr += len(out)
+            return ACK_OK, process_time
+        if cmd == 0x32 or cmd == 0x34:
+            addr, length = struct.unpack("<II", data[:8])
+            self.stats["flash_read"] += length
+            return self._response(self.flash[addr : addr + length]), 0
+        if cmd == 0x3D or cmd == 0x3E:
+            addr, length = struct.unpack("<II", data[:8])
+            sha = hashlib.sha256(self.flash[addr : addr + length]).digest()
+            # reading flash at roughly 40MB/s
+            return self._response(sha), length / 40000000.0
+        if cmd == 0x36:
+            # 3 byte jedec id followed by the 0x80 "id valid" flag
+            return self._response(self.jedec_id[0:3] + bytearray(b"\x80")), 0
+        if cmd == 0x37:
+            return self._response(bytearray(4)), 0
+        if cmd == 0x40 or cmd == 0x80:
+            addr = struct.unpack("<I", data[:4])[0]
+            for i, b in enumerate(data[4:]):
+                self.efuse[addr + i] |= b
+            return ACK_OK, len(data[4:]) * 0.0001
+        if cmd == 0x41 or cmd == 0x81:
+            addr, length = struct.unpack("<II", data[:8])
+            return self._response(self.efuse[addr : addr + length]), 0
+        if cmd == 0x42:
+            crc = struct.pack("<I", binascii.crc32(self.mac_addr) & 0xFFFFFFFF)
+            return self._response(self.mac_addr + crc), 0
+        if cmd == 0x71:
+            return self._response(b""), 0
+        # load boot header/segments, check/run image, reset, set timeout,
+        # memory write, xip start/finish, write check, set para, ...
+        return ACK_OK, 0
+
+    def _erase_pending(self, arrival, rx_len, erase_time):
+        # long erases report "PD" every 0.5s until done, like the real loader
+        ready = self._schedule(arrival, rx_len, 0)
+        done = ready + erase_time
+        while done - time.time() > 0.5:
+            self._send(ACK_PENDING, time.time() + 0.5 - self.latency)
+        self._dev_free = done
+        delay = done - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def benchmark(
+    chipname="bl602",
+    baudrate=2000000,
+    size=1024 * 1024,
+    latency=0.0,
+    error_rate=0.0,
+    window=1,
+    decompress=False,
+    verify=0,
+    drop_rate=0.0,
+):
+    import config as gol
+    from libs import bflb_utils
+    from libs import bflb_eflash_loader
+    from libs import bflb_img_loader
+    from libs import bflb_interface_uart
+
+    chiptype = gol.dict_chip_cmd.get(chipname, chipname)
+    emu = BflbDeviceEmulator(
+        baudrate=baudrate, latency=latency, error_rate=error_rate, drop_rate=drop_rate, seed=0
+    )
+    port = emu.start()
+    results = []
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        loader = bflb_eflash_loader.BflbEflashLoader(chipname, chiptype)
+        loader._bflb_com_device = port
+        loader._bflb_com_speed = baudrate
+        loader._bflb_com_if = bflb_interface_uart.BflbUartPort()
+        loader._bflb_com_img_loader = bflb_img_loader.BflbImgLoader(chiptype, chipname, "uart")
+        loader._flash_write_window = window
+        loader._decompress_write = decompress
+        # half random, half padding: roughly what a whole_img.bin looks like
+        rnd = random.Random(0)
+        data = bytearray(rnd.getrandbits(8) for i in range(size // 2)) + bytearray(b"\xff" * (size - size // 2))
+        img_file = os.path.join(tmp_dir, "bench.bin")
+        with open(img_file, "wb") as fp:
+            fp.write(data)
+
+        def phase(name, length, func, *args):
+            start = time.time()
+            ret = func(*args)
+            cost = time.time() - start
+            if isinstance(ret, tuple):
+                ret = ret[0]
+            results.append((name, ret is not False, cost, length))
+
+        phase("handshake", 0, loader._handshake)
+        phase("flash_load_opt", size, loader.flash_load_opt, img_file, 0x10000, 1, verify, 0)
+        phase("flash_read_main_process", size, loader.flash_read_main_process, 0x10000, size, 0, None)
+        if bytes(emu.flash[0x10000 : 0x10000 + size]) != bytes(data):
+            results.append(("flash content check", False, 0, size))
+        efuse_data = bytearray(rnd.getrandbits(8) for i in range(124)) + bytearray(4)
+        phase(
+            "efuse_load_main_process",
+            len(efuse_data),
+            loader.efuse_load_main_process,
+            None,
+            None,
+            efuse_data,
+            bytearray(b"\xff" * len(efuse_data)),
+            1,
+        )
+        loader._bflb_com_if.if_close()
+    finally:
+        emu.stop()
+        for name in os.listdir(tmp_dir):
+            os.remove(os.path.join(tmp_dir, name))
+        os.rmdir(tmp_dir)
+    bflb_utils.printf("========= emulator benchmark =========")
+    bflb_utils.printf(
+        "chip: %s, baudrate: %d, latency(ms): %.1f, error rate: %.3f, drop rate: %.3f, window: %d, decompress: %s"
+        % (chipname, baudrate, latency * 1000, error_rate, drop_rate, window, decompress)
+    )
+    bflb_utils.printf("%-26s%-8s%12s%14s" % ("phase", "result", "time(ms)", "speed(KB/s)"))
+    for name, ok, cost, length in results:
+        speed = "-"
+        if length and cost > 0:
+            speed = "%.1f" % (length / cost / 1024)
+        bflb_utils.printf("%-26s%-8s%12.1f%14s" % (name, "OK" if ok else "FAIL", cost * 1000, speed))
+    bflb_utils.printf("wire limit(KB/s): %.1f" % (baudrate / 10.0 / 1024))
+    bflb_utils.printf("emulator stats: ", dict(emu.stats))
+    loader.get_cmd_metrics().report()
+    return results
+
+
+def benchmark_window(window, **kwargs):
+    # the same image and line faults written stop-and-wait and with the window
+    from libs import bflb_utils
+
+    rows = []
+    for item in (1, window):
+        results = benchmark(window=item, **kwargs)
+        for name, ok, cost, length in results:
+            if name == "flash_load_opt":
+                # the content check only adds a row when the flash is wrong
+                ok = ok and not [result for result in results if not result[1]]
+                rows.append((item, ok, cost, length))
+    bflb_utils.printf("========= flash write window vs stop-and-wait =========")
+    bflb_utils.printf("%-8s%-8s%12s%14s%10s" % ("window", "result", "time(ms)", "speed(KB/s)", "speedup"))
+    base_cost = rows[0][2]
+    for item, ok, cost, length in rows:
+        bflb_utils.printf(
+            "%-8d%-8s%12.1f%14.1f%9.2fx"
+            % (item, "OK" if ok else "FAIL", cost * 1000, length / cost / 1024, base_cost / cost)
+        )
+    return rows
+
+
+def run(argv):
+    parser = argparse.ArgumentParser(description="bouffalolab uart device emulator")
+    parser.add_argument("--chipname", dest="chipname", default="bl602", help="chip name")
+    parser.add_argument("--baudrate", dest="baudrate", default=2000000, type=int, help="emulated baudrate")
+    parser.add_argument("--latency", dest="latency", default=0.0, type=float, help="reply latency in ms")
+    parser.add_argument("--error_rate", dest="error_rate", default=0.0, type=float, help="write NAK probability")
+    parser.add_argument("--drop_rate", dest="drop_rate", default=0.0, type=float, help="write no reply probability")
+    parser.add_argument("--size", dest="size", default=1024 * 1024, type=int, help="benchmark image size")
+    parser.add_argument("--window", dest="window", default=1, type=int, help="flash write window")
+    parser.add_argument("--compare", dest="compare", action="store_true", help="also run stop-and-wait and compare")
+    parser.add_argument("--decompress", dest="decompress", action="store_true", help="use decompress write")
+    parser.add_argument("--verify", dest="verify", action="store_true", help="read back verify after load")
+    parser.add_argument("--serve", dest="serve", action="store_true", help="only run the emulator")
+    args = parser.parse_args(argv)
+    if args.serve:
+        emu = BflbDeviceEmulator(
+            baudrate=args.baudrate,
+            latency=args.latency / 1000,
+            error_rate=args.error_rate,
+            drop_rate=args.drop_rate,
+        )
+        print("emulator listening on " + emu.start())
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            emu.stop()
+        return
+    if args.compare:
+        benchmark_window(
+            args.window,
+            chipname=args.chipname,
+            baudrate=args.baudrate,
+            size=args.size,
+            latency=args.latency / 1000,
+            error_rate=args.error_rate,
+            decompress=args.decompress,
+            verify=1 if args.verify else 0,
+            drop_rate=args.drop_rate,
+        )
+        return
+    benchmark(
+        args.chipname,
+        args.baudrate,
+        args.size,
+        args.latency / 1000,
+        args.error_rate,
+        args.window,
+        args.decompress,
+        1 if args.verify else 0,
+        args.drop_rate,
+    )
+
+
+if __name__ == "__main__":
+    run(sys.argv[1:])
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+#  Copyright (C) 2016- BOUFFALO LAB (NANJING) CO., LTD.
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+
+import os
+import csv
+import sys
+import time
+import sqlite3
+import argparse
+import tempfile
+import threading
+
+try:
+    import bflb_path
+except ImportError:
+    from libs import bflb_path
+from libs import bflb_utils
+
+CSV_REQUIRED = ["ProductKey", "DeviceName", "DeviceSecret", "ProductSecret", "ProductID"]
+CSV_HEADERS = CSV_REQUIRED + ["Burned"]
+LEDGER_SUFFIX = ".db"
+LEDGER_TIMEOUT = 30
+# the csv is written back at most this often while devices are finished,
+# and always when the list is used up or on --export
+EXPORT_INTERVAL = 10.0
+
+_ledgers = {}
+_ledgers_lock = threading.Lock()
+
+
+class BflbLedgerError(Exception):
+    pass
+
+
+class BflbDeviceLedger(object):
+    # factory info csv kept in a sqlite database next to it (<csv>.db, wal mode).
+    # state is "" (free), "P" (claimed by a running burn) or "Y" (programmed),
+    # burned keeps the csv column as written so other values export unchanged.
+    # the csv is imported again whenever its size or mtime no longer match the
+    # last import/export, rows already claimed or programmed keep their state
+    def __init__(self, csv_file, db_file=None):
+        self._csv_file = os.path.abspath(csv_file)
+        self._db_file = db_file or self._csv_file + LEDGER_SUFFIX
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            self._db_file, timeout=LEDGER_TIMEOUT, isolation_level=None, check_same_thread=False
+        )
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS device (
+                id INTEGER PRIMARY KEY,
+                product_key TEXT NOT NULL,
+                device_name TEXT NOT NULL,
+                device_secret TEXT NOT NULL,
+                product_secret TEXT NOT NULL,
+                product_id TEXT NOT NULL,
+                burned TEXT NOT NULL,
+                state TEXT NOT NULL,
+                claim_pid INTEGER,
+                claim_time REAL
+            );
+            CREATE INDEX IF NOT EXISTS device_state ON device (state, id);
+            CREATE INDEX IF NOT EXISTS device_name ON device (device_name);
+            """
+        )
+
+    @property
+    def csv_file(self):
+        return self._csv_file
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _begin(self):
+        self._db.execute("BEGIN IMMEDIATE")
+
+    def _get_meta(self, key, default=""):
+        row = self._db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def _set_meta(self, key, value):
+        self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def _csv_stamp(self):
+        st = os.stat(self._csv_file)
+        return "%d:%d" % (st.st_size, st.st_mtime_ns)
+
+    @staticmethod
+    def read_csv(csv_file):
+        with open(csv_file, "r") as csvf:
+            reader = csv.DictReader(csvf)
+            fieldnames = reader.fieldnames or []
+            if sorted(fieldnames) not in (sorted(CSV_REQUIRED), sorted(CSV_HEADERS)):
+                raise BflbLedgerError("csv file format error")
+            rows = []
+            for row in reader:
+                if None in row:
+                    raise BflbLedgerError("csv file format error")
+                rows.append(row)
+        return rows
+
+    def _import(self):
+        rows = self.read_csv(self._csv_file)
+        known = {}
+        for item in self._db.execute("SELECT device_name, burned, state FROM device WHERE state != ''"):
+            known[item["device_name"]] = (item["burned"], item["state"])
+        self._db.execute("DELETE FROM device")
+        records = []
+        for row in rows:
+            burned = row.get("Burned") or ""
+            state = burned if burned in ("Y", "P") else ""
+            if state == "" and row["DeviceName"] in known:
+                burned, state = known[row["DeviceName"]]
+            records.append(
+                (
+                    row["ProductKey"] or "",
+                    row["DeviceName"] or "",
+                    row["DeviceSecret"] or "",
+                    row["ProductSecret"] or "",
+                    row["ProductID"] or "",
+                    burned,
+                    state,
+                )
+            )
+        self._db.executemany(
+            "INSERT INTO device (product_key, device_name, device_secret, product_secret, product_id, burned, state)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            records,
+        )
+        self._set_meta("csv_stamp", self._csv_stamp())
+        return len(records)
+
+    def _sync(self, force=False):
+        # called inside a write transaction
+        if force or self._get_meta("csv_stamp") != self._csv_stamp():
+            return self._import()
+        return None
+
+    def _transaction(self, func, *args):
+        with self._lock:
+            self._begin()
+            try:
+                ret = func(*args)
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+            return ret
+
+    def sync(self, force=False):
+        return self._transaction(self._sync, force)
+
+    def _claim(self):
+        self._sync()
+        row = self._db.execute("SELECT * FROM device WHERE state = '' ORDER BY id LIMIT 1").fetchone()
+        if row is None:
+            self._export()
+            return None
+        self._db.execute(
+            "UPDATE device SET burned = 'P', state = 'P', claim_pid = ?, claim_time = ? WHERE id = ?",
+            (os.getpid(), time.time(), row["id"]),
+        )
+        return {
+            "ProductKey": row["product_key"],
+            "DeviceName": row["device_name"],
+            "DeviceSecret": row["device_secret"],
+            "ProductSecret": row["product_secret"],
+            "ProductID": row["product_id"],
+        }
+
+    def claim(self):
+        # take the first free row, the write lock makes concurrent claims
+        # from other threads and processes wait instead of taking the same row
+        return self._transaction(self._claim)
+
+    def _finish(self, device_name, state):
+        rows = self._db.execute(
+            "SELECT id FROM device WHERE device_name = ? AND state = 'P'", (device_name,)
+        ).fetchall()
+        if not rows:
+            return False
+        burned = "Y" if state is True else ""
+        self._db.executemany(
+            "UPDATE device SET burned = ?, state = ?, claim_pid = NULL, claim_time = NULL WHERE id = ?",
+            [(burned, burned, row["id"]) for row in rows],
+        )
+        if time.time() - float(self._get_meta("export_time", "0")) >= EXPORT_INTERVAL:
+            self._export()
+        return True
+
+    def finish(self, device_name, state):
+        # programmed when state is True, otherwise the claim is given back
+        return self._transaction(self._finish, device_name, state)
+
+    def release(self, device_name):
+        return self.finish(device_name, False)
+
+    def _export(self, csv_file=None):
+        out_file = csv_file or self._csv_file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(out_file)), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", newline="") as f:
+                f_csv = csv.writer(f)
+                f_csv.writerow(CSV_HEADERS)
+                f_csv.writerows(
+                    self._db.execute(
+                        "SELECT product_key, device_name, device_secret, product_secret, product_id, burned"
+                        " FROM device ORDER BY id"
+                    )
+                )
+            os.replace(tmp_path, out_file)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        if csv_file is None:
+            self._set_meta("csv_stamp", self._csv_stamp())
+            self._set_meta("export_time", time.time())
+
+    def export(self, csv_file=None):
+        return self._transaction(self._export, csv_file)
+
+    def _reset(self):
+        self._sync()
+        count = self._db.execute(
+            "UPDATE device SET burned = '', state = '', claim_pid = NULL, claim_time = NULL WHERE state = 'P'"
+        ).rowcount
+        self._export()
+        return count
+
+    def reset(self):
+        # give back rows left claimed by a burn that never finished
+        return self._transaction(self._reset)
+
+    def stat(self):
+        with self._lock:
+            ret = {"": 0, "P": 0, "Y": 0}
+            for row in self._db.execute("SELECT state, COUNT(*) FROM device GROUP BY state"):
+                ret[row[0]] = row[1]
+            return ret
+
+
+def get_device_ledger(csv_file):
+    # one connection per csv and process, forked workers open their own
+    key = (os.path.abspath(csv_file), os.getpid())
+    with _ledgers_lock:
+        ledger = _ledgers.get(key)
+        if ledger is None:
+            ledger = BflbDeviceLedger(csv_file)
+            _ledgers[key] = ledger
+        return ledger
+
+
+def run(argv):
+    parser = argparse.ArgumentParser(description="bouffalolab factory info device ledger")
+    parser.add_argument("csv", help="factory info csv file")
+    parser.add_argument("--import", dest="reimport", action="store_true", help="import the csv again")
+    parser.add_argument("--export", dest="export", nargs="?", const="", default=None, help="write the csv")
+    parser.add_argument("--reset", dest="reset", action="store_true", help="free rows left in programming")
+    parser.add_argument("--stat", dest="stat", action="store_true", help="show device counts")
+    args = parser.parse_args(argv)
+    try:
+        ledger = BflbDeviceLedger(args.csv)
+        count = ledger.sync(args.reimport)
+        if count is not None:
+            bflb_utils.printf("import {0} devices".format(count))
+        if args.reset:
+            bflb_utils.printf("reset {0} devices".format(ledger.reset()))
+        if args.export is not None:
+            ledger.export(args.export or None)
+        if args.stat:
+            stat = ledger.stat()
+            bflb_utils.printf("free {0} programming {1} programmed {2}".format(stat[""], stat["P"], stat["Y"]))
+        ledger.close()
+    except (BflbLedgerError, sqlite3.Error, OSError) as e:
+        bflb_utils.printf(e)
+        return False
+    return True
+
+
+if __name__ == "__main__":
+    sys.exit(0 if run(sys.argv[1:]) else 1)
@@ -23,23 +23,16 @@ import os
 import sys
 import re
 import time
+import struct
 import hashlib
 import binascii
 import subprocess
 import traceback
 import shutil
 import lzma
-import csv
 import zipfile
 from importlib import reload
 
-import portalocker
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import padding, hashes, serialization
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.primitives.asymmetric import ec
-from cryptography.hazmat.primitives.asymmetric import padding as asymmetric_padding
-from cryptography.hazmat.primitives.asymmetric.utils import decode_dss_signature, encode_dss_signature
 
 try:
     import bflb_path
@@ -49,19 +42,21 @@ except ImportError:
 import config as gol
 from libs import bflb_version
 from libs import bflb_interface_uart
-from libs import bflb_interface_sdio
-from libs import bflb_interface_jlink
-from libs import bflb_interface_cklink
-from libs import bflb_interface_openocd
 from libs import bflb_efuse_boothd_create
 from libs import bflb_img_loader
 from libs import bflb_flash_select
+from libs import bflb_flash_index
 from libs import bflb_utils
-from libs import bflb_ecdh
 from libs import bflb_img_create
+from libs import bflb_xz_cache
+from libs import bflb_artifact_store
+from libs import bflb_device_ledger
+from libs import bflb_metrics
+from libs import bflb_session
+from libs import bflb_img_layout
+from libs import bflb_chip_registry
 from libs.bflb_utils import app_path, chip_path, open_file, eflash_loader_parser_init, convert_path
 from libs.bflb_configobj import BFConfigParser
-from libs.bflb_private_driver_auth import BflbAuthBase
 
 try:
     import changeconf as cgc
@@ -77,21 +72,16 @@ try:
 except ImportError:
     th_sign = False
 
-try:
-    from PySide2 import QtCore, QtWidgets
+# qt bindings are only picked up when the gui has loaded them already
+if bflb_utils.get_qt_module("QtCore") is not None:
+    TRANSLATOR = bflb_utils.get_qt_module("QtCore").QTranslator()
 
-    qt_sign = True
-    TRANSLATOR = QtCore.QTranslator()
-    trans = QtWidgets.QApplication.translate
-except ImportError:
-    try:
-        from PySide6 import QtCore, QtWidgets
 
-        qt_sign = True
-        TRANSLATOR = QtCore.QTranslator()
-        trans = QtWidgets.QApplication.translate
-    except ImportError:
-        qt_sign = False
+def trans(context, text, disambiguation=None, n=-1):
+    qt_widgets = bflb_utils.get_qt_module("QtWidgets")
+    if qt_widgets is None:
+        return text
+    return qt_widgets.QApplication.translate(context, text, disambiguation, n)
 
 import threading
 
@@ -135,7 +125,9 @@ except ImportError:
 
 
 class BflbEflashLoader(object):
-    def __init__(self, chipname="bl60x", chiptype="bl60x", outdir="img_create_iot"):
+    def __init__(self, chipname="bl60x", chiptype="bl60x", outdir="img_create_iot", session=None):
+        # BflbSession of the job, bound to the thread while the loader runs
+        self._session = session
         self._bflb_auto_download = False
         # img loader class
         self._bflb_com_img_loader = None
@@ -158,6 +150,24 @@ class BflbEflashLoader(object):
         self._need_handshake = True
         # retry limit when checksum error occurred
         self._checksum_err_retry_limit = 2
+        # frames in flight for flash write, 1 means stop-and-wait
+        self._flash_write_window = 1
+        # only erase and write sectors whose sha differs from flash
+        self._delta_write = False
+        self._delta_sector_size = 4096
+        self._delta_group_size = 64 * 4096
+        # on-disk cache of xz payloads for decompress write
+        self._xz_cache = None
+        # flash is known to be all 0xFF, set by chip erase
+        self._flash_chip_erased = False
+        # skip transferring 0xFF chunks that land on erased flash
+        self._skip_erased_data = True
+        # per command latency, bytes and error counters of the current job
+        if session is not None:
+            self._cmd_metrics = session.metrics
+        else:
+            self._cmd_metrics = bflb_metrics.BflbCmdMetrics()
+        self._metrics_file = None
         self._csv_burn_en = False
         self._task_num = None
         self._cpu_reset = False
@@ -223,6 +233,12 @@ class BflbEflashLoader(object):
             "ecdh_get_pk": {"cmd_id": "90", "data_len": "0000", "callback": None},
             "ecdh_challenge": {"cmd_id": "91", "data_len": "0000", "callback": None},
         }
+        # cmd id bytes compiled once from the table above
+        self._com_cmd_ids = {}
+        for name, cmd in self._com_cmds.items():
+            self._com_cmd_ids[name] = bytes(bflb_utils.hexstr_to_bytearray(cmd["cmd_id"]))
+        # reusable frame buffer, grows to the largest frame sent
+        self._com_frame_buf = bytearray(0)
         self._resp_cmds = [
             "flash_read",
             "flash_xip_read",
@@ -238,24 +254,62 @@ class BflbEflashLoader(object):
             "efuse_security_read",
         ]
 
-    def com_process_one_cmd(self, section, cmd_id, data_send):
+    # frame: cmd_id(1) + checksum(1) + len(2, le) + [addr(4, le)] + data
+    # the returned memoryview points into self._com_frame_buf and is only valid
+    # until the next call
+    def com_build_frame(self, cmd_id, data_send, addr=None):
+        data_len = len(data_send)
+        offset = 4
+        if addr is not None:
+            data_len += 4
+            offset = 8
+        frame_len = 4 + data_len
+        if len(self._com_frame_buf) < frame_len:
+            self._com_frame_buf = bytearray(max(frame_len, self._bflb_com_tx_size + 8))
+        buf = self._com_frame_buf
+        view = memoryview(buf)
+        struct.pack_into("<BBH", buf, 0, cmd_id[0], 0, data_len)
+        if addr is not None:
+            struct.pack_into("<I", buf, 4, addr)
+        view[offset:frame_len] = data_send
+        buf[1] = sum(view[2:frame_len]) & 0xFF
+        return view[:frame_len]
+
+    def com_process_one_cmd(self, section, cmd_id, data_send, addr=None, try_cnt=0):
+        # try_cnt is the attempt of the caller's retry loop, every attempt
+        # after the first one is counted as a retry
         data_read = bytearray(0)
-        data_len = bflb_utils.int_to_2bytearray_l(len(data_send))
-        checksum = 0
-        checksum += bflb_utils.bytearray_to_int(data_len[0:1]) + bflb_utils.bytearray_to_int(data_len[1:2])
-        for char in data_send:
-            checksum += char
-        data = cmd_id + bflb_utils.int_to_2bytearray_l(checksum & 0xFF)[0:1] + data_len + data_send
+        sends = 1
+        start_time = time.perf_counter()
+        data = self.com_build_frame(cmd_id, data_send, addr)
         self._bflb_com_if.if_write(data)
         if section in self._resp_cmds:
             res, data_read = self._bflb_com_if.if_deal_response()
             if res != "OK":
+                sends += 1
                 self._bflb_com_if.if_write(data)
                 res, data_read = self._bflb_com_if.if_deal_response()
         else:
             res = self._bflb_com_if.if_deal_ack()
+        self._cmd_metrics.record(
+            "eflash",
+            section,
+            time.perf_counter() - start_time,
+            len(data) * sends,
+            len(data_read) if data_read else 0,
+            res,
+            sends - 1 + (1 if try_cnt else 0),
+        )
         return res, data_read
 
+    def get_cmd_metrics(self):
+        return self._cmd_metrics
+
+    def cmd_metrics_report(self):
+        self._cmd_metrics.report()
+        if self._metrics_file:
+            self._cmd_metrics.save(self._metrics_file, {"port": self._bflb_com_device})
+
     def com_inf_change_rate(self, section, newrate):
         cmd_id = bflb_utils.hexstr_to_bytearray(self._com_cmds.get(section)["cmd_id"])
         cmd_len = bflb_utils.hexstr_to_bytearray(self._com_cmds.get(section)["data_len"])
@@ -335,35 +389,11 @@ class BflbEflashLoader(object):
     @staticmethod
     def save_csv_file(csv_data, csv_file, state):
         if csv_data and csv_file:
-            lock_file = open("lock.txt", "w+")
-            portalocker.lock(lock_file, portalocker.LOCK_EX)
-            with open(csv_file, "r") as csvf:
-                reader = csv.DictReader(csvf)
-                list_csv = []
-                for row in reader:
-                    if row.get("DeviceName", "") == csv_data:
-                        if row.get("Burned", "") == "P":
-                            if state is True:
-                                row["Burned"] = "Y"
-                            else:
-                                row["Burned"] = ""
-                        else:
-                            bflb_utils.printf(csv_data, "status not programing")
-                    list_csv.append(row)
-                with open(csv_file, "w", newline="") as f:
-                    headers = [
-                        "ProductKey",
-                        "DeviceName",
-                        "DeviceSecret",
-                        "ProductSecret",
-                        "ProductID",
-                        "Burned",
-                    ]
-                    f_csv = csv.DictWriter(f, headers)
-                    f_csv.writeheader()
-                    f_csv.writerows(list_csv)
-            lock_file.close()
-            os.remove("lock.txt")
+            try:
+                if not bflb_device_ledger.get_device_ledger(csv_file).finish(csv_data, state):
+                    bflb_utils.printf(csv_data, "status not programing")
+            except Exception as e:
+                bflb_utils.printf(e)
 
     @staticmethod
     def unpack_file_zip(packet_file):
@@ -533,7 +563,7 @@ class BflbEflashLoader(object):
         if os.path.isfile(file) is False:
             efuse_bootheader_path = os.path.join(chip_path, self._chip_name, "efuse_bootheader")
             efuse_bh_cfg = efuse_bootheader_path + "/efuse_bootheader_cfg.conf"
-            sub_module = __import__("libs." + self._chip_type, fromlist=[self._chip_type])
+            chip = bflb_chip_registry.get_chip(self._chip_type)
             section = "BOOTHEADER_GROUP0_CFG"
             with open(efuse_bh_cfg, "r") as fp:
                 data = fp.read()
@@ -544,7 +574,7 @@ class BflbEflashLoader(object):
             elif "BOOTHEADER_GROUP0_CFG" in data:
                 section = "BOOTHEADER_GROUP0_CFG"
             bh_data, tmp = bflb_efuse_boothd_create.update_data_from_cfg(
-                sub_module.bootheader_cfg_keys.bootheader_cfg_keys, efuse_bh_cfg, section
+                chip.bootheader_cfg_keys.bootheader_cfg_keys, efuse_bh_cfg, section
             )
             bh_data = bflb_efuse_boothd_create.bootheader_update_flash_pll_crc(bh_data, self._chip_type)
             with open(file, "wb+") as fp:
@@ -627,11 +657,14 @@ class BflbEflashLoader(object):
                         + bootinfo[24:26]
                     )
                 bflb_utils.printf("========= chip id: ", chipid, " =========")
+                if self._session is not None:
+                    self._session.chipid = chipid
                 time_cost = (time.time() * 1000) - start_time
                 bflb_utils.printf("get bootinfo time cost(ms): ", round(time_cost, 3))
-            if qt_sign and th_sign and QtCore.QThread.currentThread().objectName():
+            qt_core = bflb_utils.get_qt_module("QtCore")
+            if qt_core is not None and th_sign and qt_core.QThread.currentThread().objectName():
                 with mutex:
-                    num = str(QtCore.QThread.currentThread().objectName())
+                    num = str(qt_core.QThread.currentThread().objectName())
                     gol.list_chipid[int(num) - 1] = chipid
                     if chipid is not None:
                         gol.list_chipid_check[int(num) - 1] = chipid
@@ -666,21 +699,21 @@ class BflbEflashLoader(object):
             ret, ptdata2 = self.flash_read_main_process(int(ptaddr2, 16), 0x300, 0, None, callback)
             if ret is False:
                 bflb_utils.printf("read pt 2 data failed")
-            sub_module = __import__("libs." + self._chip_type, fromlist=[self._chip_type])
-            ret1, table_count1, age1 = sub_module.partition_cfg_do.check_pt_data(ptdata1)
+            chip = bflb_chip_registry.get_chip(self._chip_type)
+            ret1, table_count1, age1 = chip.partition_cfg_do.check_pt_data(ptdata1)
             if ret1 is False:
                 if self._chip_type == "bl702" or self._chip_type == "bl702l":
                     ret, ptdata1 = self.flash_read_main_process(0x1000, 0x300, 0, None, callback)
-                    ret1, table_count1, age1 = sub_module.partition_cfg_do.check_pt_data(ptdata1)
+                    ret1, table_count1, age1 = chip.partition_cfg_do.check_pt_data(ptdata1)
                     if ret1 is False:
                         bflb_utils.printf("pt table 1 check failed")
                 else:
                     bflb_utils.printf("pt table 1 check failed")
-            ret2, table_count2, age2 = sub_module.partition_cfg_do.check_pt_data(ptdata2)
+            ret2, table_count2, age2 = chip.partition_cfg_do.check_pt_data(ptdata2)
             if ret2 is False:
                 if self._chip_type == "bl702" or self._chip_type == "bl702l":
                     ret, ptdata2 = self.flash_read_main_process(0x2000, 0x300, 0, None, callback)
-                    ret2, table_count2, age2 = sub_module.partition_cfg_do.check_pt_data(ptdata2)
+                    ret2, table_count2, age2 = chip.partition_cfg_do.check_pt_data(ptdata2)
                     if ret2 is False:
                         bflb_utils.printf("pt table 2 check failed")
                 else:
@@ -728,21 +761,7 @@ class BflbEflashLoader(object):
 
     @staticmethod
     def get_suitable_conf_name(cfg_dir, flash_id):
-        conf_files = []
-        for home, dirs, files in os.walk(cfg_dir):
-            for filename in files:
-                if filename.split("_")[-1] == flash_id + ".conf":
-                    conf_files.append(filename)
-        if len(conf_files) > 1:
-            bflb_utils.printf("flash id duplicate and alternative is: ")
-            for i in range(len(conf_files)):
-                tmp = conf_files[i].split(".")[0]
-                bflb_utils.printf("%d:%s" % (i + 1, tmp))
-            return conf_files[i]
-        elif len(conf_files) == 1:
-            return conf_files[0]
-        else:
-            return ""
+        return bflb_flash_index.get_flash_index().get_suitable_conf_name(cfg_dir, flash_id)
 
     def get_factory_config_info(self, file, output_file):
         version = "ver0.0.1"
@@ -754,125 +773,51 @@ class BflbEflashLoader(object):
             "ProductSecret": "",
             "ProductID": "",
         }
-        lock_file = open("lock.txt", "w+")
-        portalocker.lock(lock_file, portalocker.LOCK_EX)
         try:
-            with open(file, "r") as csv_file:
-                reader = csv.DictReader(csv_file)
-                list_csv = []
-                list_product_secret = []
-                list_product_id = []
-                for row in reader:
-                    if (
-                        "ProductKey" in row
-                        and "DeviceName" in row
-                        and "DeviceSecret" in row
-                        and "ProductSecret" in row
-                        and "ProductID" in row
-                    ):
-                        if "Burned" in row:
-                            if len(row) == 6:
-                                pass
-                            else:
-                                bflb_utils.printf("csv file format error")
-                                self._csv_data = None
-                                self._csv_file = None
-                                return False, None
-                        else:
-                            if len(row) == 5:
-                                pass
-                            else:
-                                bflb_utils.printf("csv file format error")
-                                self._csv_data = None
-                                self._csv_file = None
-                                return False, None
-                    else:
-                        bflb_utils.printf("csv file format error")
-                        self._csv_data = None
-                        self._csv_file = None
-                        return False, None
-                    list_product_secret.append(info_dict["ProductSecret"])
-                    list_product_id.append(info_dict["ProductID"])
-                    if "Burned" not in row:
-                        if csv_mac == "":
-                            burnkey = {"Burned": "P"}
-                            row.update(burnkey)
-                        list_csv.append(row)
-                    elif row.get("Burned", "") != "Y" and row.get("Burned", "") != "P":
-                        if csv_mac == "":
-                            row["Burned"] = "P"
-                        list_csv.append(row)
-                    else:
-                        list_csv.append(row)
-                        continue
-                    if csv_mac == "":
-                        info_dict["ProductKey"] = row.get("ProductKey", "")
-                        csv_mac = info_dict["DeviceName"] = row.get("DeviceName", "")
-                        info_dict["DeviceSecret"] = row.get("DeviceSecret", "")
-                        info_dict["ProductSecret"] = row.get("ProductSecret", "")
-                        info_dict["ProductID"] = row.get("ProductID", "")
-                        if len(set(list_product_secret)) > 1:
-                            print("error: ProductSecret is not the same")
-                            return False, csv_mac
-                        if len(set(list_product_id)) > 1:
-                            print("error: ProductID is not the same")
-                            return False, csv_mac
-                        if re.match(r"^([0-9a-fA-F]{2,2}){6,8}$", csv_mac) is None:
-                            print("error: {} is not a valid mac address".format(csv_mac))
-                            return False, csv_mac
-                        self._csv_data = csv_mac
-                        self._csv_file = file
-                if csv_mac == "":
-                    bflb_utils.printf("all factory info used up")
-                    lock_file.close()
-                    os.remove("lock.txt")
+            ledger = bflb_device_ledger.get_device_ledger(file)
+            row = ledger.claim()
+        except Exception as e:
+            bflb_utils.printf(e)
+            self._csv_data = None
+            self._csv_file = None
+            return False, csv_mac
+        if row is None:
+            bflb_utils.printf("all factory info used up")
+            return False, csv_mac
+        info_dict.update(row)
+        csv_mac = info_dict["DeviceName"]
+        # a row that can not be burned is given back, like the csv that was
+        # never written with "P" for it
+        if re.match(r"^([0-9a-fA-F]{2,2}){6,8}$", csv_mac) is None:
+            print("error: {} is not a valid mac address".format(csv_mac))
+            ledger.release(csv_mac)
+            return False, csv_mac
+        self._csv_data = csv_mac
+        self._csv_file = file
+        try:
+            ret, efusedata = self.efuse_read_main_process(0, 128, self._need_handshake, file=None, security_read=False)
+            if ret is False:
+                ledger.release(csv_mac)
+                return False, csv_mac
+            efusedata = bytearray(efusedata)
+            data_efuse = csv_mac[10:12] + csv_mac[8:10] + csv_mac[6:8] + csv_mac[4:6] + csv_mac[2:4] + csv_mac[0:2]
+            mac_bytearray = bflb_utils.hexstr_to_bytearray(data_efuse)
+            chip = bflb_chip_registry.get_chip(self._chip_type)
+            slot0_addr = chip.efuse_mac_slot_offset["slot0"]
+            slot1_addr = chip.efuse_mac_slot_offset["slot1"]
+            slot2_addr = chip.efuse_mac_slot_offset["slot2"]
+            bflb_utils.printf(mac_bytearray)
+            bflb_utils.printf(efusedata[int(slot0_addr, 10) : int(slot0_addr, 10) + 6])
+            bflb_utils.printf(efusedata[int(slot1_addr, 10) : int(slot1_addr, 10) + 6])
+            bflb_utils.printf(efusedata[int(slot2_addr, 10) : int(slot2_addr, 10) + 6])
+            for slot, slot_addr in (("2", slot2_addr), ("1", slot1_addr), ("0", slot0_addr)):
+                if efusedata[int(slot_addr, 10) : int(slot_addr, 10) + 6] == mac_bytearray:
+                    bflb_utils.printf("DeviceName was already written at efuse mac slot " + slot)
+                    ledger.release(csv_mac)
                     return False, csv_mac
-                else:
-                    ret, efusedata = self.efuse_read_main_process(
-                        0, 128, self._need_handshake, file=None, security_read=False
-                    )
-                    if ret is False:
-                        return False, csv_mac
-                    efusedata = bytearray(efusedata)
-                    data_efuse = (
-                        csv_mac[10:12] + csv_mac[8:10] + csv_mac[6:8] + csv_mac[4:6] + csv_mac[2:4] + csv_mac[0:2]
-                    )
-                    mac_bytearray = bflb_utils.hexstr_to_bytearray(data_efuse)
-                    sub_module = __import__("libs." + self._chip_type, fromlist=[self._chip_type])
-                    slot0_addr = sub_module.efuse_cfg_keys.efuse_mac_slot_offset["slot0"]
-                    slot1_addr = sub_module.efuse_cfg_keys.efuse_mac_slot_offset["slot1"]
-                    slot2_addr = sub_module.efuse_cfg_keys.efuse_mac_slot_offset["slot2"]
-                    bflb_utils.printf(mac_bytearray)
-                    bflb_utils.printf(efusedata[int(slot0_addr, 10) : int(slot0_addr, 10) + 6])
-                    bflb_utils.printf(efusedata[int(slot1_addr, 10) : int(slot1_addr, 10) + 6])
-                    bflb_utils.printf(efusedata[int(slot2_addr, 10) : int(slot2_addr, 10) + 6])
-                    if efusedata[int(slot2_addr, 10) : int(slot2_addr, 10) + 6] == mac_bytearray:
-                        bflb_utils.printf("DeviceName was already written at efuse mac slot 2")
-                        return False, csv_mac
-                    elif efusedata[int(slot1_addr, 10) : int(slot1_addr, 10) + 6] == mac_bytearray:
-                        bflb_utils.printf("DeviceName was already written at efuse mac slot 1")
-                        return False, csv_mac
-                    elif efusedata[int(slot0_addr, 10) : int(slot0_addr, 10) + 6] == mac_bytearray:
-                        bflb_utils.printf("DeviceName was already written at efuse mac slot 0")
-                        return False, csv_mac
-            with open(file, "w", newline="") as f:
-                headers = [
-                    "ProductKey",
-                    "DeviceName",
-                    "DeviceSecret",
-                    "ProductSecret",
-                    "ProductID",
-                    "Burned",
-                ]
-                f_csv = csv.DictWriter(f, headers)
-                f_csv.writeheader()
-                f_csv.writerows(list_csv)
-            lock_file.close()
-            os.remove("lock.txt")
         except Exception as e:
             bflb_utils.printf(e)
-            lock_file.close()
-            os.remove("lock.txt")
+            ledger.release(csv_mac)
             return False, csv_mac
         try:
             data_value = bytearray()
@@ -939,6 +884,11 @@ class BflbEflashLoader(object):
         return True, csv_mac
 
     def get_ecdh_shared_key(self, shakehand=0):
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import ec
+        from cryptography.hazmat.primitives.asymmetric.utils import encode_dss_signature
+        from libs import bflb_ecdh
+
         bflb_utils.printf("========= get ecdh shared key =========")
         # publickey_file = "utils/pem/publickey_uecc.pem"
         if shakehand:
@@ -999,6 +949,8 @@ class BflbEflashLoader(object):
             return False
 
     def ecdh_encrypt_data(self, data):
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
         # 创建 AES-CBC加密器
         cipher = Cipher(algorithms.AES(bytearray.fromhex(self._ecdh_shared_key[0:32])), modes.CBC(bytearray(16)))
         encryptor = cipher.encryptor()
@@ -1007,6 +959,8 @@ class BflbEflashLoader(object):
         return ciphertext
 
     def ecdh_decrypt_data(self, data):
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
         # 创建 AES-CBC解密器
         cipher = Cipher(algorithms.AES(bytearray.fromhex(self._ecdh_shared_key[0:32])), modes.CBC(bytearray(16)))
         decryptor = cipher.decryptor()
@@ -1092,10 +1046,10 @@ class BflbEflashLoader(object):
         if ret is False:
             return False
         efusedata = bytearray(efusedata)
-        sub_module = __import__("libs." + self._chip_type, fromlist=[self._chip_type])
-        slot0_addr = sub_module.efuse_cfg_keys.efuse_mac_slot_offset["slot0"]
-        slot1_addr = sub_module.efuse_cfg_keys.efuse_mac_slot_offset["slot1"]
-        slot2_addr = sub_module.efuse_cfg_keys.efuse_mac_slot_offset["slot2"]
+        chip = bflb_chip_registry.get_chip(self._chip_type)
+        slot0_addr = chip.efuse_mac_slot_offset["slot0"]
+        slot1_addr = chip.efuse_mac_slot_offset["slot1"]
+        slot2_addr = chip.efuse_mac_slot_offset["slot2"]
         if efusedata[int(slot2_addr, 10) : int(slot2_addr, 10) + 6] != zeromac:
             bflb_utils.printf("Efuse get mac at slot 2")
             efuseaddrstr = slot2_addr
@@ -1128,10 +1082,10 @@ class BflbEflashLoader(object):
         if ret is False:
             return False
         efusedata = bytearray(efusedata)
-        sub_module = __import__("libs." + self._chip_type, fromlist=[self._chip_type])
-        slot0_addr = sub_module.efuse_cfg_keys.efuse_mac_slot_offset["slot0"]
-        slot1_addr = sub_module.efuse_cfg_keys.efuse_mac_slot_offset["slot1"]
-        slot2_addr = sub_module.efuse_cfg_keys.efuse_mac_slot_offset["slot2"]
+        chip = bflb_chip_registry.get_chip(self._chip_type)
+        slot0_addr = chip.efuse_mac_slot_offset["slot0"]
+        slot1_addr = chip.efuse_mac_slot_offset["slot1"]
+        slot2_addr = chip.efuse_mac_slot_offset["slot2"]
         if efusedata[int(slot2_addr, 10) : int(slot2_addr, 10) + 8] != zeromac:
             bflb_utils.printf("efuse get mac at slot 2")
             efuseaddrstr = slot2_addr
@@ -1392,10 +1346,10 @@ class BflbEflashLoader(object):
         if ret is False:
             return False
         efusedata = bytearray(efusedata)
-        sub_module = __import__("libs." + self._chip_type, fromlist=[self._chip_type])
-        slot0_addr = sub_module.efuse_cfg_keys.efuse_mac_slot_offset["slot0"]
-        slot1_addr = sub_module.efuse_cfg_keys.efuse_mac_slot_offset["slot1"]
-        slot2_addr = sub_module.efuse_cfg_keys.efuse_mac_slot_offset["slot2"]
+        chip = bflb_chip_registry.get_chip(self._chip_type)
+        slot0_addr = chip.efuse_mac_slot_offset["slot0"]
+        slot1_addr = chip.efuse_mac_slot_offset["slot1"]
+        slot2_addr = chip.efuse_mac_slot_offset["slot2"]
         if efusedata[int(slot0_addr, 10) : int(slot0_addr, 10) + 6] == zeromac:
             bflb_utils.printf("efuse load mac to slot 0")
             efuseaddrstr = slot0_addr
@@ -1444,10 +1398,10 @@ class BflbEflashLoader(object):
         if ret is False:
             return False
         efusedata = bytearray(efusedata)
-        sub_module = __import__("libs." + self._chip_type, fromlist=[self._chip_type])
-        slot0_addr = sub_module.efuse_cfg_keys.efuse_mac_slot_offset["slot0"]
-        slot1_addr = sub_module.efuse_cfg_keys.efuse_mac_slot_offset["slot1"]
-        slot2_addr = sub_module.efuse_cfg_keys.efuse_mac_slot_offset["slot2"]
+        chip = bflb_chip_registry.get_chip(self._chip_type)
+        slot0_addr = chip.efuse_mac_slot_offset["slot0"]
+        slot1_addr = chip.efuse_mac_slot_offset["slot1"]
+        slot2_addr = chip.efuse_mac_slot_offset["slot2"]
         if efusedata[int(slot0_addr, 10) : int(slot0_addr, 10) + 8] == zeromac:
             bflb_utils.printf("efuse load mac to slot 0")
             efuseaddrstr = slot0_addr
@@ -1565,15 +1519,13 @@ class BflbEflashLoader(object):
     ):
         try:
             img_update_efuse_fun = None
+            chip = bflb_chip_registry.get_chip(self._chip_type)
             if self._chip_type == "bl602" or self._chip_type == "bl702" or self._chip_type == "bl702l":
-                sub_module = __import__("libs." + self._chip_type, fromlist=[self._chip_type])
-                img_update_efuse_fun = sub_module.img_create_do.img_update_efuse
+                img_update_efuse_fun = chip.img_create_do.img_update_efuse
             elif self._chip_type == "bl808" or self._chip_type == "bl628":
-                sub_module = __import__("libs." + self._chip_type, fromlist=[self._chip_type])
-                img_update_efuse_fun = sub_module.img_create_do.img_update_efuse_group0
+                img_update_efuse_fun = chip.img_create_do.img_update_efuse_group0
             elif self._chip_type == "bl616" or self._chip_type == "bl616l" or self._chip_type == "bl616d":
-                sub_module = __import__("libs." + self._chip_type, fromlist=[self._chip_type])
-                img_update_efuse_fun = sub_module.img_create_do.img_update_efuse_group0
+                img_update_efuse_fun = chip.img_create_do.img_update_efuse_group0
             else:
                 bflb_utils.printf("unrecognized chiptype")
                 return bytearray(0), bytearray(0)
@@ -1688,7 +1640,8 @@ class BflbEflashLoader(object):
         bflb_utils.printf("========= flash read =========")
         i = 0
         cur_len = 0
-        readdata = bytearray(0)
+        readdata = bytearray(flash_data_len)
+        read_len = 0
         # handshake
         if shakehand:
             bflb_utils.printf(FLASH_LOAD_HANDKE)
@@ -1696,15 +1649,15 @@ class BflbEflashLoader(object):
                 return False, None
         start_time = time.time() * 1000
         log = ""
+        cmd_id = self._com_cmd_ids["flash_read"]
         while i < flash_data_len:
             cur_len = flash_data_len - i
             if cur_len > self._bflb_com_tx_size - 8:
                 cur_len = self._bflb_com_tx_size - 8
-            cmd_id = bflb_utils.hexstr_to_bytearray(self._com_cmds.get("flash_read")["cmd_id"])
-            data_send = bflb_utils.int_to_4bytearray_l(i + start_addr) + bflb_utils.int_to_4bytearray_l(cur_len)
+            data_send = struct.pack("<II", i + start_addr, cur_len)
             try_cnt = 0
             while True:
-                ret, data_read = self.com_process_one_cmd("flash_read", cmd_id, data_send)
+                ret, data_read = self.com_process_one_cmd("flash_read", cmd_id, data_send, try_cnt=try_cnt)
                 if ret.startswith("OK"):
                     break
                 if try_cnt < self._checksum_err_retry_limit:
@@ -1722,7 +1675,9 @@ class BflbEflashLoader(object):
                 log += "\n"
             if callback is not None:
                 callback(i, flash_data_len, "flash")
-            readdata += data_read
+            readdata[read_len : read_len + len(data_read)] = data_read
+            read_len += len(data_read)
+        del readdata[read_len:]
         bflb_utils.printf(log)
         time_cost = (time.time() * 1000) - start_time
         bflb_utils.printf("flash read time cost(ms): ", round(time_cost, 3))
@@ -1745,7 +1700,7 @@ class BflbEflashLoader(object):
         data_send = bflb_utils.int_to_4bytearray_l(start_addr) + bflb_utils.int_to_4bytearray_l(flash_data_len)
         try_cnt = 0
         while True:
-            ret, data_read = self.com_process_one_cmd("flash_readSha", cmd_id, data_send)
+            ret, data_read = self.com_process_one_cmd("flash_readSha", cmd_id, data_send, try_cnt=try_cnt)
             if ret.startswith("OK"):
                 break
             if try_cnt < self._checksum_err_retry_limit:
@@ -1800,7 +1755,7 @@ class BflbEflashLoader(object):
         cmd_id = bflb_utils.hexstr_to_bytearray(self._com_cmds.get("flash_write_check")["cmd_id"])
         try_cnt = 0
         while True:
-            ret, dmy = self.com_process_one_cmd("flash_write_check", cmd_id, bytearray(0))
+            ret, dmy = self.com_process_one_cmd("flash_write_check", cmd_id, bytearray(0), try_cnt=try_cnt)
             if ret.startswith("OK"):
                 break
             if try_cnt < self._checksum_err_retry_limit:
@@ -1830,7 +1785,7 @@ class BflbEflashLoader(object):
         data_send = bflb_utils.int_to_4bytearray_l(start_addr) + bflb_utils.int_to_4bytearray_l(end_addr)
         try_cnt = 0
         while True:
-            ret, dmy = self.com_process_one_cmd("flash_erase", cmd_id, data_send)
+            ret, dmy = self.com_process_one_cmd("flash_erase", cmd_id, data_send, try_cnt=try_cnt)
             if ret.startswith("OK"):
                 break
             elif ret.startswith("PD"):
@@ -1880,7 +1835,7 @@ class BflbEflashLoader(object):
         cmd_id = bflb_utils.hexstr_to_bytearray(self._com_cmds.get("flash_chiperase")["cmd_id"])
         try_cnt = 0
         while True:
-            ret, dmy = self.com_process_one_cmd("flash_chiperase", cmd_id, bytearray(0))
+            ret, dmy = self.com_process_one_cmd("flash_chiperase", cmd_id, bytearray(0), try_cnt=try_cnt)
             if ret.startswith("OK"):
                 break
             elif ret.startswith("PD"):
@@ -1911,6 +1866,7 @@ class BflbEflashLoader(object):
         time_cost = (time.time() * 1000) - start_time
         bflb_utils.printf("chip erase time cost(ms): ", round(time_cost, 3))
         self._bflb_com_if.if_set_rx_timeout(self._default_time_out)
+        self._flash_chip_erased = True
         return True
 
     def flash_loader_cut_flash_bin(self, file, addr, flash1_size):
@@ -2004,7 +1960,7 @@ class BflbEflashLoader(object):
         data_send = bflb_utils.int_to_4bytearray_l(flash_pin) + flash_para
         try_cnt = 0
         while True:
-            ret, dmy = self.com_process_one_cmd("flash_set_para", cmd_id, data_send)
+            ret, dmy = self.com_process_one_cmd("flash_set_para", cmd_id, data_send, try_cnt=try_cnt)
             if ret.startswith("OK"):
                 break
             if try_cnt < self._checksum_err_retry_limit:
@@ -2042,7 +1998,7 @@ class BflbEflashLoader(object):
             data_send = bflb_utils.int_to_4bytearray_l(i + start_addr) + bflb_utils.int_to_4bytearray_l(cur_len)
             try_cnt = 0
             while True:
-                ret, data_read = self.com_process_one_cmd("flash_xip_read", cmd_id, data_send)
+                ret, data_read = self.com_process_one_cmd("flash_xip_read", cmd_id, data_send, try_cnt=try_cnt)
                 if ret.startswith("OK"):
                     break
                 if try_cnt < self._checksum_err_retry_limit:
@@ -2093,7 +2049,7 @@ class BflbEflashLoader(object):
         data_send = bflb_utils.int_to_4bytearray_l(start_addr) + bflb_utils.int_to_4bytearray_l(flash_data_len)
         try_cnt = 0
         while True:
-            ret, data_read = self.com_process_one_cmd("flash_xip_readSha", cmd_id, data_send)
+            ret, data_read = self.com_process_one_cmd("flash_xip_readSha", cmd_id, data_send, try_cnt=try_cnt)
             if ret.startswith("OK"):
                 break
             if try_cnt < self._checksum_err_retry_limit:
@@ -2264,25 +2220,33 @@ class BflbEflashLoader(object):
                         fp = open_file(file, "wb")
                         fp.write(flash_data)
                         fp.close()
-        ret = self.flash_load_main_process(file, start_addr, erase, callback)
+        if self._delta_write and erase == 1:
+            ret = self.flash_load_delta_process(file, start_addr, callback)
+        else:
+            ret = self.flash_load_main_process(file, start_addr, erase, callback)
         if ret is False:
             bflb_utils.printf("flash load failed")
             return ret
         # temp var to store imgage sha-256
         fw_sha256 = ""
-        fp = open_file(file, "rb")
-        flash_data = fp.read()
-        fp.close()
-        flash_data_len = len(flash_data)
+        artifact = bflb_artifact_store.get_artifact_store().lookup(os.path.join(app_path, file))
+        if artifact is not None:
+            flash_data_len = artifact.size
+            fw_sha256 = bytearray(artifact.digest())
+        else:
+            fp = open_file(file, "rb")
+            flash_data = fp.read()
+            fp.close()
+            flash_data_len = len(flash_data)
+            sh = hashlib.sha256()
+            sh.update(flash_data)
+            fw_sha256 = sh.hexdigest()
+            fw_sha256 = bflb_utils.hexstr_to_bytearray(fw_sha256)
+            del sh
         if flash_data_len > (2 * 1024 * 1024):
             # if program file size is greater than 2*1024*1024, xip read sha will use more time
             self._bflb_com_if.if_set_rx_timeout(2.0 * (flash_data_len / (2 * 1024 * 1024) + 1))
-        sh = hashlib.sha256()
-        sh.update(flash_data)
-        fw_sha256 = sh.hexdigest()
-        fw_sha256 = bflb_utils.hexstr_to_bytearray(fw_sha256)
         bflb_utils.printf("sha256 caled by host: ", binascii.hexlify(fw_sha256).decode("utf-8"))
-        del sh
         # xip mode verify
         bflb_utils.printf("xip mode verify")
         ret, read_data = self.flash_xip_read_sha_main_process(start_addr, flash_data_len, 0, None, callback)
@@ -2397,6 +2361,129 @@ class BflbEflashLoader(object):
             ret = self.flash_load_opt(file, start_addr, erase, verify, shakehand, callback)
         return ret
 
+    # compare sector groups by sha, split differing groups down to single sectors
+    def flash_delta_sectors(self, flash_data, start_addr, offset, length, dirty, artifact=None):
+        ret, read_data = self.flash_read_sha_main_process(start_addr + offset, length, 0, None, None)
+        if ret is False:
+            return False
+        digest = None
+        if artifact is not None:
+            if offset == 0 and length == artifact.size:
+                digest = artifact.digest()
+            else:
+                digest = artifact.sector_sha256(offset, length, self._delta_sector_size)
+        if digest is None:
+            digest = hashlib.sha256(flash_data[offset : offset + length]).digest()
+        if read_data == digest:
+            return True
+        if length <= self._delta_sector_size:
+            dirty.append((offset, length))
+            return True
+        half = (length // 2 + self._delta_sector_size - 1) // self._delta_sector_size * self._delta_sector_size
+        if self.flash_delta_sectors(flash_data, start_addr, offset, half, dirty, artifact) is False:
+            return False
+        return self.flash_delta_sectors(flash_data, start_addr, offset + half, length - half, dirty, artifact)
+
+    def flash_load_delta_process(self, file, start_addr, callback=None):
+        if start_addr % self._delta_sector_size != 0:
+            bflb_utils.printf("delta write needs sector aligned address, write whole file")
+            return self.flash_load_main_process(file, start_addr, 1, callback)
+        fp = open_file(file, "rb")
+        flash_data = fp.read()
+        fp.close()
+        flash_data_len = len(flash_data)
+        if flash_data_len == 0:
+            bflb_utils.printf("file size is 0")
+            return False
+        bflb_utils.printf("========= flash delta compare =========")
+        start_time = time.time() * 1000
+        artifact = bflb_artifact_store.get_artifact_store().lookup(os.path.join(app_path, file))
+        dirty = []
+        i = 0
+        while i < flash_data_len:
+            cur_len = flash_data_len - i
+            if cur_len > self._delta_group_size:
+                cur_len = self._delta_group_size
+            if self.flash_delta_sectors(flash_data, start_addr, i, cur_len, dirty, artifact) is False:
+                bflb_utils.printf("delta compare failed, write whole file")
+                return self.flash_load_main_process(file, start_addr, 1, callback)
+            i += cur_len
+        # merge adjacent sectors into runs
+        runs = []
+        for offset, length in dirty:
+            if runs and runs[-1][0] + runs[-1][1] == offset:
+                runs[-1] = (runs[-1][0], runs[-1][1] + length)
+            else:
+                runs.append((offset, length))
+        dirty_len = 0
+        for offset, length in runs:
+            dirty_len += length
+        bflb_utils.printf(
+            "delta sectors: %d/%d, compare time cost(ms): %d"
+            % (
+                dirty_len // self._delta_sector_size + (dirty_len % self._delta_sector_size > 0),
+                (flash_data_len + self._delta_sector_size - 1) // self._delta_sector_size,
+                (time.time() * 1000) - start_time,
+            )
+        )
+        filename, ext = os.path.splitext(file)
+        for offset, length in runs:
+            file_temp = os.path.join(app_path, filename + "_delta_" + self._bflb_com_device.replace("/", "_") + ext)
+            with open(file_temp, "wb") as fp:
+                fp.write(flash_data[offset : offset + length])
+            ret = self.flash_load_main_process(file_temp, start_addr + offset, 1, callback)
+            os.remove(file_temp)
+            if ret is False:
+                return False
+        if callback is not None:
+            callback(flash_data_len, flash_data_len, "APP_WR")
+        return True
+
+    # split data into (offset, length) runs that are not entirely 0xFF at block granularity
+    @staticmethod
+    def flash_data_segments(flash_data, block_size, start=0, end=None):
+        segments = []
+        data_len = len(flash_data) if end is None else end
+        seg_start = None
+        i = start
+        while i < data_len:
+            cur_len = min(block_size, data_len - i)
+            if flash_data.count(0xFF, i, i + cur_len) == cur_len:
+                if seg_start is not None:
+                    segments.append((seg_start, i - seg_start))
+                    seg_start = None
+            elif seg_start is None:
+                seg_start = i
+            i += cur_len
+        if seg_start is not None:
+            segments.append((seg_start, data_len - seg_start))
+        return segments
+
+    # decompress write can not skip inside one xz stream, so erase the whole
+    # range once and send every non 0xFF segment as its own stream
+    def flash_load_segments(self, file, flash_data, start_addr, segments, erase, callback=None):
+        flash_data_len = len(flash_data)
+        if erase == 1:
+            ret = self.flash_erase_main_process(start_addr, start_addr + flash_data_len - 1)
+            if ret is False:
+                return False
+        load_len = 0
+        for offset, length in segments:
+            load_len += length
+        bflb_utils.printf("skip 0xFF data, load %d/%d bytes" % (load_len, flash_data_len))
+        filename, ext = os.path.splitext(file)
+        for offset, length in segments:
+            file_temp = os.path.join(app_path, filename + "_seg_" + self._bflb_com_device.replace("/", "_") + ext)
+            with open(file_temp, "wb") as fp:
+                fp.write(flash_data[offset : offset + length])
+            ret = self.flash_load_main_process(file_temp, start_addr + offset, 0, callback)
+            os.remove(file_temp)
+            if ret is False:
+                return False
+        if callback is not None and flash_data_len > 200:
+            callback(flash_data_len, flash_data_len, "APP_WR")
+        return True
+
     def flash_load_main_process(self, file, start_addr, erase=1, callback=None):
         fp = open_file(file, "rb")
         flash_data = bytearray(fp.read())
@@ -2413,20 +2500,59 @@ class BflbEflashLoader(object):
             return False
         i = 0
         cur_len = 0
+        skip_ff = self._skip_erased_data and (erase == 1 or self._flash_chip_erased)
+        if skip_ff and self._decompress_write and flash_data_len > 4 * 1024:
+            artifact = bflb_artifact_store.get_artifact_store().lookup(os.path.join(app_path, file))
+            if artifact is not None and artifact.sector_size == 4096:
+                # scanned when the image was stored
+                segments = artifact.segments
+            else:
+                # gaps in the region map of a bound image are padding, only scan the populated ranges
+                regions = bflb_img_layout.region_map_segments(os.path.join(app_path, file), flash_data_len, 4096)
+                if regions is None:
+                    regions = [(0, flash_data_len)]
+                segments = []
+                for offset, length in regions:
+                    for seg in self.flash_data_segments(flash_data, 4096, offset, offset + length):
+                        if segments and segments[-1][0] + segments[-1][1] == seg[0]:
+                            segments[-1] = (segments[-1][0], segments[-1][1] + seg[1])
+                        else:
+                            segments.append(seg)
+            if len(segments) != 1 or segments[0] != (0, flash_data_len):
+                return self.flash_load_segments(file, flash_data, start_addr, segments, erase, callback)
+        # compress in background while erase is in flight, lzma releases the gil
+        compress_thread = None
+        compress_result = []
+        if self._decompress_write and flash_data_len > 4 * 1024:
+
+            def compress():
+                if self._session is None:
+                    compress_result.extend(self.flash_load_xz_compress(file, self._xz_cache))
+                    return
+                # the log of the thread belongs to this job
+                with self._session.activate():
+                    compress_result.extend(self.flash_load_xz_compress(file, self._xz_cache))
+
+            compress_thread = threading.Thread(target=compress)
+            compress_thread.daemon = True
+            compress_thread.start()
         if erase == 1:
             if flash_data_len == 0:
                 bflb_utils.printf("file size is 0")
                 return False
             ret = self.flash_erase_main_process(start_addr, start_addr + flash_data_len - 1)
             if ret is False:
+                if compress_thread:
+                    compress_thread.join()
                 return False
         start_time = time.time() * 1000
         log = ""
         decompressor = None
-        if self._decompress_write and flash_data_len > 4 * 1024:
+        if compress_thread:
             decompressor = lzma.LZMADecompressor()
             flash_data_len_origin = flash_data_len
-            ret, flash_data, flash_data_len = self.flash_load_xz_compress(file)
+            compress_thread.join()
+            ret, flash_data, flash_data_len = compress_result
             if ret is False:
                 bflb_utils.printf("flash write data xz failed")
                 self._bflb_com_if.if_set_rx_timeout(self._default_time_out)
@@ -2444,22 +2570,13 @@ class BflbEflashLoader(object):
             self._bflb_com_if.if_set_rx_timeout(rx_timeout / 1000)
             start_addr |= 0x80000000
             cmd_name = "flash_decompress_write"
-            chip_isp_timeout = 2000
-            if self._chip_type == "bl616" or self._chip_type == "bl602":
-                # bl616 has set isp timeout to 10s in bflb_img_loader.py: img_get_bootinfo
-                chip_isp_timeout = 10000
-            # if compress take time > 2.2s, chip timeout, reshakehand
-            if (time.time() * 1000) - start_time > chip_isp_timeout * 1.1:
-                bflb_utils.printf(FLASH_LOAD_HANDKE)
-                if self._handshake() is False:
-                    return False
-            # if compress take time > 1.8s, delay 0.6s make sure chip timeout, and reshakehand
-            # if compress take time <= 1.8s, no need reshakehand
-            elif (time.time() * 1000) - start_time > chip_isp_timeout * 0.9:
-                time.sleep(chip_isp_timeout * 0.001 * 0.3)
+            # the link sat idle while waiting for compress, ask the chip
+            # whether it is still in isp mode instead of guessing from the time
+            if isinstance(self._bflb_com_if, bflb_interface_uart.BflbUartPort) and not self._isp_alive():
                 bflb_utils.printf(FLASH_LOAD_HANDKE)
                 if self._handshake() is False:
                     return False
+                self._bflb_com_if.if_set_rx_timeout(rx_timeout / 1000)
             bflb_utils.printf("decompress flash load ", flash_data_len)
         else:
             cmd_name = "flash_write"
@@ -2483,17 +2600,33 @@ class BflbEflashLoader(object):
                 self._bflb_com_if.if_write(data)
                 ret, data_read_ack = self._bflb_com_if.if_deal_ack(dmy_data=False)
 
+        if (
+            self._flash_write_window > 1
+            and cmd_name == "flash_write"
+            and isinstance(self._bflb_com_if, bflb_interface_uart.BflbUartPort)
+        ):
+            ret = self.flash_write_window_process(flash_data, start_addr, skip_ff, callback)
+            self._bflb_com_if.if_set_rx_timeout(self._default_time_out)
+            if ret is False:
+                return False
+            i = flash_data_len
+        cmd_id = self._com_cmd_ids[cmd_name]
+        flash_data_view = memoryview(flash_data)
         while i < flash_data_len:
             cur_len = flash_data_len - i
             if cur_len > self._bflb_com_tx_size - 8:
                 cur_len = self._bflb_com_tx_size - 8
-            cmd_id = bflb_utils.hexstr_to_bytearray(self._com_cmds.get(cmd_name)["cmd_id"])
-            data_send = bflb_utils.int_to_4bytearray_l(i + start_addr) + flash_data[i : i + cur_len]
+            data_addr = i + start_addr
+            data_send = flash_data_view[i : i + cur_len]
             start_addr &= 0x7FFFFFFF
+            if skip_ff and not decompressor and flash_data.count(0xFF, i, i + cur_len) == cur_len:
+                # erased flash already reads back 0xFF
+                i += cur_len
+                continue
             try_cnt = 0
             last_rx_time_out = self._bflb_com_if.if_get_rx_timeout()
             if self._decompress_write and decompressor:
-                decompress_data = decompressor.decompress(flash_data[i : i + cur_len])
+                decompress_data = decompressor.decompress(data_send)
                 # print(f"decompress_data:{str(len(decompress_data))}")
                 current_rx_timeout = len(decompress_data) / 256 * 0.5 * 2 + 2000
                 current_rx_timeout = round(current_rx_timeout)
@@ -2504,7 +2637,7 @@ class BflbEflashLoader(object):
                     self._bflb_com_if.if_set_rx_timeout(current_rx_timeout / 1000)
                     # last_rx_time_out = current_rx_timeout
             while True:
-                ret, dmy = self.com_process_one_cmd(cmd_name, cmd_id, data_send)
+                ret, dmy = self.com_process_one_cmd(cmd_name, cmd_id, data_send, data_addr, try_cnt)
                 if ret.startswith("OK"):
                     break
                 elif ret.find("FL000c") != -1:
@@ -2520,16 +2653,13 @@ class BflbEflashLoader(object):
                     return False
             i += cur_len
             length = len(str(flash_data_len)) + 1
-            log = (
-                # "load{:>8}/{:<8}[{}%]".format(i, flash_data_len, (i*100)//flash_data_len)
-                "load{0}/{1}[{2}%]".format(
-                    str(i).rjust(length), str(flash_data_len).ljust(length), (i * 100) // flash_data_len
-                )
-            )
-            bflb_utils.printf(log)
+            # "load{:>8}/{:<8}[{}%]".format(i, flash_data_len, (i*100)//flash_data_len)
+            log = ("load%*d/%-*d[%d%%]", length, i, length, flash_data_len, (i * 100) // flash_data_len)
+            bflb_utils.logf(bflb_utils.LOG_INFO, *log)
             if callback is not None and flash_data_len > 200:
                 callback(i, flash_data_len, "APP_WR")
-        bflb_utils.printf(log)
+        if log:
+            bflb_utils.logf(bflb_utils.LOG_INFO, *log)
         if self.flash_write_check_main_process() is False:
             bflb_utils.printf("flash write check failed")
             self._bflb_com_if.if_set_rx_timeout(self._default_time_out)
@@ -2537,10 +2667,84 @@ class BflbEflashLoader(object):
         self._bflb_com_if.if_set_rx_timeout(self._default_time_out)
         time_cost = (time.time() * 1000) - start_time
         bflb_utils.printf("flash load time cost(ms): ", round(time_cost, 3))
+        if time_cost > 0:
+            bflb_utils.printf("flash load speed(KB/s): ", round(flash_data_len / time_cost * 1000 / 1024, 3))
+        return True
+
+    # send flash_write_window frames back to back, then read their acks. acks
+    # carry no sequence number, so a frame the device never answered only shows
+    # up as a missing ack at the end of its window: the acks of the frames
+    # behind it are taken as its own. any failure in a window therefore sends
+    # the whole window again stop-and-wait before the next window goes out
+    def flash_write_window_process(self, flash_data, start_addr, skip_ff=False, callback=None):
+        flash_data_len = len(flash_data)
+        chunk_size = self._bflb_com_tx_size - 8
+        cmd_id = self._com_cmd_ids["flash_write"]
+        flash_data_view = memoryview(flash_data)
+        window = self._flash_write_window
+        bflb_utils.printf("flash write window: ", window)
+        i = 0
+        length = len(str(flash_data_len)) + 1
+        while i < flash_data_len:
+            frames = []
+            next_pos = i
+            while len(frames) < window and next_pos < flash_data_len:
+                cur_len = flash_data_len - next_pos
+                if cur_len > chunk_size:
+                    cur_len = chunk_size
+                if skip_ff and flash_data.count(0xFF, next_pos, next_pos + cur_len) == cur_len:
+                    next_pos += cur_len
+                    continue
+                data_send = flash_data_view[next_pos : next_pos + cur_len]
+                self._bflb_com_if.if_write(self.com_build_frame(cmd_id, data_send, next_pos + start_addr))
+                frames.append((next_pos, cur_len, time.perf_counter()))
+                next_pos += cur_len
+            failed = False
+            for pos, cur_len, send_time in frames:
+                ret = self._bflb_com_if.if_deal_ack()
+                self._cmd_metrics.record(
+                    "eflash", "flash_write", time.perf_counter() - send_time, cur_len + 8, 2, ret, 0
+                )
+                if ret and ret.startswith("OK"):
+                    continue
+                if ret and ret.find("FL000c") != -1:
+                    self.print_error_code("0036")
+                    return False
+                failed = True
+                if not ret or ret == "FL":
+                    # timed out, the device has nothing more to answer
+                    break
+            if failed:
+                bflb_utils.printf("resend window from 0x%08X" % (frames[0][0] + start_addr))
+                self._bflb_com_if.if_clear_buf()
+                for pos, cur_len, send_time in frames:
+                    data_send = flash_data_view[pos : pos + cur_len]
+                    try_cnt = 1
+                    while True:
+                        ret, dmy = self.com_process_one_cmd("flash_write", cmd_id, data_send, pos + start_addr, try_cnt)
+                        if ret.startswith("OK"):
+                            break
+                        elif ret.find("FL000c") != -1 or try_cnt > self._checksum_err_retry_limit:
+                            self.print_error_code("0036")
+                            return False
+                        bflb_utils.printf("retry")
+                        try_cnt += 1
+            i = next_pos
+            bflb_utils.logf(
+                bflb_utils.LOG_INFO,
+                "load%*d/%-*d[%d%%]",
+                length,
+                i,
+                length,
+                flash_data_len,
+                (i * 100) // flash_data_len,
+            )
+            if callback is not None and flash_data_len > 200:
+                callback(i, flash_data_len, "APP_WR")
         return True
 
     @staticmethod
-    def flash_load_xz_compress(file):
+    def flash_load_xz_compress(file, xz_cache=None):
         try:
             xz_filters = [
                 {"id": lzma.FILTER_LZMA2, "dict_size": 32768},
@@ -2548,7 +2752,15 @@ class BflbEflashLoader(object):
             fp = open_file(file, "rb")
             data = bytearray(fp.read())
             fp.close()
-            flash_data = lzma.compress(data, check=lzma.CHECK_CRC32, filters=xz_filters)
+            # prepared once by the server for registered and uploaded images
+            flash_data = bflb_artifact_store.get_artifact_store().get_xz(data, os.path.join(app_path, file))
+            if flash_data is not None:
+                bflb_utils.printf("xz stream from artifact store")
+            elif xz_cache is not None:
+                flash_data = xz_cache.compress(data, xz_filters, lzma.CHECK_CRC32)
+                bflb_utils.printf("xz cache hits: {hits}, misses: {misses}".format(**xz_cache.stats()))
+            else:
+                flash_data = lzma.compress(data, check=lzma.CHECK_CRC32, filters=xz_filters)
             flash_data_len = len(flash_data)
         except Exception as e:
             bflb_utils.printf(e)
@@ -2567,12 +2779,12 @@ class BflbEflashLoader(object):
     def flash_update_para(self, file, jedec_id):
         flash_para = bytearray(0)
         if self.is_conf_exist(jedec_id) is True:
-            sub_module = __import__("libs." + self._chip_type, fromlist=[self._chip_type])
+            chip = bflb_chip_registry.get_chip(self._chip_type)
             if conf_sign:
                 cfg_dir = app_path + "/utils/flash/" + self._chip_name + "/"
             else:
                 cfg_dir = app_path + "/utils/flash/" + self._chip_type + "/"
-            conf_name = sub_module.flash_select_do.get_suitable_file_name(cfg_dir, jedec_id)
+            conf_name = chip.flash_select_do.get_suitable_file_name(cfg_dir, jedec_id)
             (
                 offset,
                 flash_cfg_length,
@@ -2580,12 +2792,26 @@ class BflbEflashLoader(object):
                 flash_crc_offset,
                 crc_offset,
             ) = bflb_flash_select.update_flash_para_from_cfg(
-                sub_module.bootheader_cfg_keys.bootheader_cfg_keys, cfg_dir + conf_name
+                chip.bootheader_cfg_keys.bootheader_cfg_keys, cfg_dir + conf_name
             )
             with open(os.path.join(app_path, file), "wb+") as fp:
                 fp.write(flash_para)
         return flash_para
 
+    def _isp_alive(self):
+        # one flash_read_jid round trip with a short rx timeout, a chip that
+        # left isp mode does not answer and needs a new handshake
+        cmd_id = bflb_utils.hexstr_to_bytearray(self._com_cmds.get("flash_read_jid")["cmd_id"])
+        rx_timeout = self._bflb_com_if.if_get_rx_timeout()
+        self._bflb_com_if.if_set_rx_timeout(0.1)
+        ret, data_read = self.com_process_one_cmd("flash_read_jid", cmd_id, bytearray(0))
+        self._bflb_com_if.if_set_rx_timeout(rx_timeout)
+        if ret.startswith("OK"):
+            return True
+        bflb_utils.printf("chip left isp mode")
+        self._bflb_com_if.if_clear_buf()
+        return False
+
     def _handshake(self):
         isp_sh_time = 0
         if self._chip_type == "bl702" or self._chip_type == "bl702l":
@@ -2696,10 +2922,10 @@ class BflbEflashLoader(object):
 
     def load_firmware_bin(self, file, verify, shakehand=1, callback=None):
         entry_name = ""
-        sub_module = __import__("libs." + self._chip_type, fromlist=[self._chip_type])
-        pt_addr1 = sub_module.partition_cfg_do.partition1_addr
-        pt_addr2 = sub_module.partition_cfg_do.partition2_addr
-        entry_name = sub_module.partition_cfg_do.fireware_name
+        chip = bflb_chip_registry.get_chip(self._chip_type)
+        pt_addr1 = chip.partition1_addr
+        pt_addr2 = chip.partition2_addr
+        entry_name = chip.fireware_name
         ret, fwaddr, max_len = self.get_active_fwbin_addr(pt_addr1, pt_addr2, entry_name, shakehand, callback)
         if ret is False:
             bflb_utils.printf("get active fwbin addr failed")
@@ -2734,8 +2960,8 @@ class BflbEflashLoader(object):
             # eflash_loader.bin has 192 bytes bootheader and seg header
             fw_data = bytearray(imge_fp.read())[192:] + bytearray(0)
             imge_fp.close()
-            sub_module = __import__("libs." + self._chip_type, fromlist=[self._chip_type])
-            load_addr = sub_module.jlink_load_cfg.jlink_load_addr
+            chip = bflb_chip_registry.get_chip(self._chip_type)
+            load_addr = chip.jlink.load_addr
             self._bflb_com_if.if_raw_write(load_addr, fw_data)
             pc = fw_data[4:8]
             pc = bytes([pc[3], pc[2], pc[1], pc[0]])
@@ -2761,8 +2987,8 @@ class BflbEflashLoader(object):
             # eflash_loader.bin has 192 bytes bootheader and seg header
             fw_data = bytearray(imge_fp.read())[192:] + bytearray(0)
             imge_fp.close()
-            sub_module = __import__("libs." + self._chip_type, fromlist=[self._chip_type])
-            load_addr = sub_module.openocd_load_cfg.openocd_load_addr
+            chip = bflb_chip_registry.get_chip(self._chip_type)
+            load_addr = chip.openocd.load_addr
             self._bflb_com_if.if_raw_write(load_addr, fw_data)
             pc = fw_data[4:8]
             pc = bytes([pc[3], pc[2], pc[1], pc[0]])
@@ -2787,8 +3013,8 @@ class BflbEflashLoader(object):
             # eflash_loader.bin has 192 bytes bootheader and seg header
             fw_data = bytearray(imge_fp.read())[192:] + bytearray(0)
             imge_fp.close()
-            sub_module = __import__("libs." + self._chip_type, fromlist=[self._chip_type])
-            load_addr = sub_module.openocd_load_cfg.openocd_load_addr
+            chip = bflb_chip_registry.get_chip(self._chip_type)
+            load_addr = chip.openocd.load_addr
             self._bflb_com_if.if_raw_write(load_addr, fw_data)
             pc = fw_data[4:8]
             pc = bytes([pc[3], pc[2], pc[1], pc[0]])
@@ -2825,6 +3051,7 @@ class BflbEflashLoader(object):
             bflb_utils.printf("load helper bin time cost(ms): ", round(time_cost, 3))
             return ret, bootinfo, res
 
+    @bflb_session.bind_session
     def efuse_flash_loader(
         self,
         args,
@@ -2842,6 +3069,7 @@ class BflbEflashLoader(object):
             bflb_utils.local_log_enable(True)
         bflb_utils.printf("eflash loader version: ", bflb_version.version_text.replace("(", "").replace(")", ""))
         start_time = time.time() * 1000
+        self._cmd_metrics.reset()
         try:
             retry = -1
             update_cutoff_time = True
@@ -2894,6 +3122,7 @@ class BflbEflashLoader(object):
                             self._bflb_com_if.if_close()
                         self.save_csv_file(self._csv_data, self._csv_file, True)
                         bflb_utils.printf("[All Successful]")
+                        self.cmd_metrics_report()
                         bflb_utils.local_log_save("log", self._input_macaddr)
                     return True
                 else:
@@ -2904,6 +3133,7 @@ class BflbEflashLoader(object):
                         break
             bflb_utils.printf("burn return with retry failed")
             self.save_csv_file(self._csv_data, self._csv_file, False)
+            self.cmd_metrics_report()
             bflb_utils.local_log_save("log", self._input_macaddr)
             if self._bflb_com_if is not None:
                 self._bflb_com_if.if_close()
@@ -2914,6 +3144,7 @@ class BflbEflashLoader(object):
             # bflb_utils.printf(e)
             # traceback.print_exc(limit=NUM_ERR, file=sys.stdout)
             self.save_csv_file(self._csv_data, self._csv_file, False)
+            self.cmd_metrics_report()
             bflb_utils.local_log_save("log", self._input_macaddr)
             if self._bflb_com_if is not None:
                 self._bflb_com_if.if_close()
@@ -2948,6 +3179,7 @@ class BflbEflashLoader(object):
     ):
         bflb_utils.printf("========= eflash loader cmd arguments =========")
         # bflb_utils.printf(eflash_loader_cfg)
+        self._flash_chip_erased = False
         config_file = None
         eflash_loader_file = None
         bootinfo = None
@@ -3032,6 +3264,8 @@ class BflbEflashLoader(object):
                     self._skip_len = int(skip_para[1][2:], 16)
                 else:
                     self._skip_len = int(skip_para[1], 10)
+            if args.delta:
+                self._delta_write = True
             if args.key:
                 aeskey = args.key
             if args.iv:
@@ -3139,6 +3373,8 @@ class BflbEflashLoader(object):
                 bflb_utils.local_log_enable(True)
                 if isinstance(macaddr, str):
                     self._input_macaddr = macaddr
+                    if self._session is not None:
+                        self._session.macaddr = macaddr
                 else:
                     self._input_macaddr = ""
             else:
@@ -3190,6 +3426,26 @@ class BflbEflashLoader(object):
             flash_burn_retry = int(cfg.get("LOAD_CFG", "flash_burn_retry"))
         if cfg.has_option("LOAD_CFG", "checksum_err_retry"):
             self._checksum_err_retry_limit = int(cfg.get("LOAD_CFG", "checksum_err_retry"))
+        if cfg.has_option("LOAD_CFG", "flash_write_window"):
+            self._flash_write_window = int(cfg.get("LOAD_CFG", "flash_write_window"))
+        if cfg.has_option("LOAD_CFG", "delta_write") and cfg.get("LOAD_CFG", "delta_write") == "true":
+            self._delta_write = True
+        if cfg.has_option("LOAD_CFG", "skip_erased_data"):
+            self._skip_erased_data = cfg.get("LOAD_CFG", "skip_erased_data") == "true"
+        if cfg.has_option("LOAD_CFG", "xz_cache") and cfg.get("LOAD_CFG", "xz_cache") == "true":
+            xz_cache_dir = None
+            xz_cache_size = None
+            if cfg.has_option("LOAD_CFG", "xz_cache_dir"):
+                xz_cache_dir = convert_path(cfg.get("LOAD_CFG", "xz_cache_dir"))
+            if cfg.has_option("LOAD_CFG", "xz_cache_size"):
+                xz_cache_size = int(cfg.get("LOAD_CFG", "xz_cache_size")) * 1024 * 1024
+            self._xz_cache = bflb_xz_cache.get_xz_cache(xz_cache_dir, xz_cache_size)
+        if cfg.has_option("LOAD_CFG", "metrics_file"):
+            self._metrics_file = convert_path(cfg.get("LOAD_CFG", "metrics_file"))
+        if cfg.has_option("LOAD_CFG", "log_level"):
+            bflb_utils.set_log_level(cfg.get("LOAD_CFG", "log_level"))
+        if cfg.has_option("LOAD_CFG", "local_log_limit"):
+            bflb_utils.local_log_set_limit(cfg.get("LOAD_CFG", "local_log_limit"))
         if cfg.has_option("LOAD_CFG", "chiptype"):
             self._chip_type = cfg.get("LOAD_CFG", "chiptype")
         if cfg.has_option("LOAD_CFG", "cpu_reset_after_load"):
@@ -3238,7 +3494,7 @@ class BflbEflashLoader(object):
         if interface == "uart" or interface == "sdio":
             bflb_utils.printf("========= interface is {} =========".format(interface))
             self._bflb_com_img_loader = bflb_img_loader.BflbImgLoader(
-                self._chip_type, self._chip_name, interface, create_cfg
+                self._chip_type, self._chip_name, interface, create_cfg, self._cmd_metrics, self._session
             )
             self._bflb_com_if = self._bflb_com_img_loader.bflb_boot_if
             if load_speed:
@@ -3270,7 +3526,9 @@ class BflbEflashLoader(object):
                 self._bflb_com_if.if_set_isp_baudrate(isp_mode_speed)
         elif interface == "jlink":
             bflb_utils.printf("========= interface is JLink =========")
-            self._bflb_com_if = bflb_interface_jlink.BflbJLinkPort()
+            from libs import bflb_interface_jlink
+
+            self._bflb_com_if = bflb_interface_jlink.BflbJLinkPort(session=self._session)
             if load_speed:
                 self._bflb_com_speed = load_speed // 1000
                 bflb_utils.printf("jlink speed: %dk" % (self._bflb_com_speed))
@@ -3282,7 +3540,9 @@ class BflbEflashLoader(object):
             self._bflb_boot_speed = self._bflb_com_speed
         elif interface == "openocd":
             bflb_utils.printf("========= interface is Openocd =========")
-            self._bflb_com_if = bflb_interface_openocd.BflbOpenocdPort()
+            from libs import bflb_interface_openocd
+
+            self._bflb_com_if = bflb_interface_openocd.BflbOpenocdPort(session=self._session)
             if load_speed:
                 self._bflb_com_speed = load_speed // 1000
                 bflb_utils.printf("openocd speed: %dk" % (self._bflb_com_speed))
@@ -3294,7 +3554,9 @@ class BflbEflashLoader(object):
             self._bflb_boot_speed = self._bflb_com_speed
         elif interface == "cklink":
             bflb_utils.printf("========= interface is CKLink =========")
-            self._bflb_com_if = bflb_interface_cklink.BflbCKLinkPort()
+            from libs import bflb_interface_cklink
+
+            self._bflb_com_if = bflb_interface_cklink.BflbCKLinkPort(session=self._session)
             if load_speed:
                 self._bflb_com_speed = load_speed // 1000
                 bflb_utils.printf("cklink speed: %dk" % (self._bflb_com_speed))
@@ -4067,6 +4329,9 @@ class BflbEflashLoader(object):
                 if publickey:
                     loadflag = False
                     bflb_utils.printf("write efuse publickey hash")
+                    from cryptography.hazmat.backends import default_backend
+                    from cryptography.hazmat.primitives import serialization
+
                     with open(publickey, "rb") as fp:
                         key = fp.read()
                     public_key = serialization.load_pem_public_key(key, backend=default_backend())
@@ -4191,6 +4456,9 @@ class BflbEflashLoader(object):
                     else:
                         security_write = True
                         # security_write = (cfg.get("EFUSE_CFG", "security_write") == "true")
+                    from cryptography.hazmat.primitives import serialization
+                    from cryptography.hazmat.primitives.asymmetric import padding as asymmetric_padding
+
                     sk = bytearray.fromhex(PRIVATE_KEY_RSA_HEX)
                     privatekey = serialization.load_pem_private_key(sk, password=None)
                     data = []
@@ -4224,9 +4492,9 @@ class BflbEflashLoader(object):
                     cfgfile = os.path.join(chip_path, self._chip_name, self._outdir, "efuse_bootheader_cfg.ini")
                     if os.path.isfile(cfgfile) is False:
                         shutil.copyfile(cfgfile_org, cfgfile)
-                    sub_module = __import__("libs." + self._chip_type, fromlist=[self._chip_type])
+                    chip = bflb_chip_registry.get_chip(self._chip_type)
                     efuse_data, mask = bflb_efuse_boothd_create.update_data_from_cfg(
-                        sub_module.efuse_cfg_keys.efuse_cfg_keys, cfgfile, "EFUSE_CFG"
+                        chip.efuse_cfg_keys.efuse_cfg_keys, cfgfile, "EFUSE_CFG"
                     )
                     if gol.ENABLE_AQARA:
                         security_write = True
@@ -4387,6 +4655,8 @@ class BflbEflashLoader(object):
             with mutex:
                 efuse_data = bytearray(128)
 
+                from libs.bflb_private_driver_auth import BflbAuthBase
+
                 bflb_auth_obj = BflbAuthBase(port_auth, port_dev, rate_uart)
                 if bflb_auth_obj.efuse_load_shakehand():
                     res = bflb_auth_obj.efuse_load_main_process(efuse_data, security_write=True)
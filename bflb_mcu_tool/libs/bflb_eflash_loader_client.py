@@ -136,6 +136,11 @@ def udp_socket_send_client(udp_socket_client, send_address, key=None):
                     sdata += bytearray(16)
                 sdata = create_encrypt_data(sdata, bytearray.fromhex(key), bytearray(16))
         udp_socket_client.sendto(sdata, send_address)
+        if send_data.startswith("status") or send_data.startswith("metrics") or send_data.startswith("register"):
+            # answered with a single datagram
+            recv_data, recv_addr = udp_socket_client.recvfrom(65536)
+            print(recv_data.decode("utf-8", "ignore"))
+            return True
         start_time = time.time()
         while True:
             log = udp_socket_recv_log(udp_socket_client)
@@ -19,8 +19,8 @@
 #  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 #  SOFTWARE.
 
-import re
 import sys
+import json
 import time
 import socket
 import threading
@@ -57,9 +57,7 @@ import inspect
 
 import multiprocessing
 
-list_process = []
-
-from libs.bflb_eflash_loader_worker import eflash_loader_worker
+from libs.bflb_eflash_loader_worker import eflash_loader_worker, BflbEflashLoaderPool
 
 
 def _async_raise(tid, exctype):
@@ -85,15 +83,6 @@ def stop_thread(thread_name):
             _async_raise(thread.ident, SystemExit)
 
 
-def stop_process(process_name):
-    for process in list_process:
-        if process.name == process_name:
-            if process.is_alive():
-                bflb_utils.printf("Kill process {0}".format(process_name))
-                process.terminate()
-            list_process.remove(process)
-
-
 def create_decrypt_data(data_bytearray, key_bytearray, iv_bytearray):
     # 创建 AES-CBC解密器
     cipher = Cipher(algorithms.AES(key_bytearray), modes.CBC(iv_bytearray))
@@ -103,13 +92,39 @@ def create_decrypt_data(data_bytearray, key_bytearray, iv_bytearray):
     return plaintext
 
 
-def eflash_loader_server(socket_server, port, echo, aes_key):
+def register_artifact(socket_server, recv_addr, path):
+    from libs import bflb_artifact_store
+
+    store = bflb_artifact_store.get_artifact_store()
+    try:
+        sha256 = store.register(path)
+        data = {"sha256": sha256, "path": store.get(sha256).path}
+    except Exception as e:
+        bflb_utils.printf(e)
+        data = {"error": str(e)}
+    try:
+        socket_server.sendto(json.dumps(data).encode("utf-8"), recv_addr)
+    except Exception as e:
+        bflb_utils.printf(e)
+
+
+def eflash_loader_server(
+    socket_server, port, echo, aes_key, workers=None, worker_jobs=None, queue_size=None, tcp=False, unix_path=None
+):
+    global ecdh_enable
     ecdh_shared_key = None
     socket_address = ("", port)
     socket_server.bind(socket_address)
     bflb_utils.enable_udp_send_log(echo)
-    count_total = multiprocessing.Value("i", 0)
-    count_success = multiprocessing.Value("i", 0)
+    pool = BflbEflashLoaderPool(workers, worker_jobs, queue_size, echo)
+    bflb_utils.printf("Workers: {0}, queue size: {1}".format(pool.workers, pool.queue_size))
+    job_server = None
+    if tcp or unix_path:
+        # streamed jobs over tcp on the same port number or a unix socket
+        from libs.bflb_eflash_loader_tcp import BflbJobServer
+
+        job_server = BflbJobServer(pool, aes_key, ecdh_enable)
+        job_server.start("", port, unix_path)
     try:
         while True:
             try:
@@ -118,7 +133,6 @@ def eflash_loader_server(socket_server, port, echo, aes_key):
             except Exception as e:
                 bflb_utils.printf(e)
                 continue
-            global ecdh_enable
             if aes_key:
                 try:
                     if len(recv_data) % 16 != 0:
@@ -176,25 +190,42 @@ def eflash_loader_server(socket_server, port, echo, aes_key):
                 )
                 bflb_utils.printf("Stop server successfully")
                 socket_server.close()
+                if job_server is not None:
+                    job_server.close()
+                pool.close()
                 break
-            match = re.search("--port=(\S*)\s", recv_data.decode("utf-8", "ignore"), re.I)
-            if match is not None:
-                name_port = match.group(1)
-            else:
-                name_port = None
-            if name_port:
-                stop_process(name_port)
-                p = multiprocessing.Process(
-                    target=eflash_loader_worker, args=(recv_addr, recv_data, count_total, count_success)
-                )
-                p.name = name_port
-            else:
-                p = multiprocessing.Process(
-                    target=eflash_loader_worker, args=(recv_addr, recv_data, count_total, count_success)
-                )
-            list_process.append(p)
-            p.start()
-            time.sleep(0.001)
+            if recv_data.decode("utf-8", "ignore").startswith("metrics"):
+                # "metrics" answers prometheus text, "metrics json" answers json
+                if recv_data.decode("utf-8", "ignore").strip().endswith("json"):
+                    metrics_data = pool.get_metrics("json")
+                else:
+                    metrics_data = pool.get_metrics()
+                try:
+                    socket_server.sendto(metrics_data.encode("utf-8"), recv_addr)
+                except Exception as e:
+                    bflb_utils.printf(e)
+                continue
+            if recv_data.decode("utf-8", "ignore").startswith("register "):
+                # "register <path>" prepares an image for all workers, answers json
+                threading.Thread(
+                    target=register_artifact,
+                    args=(socket_server, recv_addr, recv_data.decode("utf-8", "ignore")[9:].strip()),
+                ).start()
+                continue
+            if recv_data.decode("utf-8", "ignore").startswith("status"):
+                # queue depth and worker utilization of the pool as json
+                try:
+                    socket_server.sendto(pool.to_json().encode("utf-8"), recv_addr)
+                except Exception as e:
+                    bflb_utils.printf(e)
+                continue
+            if not pool.submit(recv_addr, recv_data):
+                bflb_utils.printf("Job queue is full, request refused")
+                try:
+                    socket_server.sendto(b"Job queue is full\r\n", recv_addr)
+                    socket_server.sendto(b"Finished with fail", recv_addr)
+                except Exception as e:
+                    bflb_utils.printf(e)
     finally:
         return
 
@@ -224,6 +255,11 @@ def usage():
     bflb_utils.printf("--echo         :open local log echo")
     bflb_utils.printf("--ecdh         :open ecdh function")
     bflb_utils.printf("--key=         :aes 128 encrypt")
+    bflb_utils.printf("--workers=     :number of worker processes")
+    bflb_utils.printf("--worker_jobs= :jobs before a worker is recycled")
+    bflb_utils.printf("--queue_size=  :requests waiting for a worker")
+    bflb_utils.printf("--tcp          :also take streamed jobs over tcp")
+    bflb_utils.printf("--unix=        :take streamed jobs on a unix socket")
 
 
 def eflash_loader_server_main():
@@ -231,6 +267,11 @@ def eflash_loader_server_main():
     port = 8080
     echo = False
     aes_key = ""
+    workers = None
+    worker_jobs = None
+    queue_size = None
+    tcp = False
+    unix_path = None
     parser = eflash_loader_parser_init()
     # args = parser.parse_args()
     args, unparsed = parser.parse_known_args()
@@ -252,6 +293,16 @@ def eflash_loader_server_main():
         ecdh_enable = False
     if args.echo:
         echo = True
+    if args.workers:
+        workers = int(args.workers)
+    if args.worker_jobs:
+        worker_jobs = int(args.worker_jobs)
+    if args.queue_size:
+        queue_size = int(args.queue_size)
+    if args.tcp:
+        tcp = True
+    if args.unix:
+        unix_path = args.unix
     if args.usage:
         usage()
         return
@@ -265,7 +316,7 @@ def eflash_loader_server_main():
     #         target=eflash_loader_server, args=(socket_server, port, echo, aes_key)
     #     )
     #     eflash_loader_server_thread.start()
-    eflash_loader_server(socket_server, port, echo, aes_key)
+    eflash_loader_server(socket_server, port, echo, aes_key, workers, worker_jobs, queue_size, tcp, unix_path)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,445 @@
+# -*- coding: utf-8 -*-
+#  Copyright (C) 2016- BOUFFALO LAB (NANJING) CO., LTD.
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+import os
+import sys
+import json
+import base64
+import struct
+import asyncio
+import argparse
+import threading
+import collections
+
+try:
+    import bflb_path
+except ImportError:
+    from libs import bflb_path
+from libs import bflb_utils
+
+# every message is a json object behind a 4 byte big endian length
+FRAME_HEADER = struct.Struct(">I")
+FRAME_MAX_LEN = 64 * 1024 * 1024
+# messages waiting for a slow client, further event batches are dropped
+CLIENT_QUEUE_LIMIT = 256
+# jobs one connection may have waiting or running
+CLIENT_MAX_JOBS = 64
+
+
+class BflbFrameCipher(object):
+    # aes-128-cbc with the --key or ecdh key like the udp requests, frames
+    # are binary safe so each one gets a random iv and pkcs7 padding
+    def __init__(self, key=None):
+        self.key = key
+
+    def seal(self, payload):
+        if self.key is None:
+            return payload
+        from cryptography.hazmat.primitives import padding
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+        iv = os.urandom(16)
+        padder = padding.PKCS7(128).padder()
+        data = padder.update(payload) + padder.finalize()
+        encryptor = Cipher(algorithms.AES(self.key), modes.CBC(iv)).encryptor()
+        return iv + encryptor.update(data) + encryptor.finalize()
+
+    def open(self, data):
+        if self.key is None:
+            return data
+        from cryptography.hazmat.primitives import padding
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+        decryptor = Cipher(algorithms.AES(self.key), modes.CBC(data[0:16])).decryptor()
+        data = decryptor.update(data[16:]) + decryptor.finalize()
+        unpadder = padding.PKCS7(128).unpadder()
+        return unpadder.update(data) + unpadder.finalize()
+
+
+def pack_frame(cipher, message):
+    payload = cipher.seal(json.dumps(message).encode("utf-8"))
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+async def read_frame(reader, cipher):
+    header = await reader.readexactly(FRAME_HEADER.size)
+    length = FRAME_HEADER.unpack(header)[0]
+    if length > FRAME_MAX_LEN:
+        raise ValueError("frame too long: %d" % length)
+    payload = await reader.readexactly(length)
+    return json.loads(cipher.open(payload).decode("utf-8"))
+
+
+def store_artifact(message):
+    # register a path on the server or store uploaded image data
+    from libs import bflb_artifact_store
+
+    store = bflb_artifact_store.get_artifact_store()
+    try:
+        if message["type"] == "register":
+            sha256 = store.register(message["path"])
+        else:
+            sha256 = store.put(base64.b64decode(message["data"]), message.get("name", ""))
+        artifact = store.get(sha256)
+        return {
+            "type": "artifact",
+            "tag": message.get("tag"),
+            "sha256": sha256,
+            "path": artifact.path,
+            "size": artifact.size,
+        }
+    except Exception as e:
+        return {"type": "error", "tag": message.get("tag"), "reason": str(e)}
+
+
+class BflbJobConnection(object):
+    # one client connection. requests are answered in order, job events and
+    # results are pushed from the pool dispatcher thread into a bounded
+    # outgoing queue that a single writer drains at the pace of the client
+    def __init__(self, pool, reader, writer, cipher, loop):
+        self.pool = pool
+        self.reader = reader
+        self.writer = writer
+        self.cipher = cipher
+        self.loop = loop
+        self.jobs = set()
+        self.dropped = 0
+        self._out = collections.deque()
+        self._wakeup = asyncio.Event()
+        self._closed = False
+
+    def notify(self, kind, job_id, data):
+        # called from the pool dispatcher thread
+        try:
+            self.loop.call_soon_threadsafe(self._on_job, kind, job_id, data)
+        except RuntimeError:
+            pass
+
+    def _on_job(self, kind, job_id, data):
+        if kind == "events":
+            if len(self._out) >= CLIENT_QUEUE_LIMIT:
+                # the client does not keep up, drop its log instead of
+                # buffering without limit, the next message carries the count
+                self.dropped += len(data)
+                return
+            self.post({"type": "events", "job": job_id, "events": data})
+        else:
+            self.jobs.discard(job_id)
+            message = {"type": "result", "job": job_id}
+            message.update(data)
+            self.post(message)
+
+    def post(self, message):
+        if self._closed:
+            return
+        self._out.append(message)
+        self._wakeup.set()
+
+    async def send_loop(self):
+        while not self._closed:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self._out:
+                message = self._out.popleft()
+                if self.dropped and message["type"] in ("events", "result"):
+                    message["dropped"] = self.dropped
+                    self.dropped = 0
+                self.writer.write(pack_frame(self.cipher, message))
+                await self.writer.drain()
+
+    def handle(self, message):
+        msg_type = message.get("type")
+        if msg_type == "submit":
+            tag = message.get("tag")
+            if len(self.jobs) >= CLIENT_MAX_JOBS:
+                self.post({"type": "rejected", "tag": tag, "reason": "too many jobs"})
+                return
+            cmd = str(message.get("cmd", "")).strip()
+            job_id = self.pool.submit(None, cmd.encode("utf-8"), self.notify)
+            if job_id is None:
+                self.post({"type": "rejected", "tag": tag, "reason": "queue full"})
+                return
+            self.jobs.add(job_id)
+            self.post({"type": "accepted", "tag": tag, "job": job_id})
+        elif msg_type == "cancel":
+            job_id = message.get("job")
+            if job_id not in self.jobs or not self.pool.cancel(job_id):
+                self.post({"type": "error", "job": job_id, "reason": "unknown job"})
+        elif msg_type in ("register", "upload"):
+            # storing an image compresses and hashes it, keep that off the loop
+            future = self.loop.run_in_executor(None, store_artifact, message)
+            future.add_done_callback(lambda item: self.post(item.result()))
+        elif msg_type == "status":
+            status = self.pool.get_status()
+            status["type"] = "status"
+            self.post(status)
+        elif msg_type == "metrics":
+            self.post({"type": "metrics", "data": self.pool.get_metrics(message.get("format", "prometheus"))})
+        else:
+            self.post({"type": "error", "reason": "unknown request %s" % msg_type})
+
+    async def serve(self):
+        sender = asyncio.ensure_future(self.send_loop())
+        try:
+            while not sender.done():
+                try:
+                    message = await read_frame(self.reader, self.cipher)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except ValueError as e:
+                    bflb_utils.printf("Bad frame: ", e)
+                    break
+                self.handle(message)
+        finally:
+            # jobs of a client that went away are not worth finishing
+            self._closed = True
+            for job_id in list(self.jobs):
+                self.pool.cancel(job_id)
+            sender.cancel()
+            self.writer.close()
+
+
+class BflbJobServer(object):
+    # asyncio tcp or unix socket front end of a BflbEflashLoaderPool. with
+    # ecdh the key exchange is the first frame of a connection and covers all
+    # of its jobs, with aes_key every frame is encrypted with that key
+    def __init__(self, pool, aes_key="", ecdh=False):
+        self.pool = pool
+        self.aes_key = aes_key
+        self.ecdh = ecdh
+        self._loop = None
+        self._stop = None
+        self._thread = None
+        self._ready = threading.Event()
+
+    async def _handle(self, reader, writer):
+        if self.aes_key:
+            cipher = BflbFrameCipher(bytes(bytearray.fromhex(self.aes_key)))
+        else:
+            cipher = BflbFrameCipher()
+        try:
+            if self.ecdh:
+                from libs import bflb_ecdh
+
+                message = await read_frame(reader, cipher)
+                if message.get("type") != "csk":
+                    raise ValueError("ecdh key exchange expected")
+                tmp_ecdh = bflb_ecdh.BflbEcdh()
+                ssk = tmp_ecdh.create_public_key()
+                ecdh_shared_key = tmp_ecdh.create_shared_key(message["key"])
+                writer.write(pack_frame(cipher, {"type": "ssk", "key": ssk}))
+                await writer.drain()
+                cipher = BflbFrameCipher(bytes(bytearray.fromhex(ecdh_shared_key[0:32])))
+        except Exception as e:
+            bflb_utils.printf(e)
+            writer.close()
+            return
+        connection = BflbJobConnection(self.pool, reader, writer, cipher, self._loop)
+        await connection.serve()
+
+    async def _serve(self, host, port, unix_path):
+        self._stop = asyncio.Event()
+        if unix_path:
+            server = await asyncio.start_unix_server(self._handle, unix_path)
+            bflb_utils.printf("Job server listening on ", unix_path)
+        else:
+            server = await asyncio.start_server(self._handle, host, port)
+            bflb_utils.printf("Job server listening on ", port)
+        self._ready.set()
+        await self._stop.wait()
+        server.close()
+        await server.wait_closed()
+
+    def _run(self, host, port, unix_path):
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._loop.run_until_complete(self._serve(host, port, unix_path))
+        except Exception as e:
+            bflb_utils.printf("Job server failed: ", e)
+        finally:
+            self._ready.set()
+            self._loop.close()
+
+    def start(self, host="", port=8080, unix_path=None):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, args=(host, port, unix_path), name="eflash_loader_tcp")
+        self._thread.daemon = True
+        self._thread.start()
+        self._ready.wait()
+
+    def close(self, timeout=5):
+        if self._thread is None or not self._thread.is_alive():
+            return
+        self._loop.call_soon_threadsafe(self._stop.set)
+        self._thread.join(timeout)
+
+
+class BflbJobClient(object):
+    def __init__(self, key=None, ecdh=False):
+        if key:
+            self.cipher = BflbFrameCipher(bytes(bytearray.fromhex(key)))
+        else:
+            self.cipher = BflbFrameCipher()
+        self.ecdh = ecdh
+        self.reader = None
+        self.writer = None
+
+    async def connect(self, host="127.0.0.1", port=8080, unix_path=None):
+        if unix_path:
+            self.reader, self.writer = await asyncio.open_unix_connection(unix_path)
+        else:
+            self.reader, self.writer = await asyncio.open_connection(host, port)
+        if self.ecdh:
+            from libs import bflb_ecdh
+
+            tmp_ecdh = bflb_ecdh.BflbEcdh()
+            await self.send({"type": "csk", "key": tmp_ecdh.create_public_key()})
+            message = await self.receive()
+            if message.get("type") != "ssk":
+                raise ValueError("ecdh key exchange failed")
+            ecdh_shared_key = tmp_ecdh.create_shared_key(message["key"])
+            self.cipher = BflbFrameCipher(bytes(bytearray.fromhex(ecdh_shared_key[0:32])))
+
+    async def send(self, message):
+        self.writer.write(pack_frame(self.cipher, message))
+        await self.writer.drain()
+
+    async def receive(self):
+        return await read_frame(self.reader, self.cipher)
+
+    async def request(self, message, reply_type):
+        await self.send(message)
+        while True:
+            reply = await self.receive()
+            if reply.get("type") in (reply_type, "error"):
+                return reply
+
+    async def run_job(self, cmd, on_event=None):
+        # submit one job and wait for its result, events go to on_event
+        await self.send({"type": "submit", "tag": 0, "cmd": cmd})
+        job_id = None
+        while True:
+            message = await self.receive()
+            msg_type = message.get("type")
+            if msg_type == "rejected":
+                return message
+            if msg_type == "accepted":
+                job_id = message["job"]
+            elif message.get("job") != job_id:
+                continue
+            elif msg_type == "events" and on_event is not None:
+                for event in message["events"]:
+                    on_event(event)
+            elif msg_type in ("result", "error"):
+                return message
+
+    async def register(self, path):
+        # the path is read by the server, the reply has the sha-256
+        return await self.request({"type": "register", "path": path}, "artifact")
+
+    async def upload(self, data, name=""):
+        # the reply path is where the server keeps the image, use it in --file
+        message = {"type": "upload", "name": name, "data": base64.b64encode(data).decode("ascii")}
+        return await self.request(message, "artifact")
+
+    async def cancel(self, job_id):
+        await self.send({"type": "cancel", "job": job_id})
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def print_event(event):
+    if event["kind"] == "log":
+        print(event["msg"])
+    else:
+        print("%s %d/%d" % (event["stage"], event["current"], event["total"]))
+
+
+async def client_main(args):
+    client = BflbJobClient(args.key, args.ecdh)
+    await client.connect(args.host, args.port, args.unix)
+    try:
+        if args.status:
+            status = await client.request({"type": "status"}, "status")
+            print(json.dumps(status, indent=1))
+            return True
+        if args.register or args.upload:
+            if args.register:
+                reply = await client.register(args.register)
+            else:
+                with open(args.upload, "rb") as fp:
+                    reply = await client.upload(fp.read(), os.path.basename(args.upload))
+            if reply.get("type") != "artifact":
+                print("Store image failed: ", reply.get("reason"))
+                return False
+            print("%s %d %s" % (reply["sha256"], reply["size"], reply["path"]))
+            return True
+        if args.metrics:
+            fmt = "json" if args.json else "prometheus"
+            reply = await client.request({"type": "metrics", "format": fmt}, "metrics")
+            print(reply.get("data", reply))
+            return True
+        cmd = args.cmd
+        if cmd and cmd[0] == "--":
+            cmd = cmd[1:]
+        result = await client.run_job(" ".join(cmd), print_event)
+        if result.get("type") != "result":
+            print("Job not run: ", result.get("reason"))
+            return False
+        if result.get("dropped"):
+            print("%d events dropped" % result["dropped"])
+        if result["success"]:
+            print("Program succeeded, time cost(s): %.3f" % result["cost"])
+        else:
+            print("Program failed: %s" % result["error"])
+        return result["success"]
+    finally:
+        client.close()
+
+
+def run(argv):
+    parser = argparse.ArgumentParser(description="bouffalolab eflash loader tcp client")
+    parser.add_argument("--host", dest="host", default="127.0.0.1", help="server address")
+    parser.add_argument("-p", "--port", dest="port", type=int, default=8080, help="server tcp port")
+    parser.add_argument("--unix", dest="unix", help="server unix socket path")
+    parser.add_argument("--key", dest="key", help="aes key for socket")
+    parser.add_argument("--ecdh", dest="ecdh", action="store_true", help="open ecdh function")
+    parser.add_argument("--status", dest="status", action="store_true", help="show worker pool status")
+    parser.add_argument("--metrics", dest="metrics", action="store_true", help="show command metrics")
+    parser.add_argument("--json", dest="json", action="store_true", help="metrics as json")
+    parser.add_argument("--register", dest="register", help="image path on the server to prepare")
+    parser.add_argument("--upload", dest="upload", help="local image to upload and prepare")
+    parser.add_argument("cmd", nargs=argparse.REMAINDER, help="-- followed by the eflash loader command line")
+    args = parser.parse_args(argv)
+    if args.key and args.ecdh:
+        print("key and ecdh can only set one")
+        return False
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(client_main(args))
+    finally:
+        loop.close()
+
+
+if __name__ == "__main__":
+    sys.exit(0 if run(sys.argv[1:]) else 1)
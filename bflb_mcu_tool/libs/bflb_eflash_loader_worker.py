@@ -19,12 +19,17 @@
 #  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 #  SOFTWARE.
 
+import os
 import re
 import sys
 import time
+import json
+import queue
 import socket
 import threading
-import binascii
+import collections
+import multiprocessing
+import multiprocessing.connection
 
 try:
     import bflb_path
@@ -33,48 +38,510 @@ except ImportError:
 import config as gol
 from libs import bflb_eflash_loader
 from libs import bflb_version
-from libs import bflb_ecdh
 from libs import bflb_utils
+from libs import bflb_metrics
+from libs import bflb_session
 from libs.bflb_utils import eflash_loader_parser_init
 
+# workers are recycled after this many jobs so that state left behind by a
+# job (module globals, open handles, memory) does not pile up
+WORKER_MAX_JOBS = 50
+# requests waiting for a worker, further requests are refused
+JOB_QUEUE_SIZE = 64
+# streamed jobs send their log and progress at most this often (seconds)
+EVENT_INTERVAL = 0.2
+# workers are checked for a crash at least this often (seconds)
+WORKER_CHECK_INTERVAL = 0.5
+# a cancelled job that has not stopped after this long is terminated (seconds)
+CANCEL_TIMEOUT = 10
 
-def eflash_loader_worker(client_addr, client_data, count_total, count_success):
-    with count_total.get_lock():
-        count_total.value += 1
-    bflb_utils.enable_udp_send_log(True)
+
+def get_request_port(request):
+    match = re.search(r"--port=(\S+)", request.decode("utf-8", "ignore"), re.I)
+    if match is not None:
+        return match.group(1)
+    return None
+
+
+def send_result(client_addr, ret):
+    udp_socket_result = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        if ret is True:
+            udp_socket_result.sendto(b"Finished with success", client_addr)
+        else:
+            udp_socket_result.sendto(b"Finished with fail", client_addr)
+    finally:
+        udp_socket_result.close()
+
+
+class BflbResultPipe(object):
+    # worker end of the result pipe, shared by the job and its event batcher
+    def __init__(self, conn):
+        self._conn = conn
+        self._lock = threading.Lock()
+
+    def put(self, item):
+        with self._lock:
+            self._conn.send(item)
+
+
+def watch_cancel(cancel_event, session, done):
+    # stops the job of session once the pool sets cancel_event
+    while not done.is_set():
+        if cancel_event.wait(0.1):
+            bflb_utils.printf("Job cancelled")
+            session.cancel()
+            return
+
+
+class BflbEventBatcher(object):
+    # collects the log lines and progress callbacks of a streamed job and
+    # hands them to the server in batches, only the last progress of each
+    # stage inside an interval is kept
+    def __init__(self, result_queue, index, job_id, interval=EVENT_INTERVAL):
+        self._result_queue = result_queue
+        self._index = index
+        self._job_id = job_id
+        self._lock = threading.Lock()
+        self._events = []
+        self._progress = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(interval,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def log(self, msg):
+        with self._lock:
+            self._events.append({"kind": "log", "time": time.time(), "msg": msg})
+
+    def progress(self, current, total, stage="", *args):
+        with self._lock:
+            self._progress[str(stage)] = {
+                "kind": "progress",
+                "time": time.time(),
+                "stage": str(stage),
+                "current": current,
+                "total": total,
+            }
+
+    def flush(self):
+        with self._lock:
+            events = self._events + list(self._progress.values())
+            self._events = []
+            self._progress = {}
+        if events:
+            self._result_queue.put(("events", self._index, self._job_id, events))
+
+    def _run(self, interval):
+        while not self._stop.wait(interval):
+            self.flush()
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self.flush()
+
+
+def eflash_loader_run_job(client_addr, client_data, parser=None, callback=None, listener=None, cancel_event=None):
+    # run one request in the calling thread, returns (ret, metrics dict). the
+    # result goes to client_addr over udp when it is set. the job has its own
+    # BflbSession, so requests for different ports can run on threads of one
+    # process. setting cancel_event stops the job at its next transfer
     tid = threading.get_ident()
     request = client_data.decode("utf-8")
     bflb_utils.printf("Worker ID: {0} deal request: {1}".format(tid, request))
-    bflb_utils.add_udp_client(str(tid), client_addr)
+    session = bflb_session.BflbSession(str(tid), listener, client_addr)
     ret = False
-    try:
-        parser = eflash_loader_parser_init()
-        args = parser.parse_args(request.split(" "))
-        eflash_loader_t = bflb_eflash_loader.BflbEflashLoader(args.chipname, gol.dict_chip_cmd[args.chipname])
-        ret = eflash_loader_t.efuse_flash_loader(args, None, None)
-    finally:
-        udp_socket_result = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        bflb_utils.remove_udp_client(str(tid))
-        if ret is True:
-            udp_socket_result.sendto(
-                bytearray.fromhex(binascii.hexlify(b"Finished with success").decode("utf-8")),
-                client_addr,
+    metrics = None
+    done = threading.Event()
+    if cancel_event is not None:
+        watcher = threading.Thread(target=watch_cancel, args=(cancel_event, session, done))
+        watcher.daemon = True
+        watcher.start()
+    with session.activate():
+        try:
+            if parser is None:
+                parser = eflash_loader_parser_init()
+            args = parser.parse_args(request.split(" "))
+            eflash_loader_t = bflb_eflash_loader.BflbEflashLoader(
+                args.chipname, gol.dict_chip_cmd[args.chipname], session=session
             )
-            bflb_utils.printf("Worker ID: {} finished with success".format(tid))
-            udp_socket_result.close()
+            ret = eflash_loader_t.efuse_flash_loader(args, None, None, callback)
+            metrics = session.metrics.to_dict()
             del eflash_loader_t
-            with count_success.get_lock():
-                count_success.value += 1
-            bflb_utils.printf("State: {0}/{1}".format(count_success.value, count_total.value))
-            return True
-        else:
-            udp_socket_result.sendto(
-                bytearray.fromhex(binascii.hexlify(b"Finished with fail").decode("utf-8")),
-                client_addr,
+        except (Exception, SystemExit) as e:
+            # argparse exits on a bad request, that must not take the worker down
+            bflb_utils.printf("Worker ID: {0} request failed: {1}".format(tid, e))
+            ret = False
+    done.set()
+    if client_addr is not None:
+        send_result(client_addr, ret)
+    if ret is True:
+        bflb_utils.printf("Worker ID: {} finished with success".format(tid))
+    else:
+        bflb_utils.printf("Worker ID: {} finished unsuccessfully".format(tid))
+    return ret, metrics
+
+
+def eflash_loader_worker(client_addr, client_data, count_total, count_success):
+    with count_total.get_lock():
+        count_total.value += 1
+    bflb_utils.enable_udp_send_log(True)
+    ret, metrics = eflash_loader_run_job(client_addr, client_data)
+    if ret is True:
+        with count_success.get_lock():
+            count_success.value += 1
+    bflb_utils.printf("State: {0}/{1}".format(count_success.value, count_total.value))
+    return ret is True
+
+
+def eflash_loader_worker_loop(index, job_queue, result_conn, cancel_event, echo, server_pid=None):
+    # body of a pooled worker process, the loader stack is already imported
+    # (forked from the server or imported once when spawned) and the argument
+    # parser is built once for all jobs of this worker
+    bflb_utils.enable_udp_send_log(echo)
+    parser = eflash_loader_parser_init()
+    result_queue = BflbResultPipe(result_conn)
+    while True:
+        try:
+            item = job_queue.get(timeout=1)
+        except queue.Empty:
+            # do not outlive a server that was killed
+            if server_pid is not None and os.getppid() != server_pid:
+                break
+            continue
+        if item is None:
+            break
+        job_id, client_addr, client_data, stream = item
+        start_time = time.time()
+        batcher = None
+        callback = None
+        listener = None
+        if stream:
+            batcher = BflbEventBatcher(result_queue, index, job_id)
+            callback = batcher.progress
+            listener = batcher.log
+        try:
+            ret, metrics = eflash_loader_run_job(client_addr, client_data, parser, callback, listener, cancel_event)
+        except Exception as e:
+            bflb_utils.printf(e)
+            ret, metrics = False, None
+        if batcher is not None:
+            batcher.close()
+        # the loader answers True or an error code message
+        error = None
+        if ret is not True:
+            error = ret if isinstance(ret, str) else "request failed"
+        result_queue.put(("done", index, job_id, (ret is True, error, metrics, time.time() - start_time)))
+
+
+class BflbPoolWorker(object):
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.job_queue = None
+        self.result_conn = None
+        self.cancel_event = None
+        self.cancel_deadline = None
+        self.job = None
+        self.jobs = 0
+        self.busy_start = 0
+        self.busy_time = 0.0
+
+
+class BflbEflashLoaderPool(object):
+    # fixed set of warm worker processes fed from a bounded queue. a port is
+    # only ever driven by one worker at a time, requests for a busy port wait
+    # behind it, and a port goes back to the worker that served it last when
+    # that worker is idle. every worker answers on a pipe of its own, so a
+    # worker that has to be terminated cannot break the results of the others
+    def __init__(self, workers=None, max_jobs=None, queue_size=None, echo=False):
+        if not workers:
+            workers = multiprocessing.cpu_count()
+        if max_jobs is None:
+            max_jobs = WORKER_MAX_JOBS
+        if queue_size is None:
+            queue_size = JOB_QUEUE_SIZE
+        self.workers = workers
+        self.max_jobs = max_jobs
+        self.queue_size = queue_size
+        self.echo = echo
+        self.start_time = time.time()
+        self.jobs_total = 0
+        self.jobs_success = 0
+        self.jobs_refused = 0
+        self.jobs_cancelled = 0
+        self.recycled = 0
+        self.metrics = bflb_metrics.BflbCmdMetrics()
+        self._job_id = 0
+        self._lock = threading.Lock()
+        self._pending = collections.deque()
+        self._busy_ports = {}
+        self._port_owner = {}
+        self._retired = []
+        self._workers = [BflbPoolWorker(i) for i in range(workers)]
+        self._running = True
+        for worker in self._workers:
+            self._start_worker(worker)
+        self._dispatcher = threading.Thread(target=self._dispatch, name="eflash_loader_pool")
+        self._dispatcher.daemon = True
+        self._dispatcher.start()
+
+    def _start_worker(self, worker):
+        worker.job_queue = multiprocessing.Queue()
+        worker.cancel_event = multiprocessing.Event()
+        worker.cancel_deadline = None
+        worker.job = None
+        worker.jobs = 0
+        result_conn, worker_conn = multiprocessing.Pipe(duplex=False)
+        worker.process = multiprocessing.Process(
+            target=eflash_loader_worker_loop,
+            args=(worker.index, worker.job_queue, worker_conn, worker.cancel_event, self.echo, os.getpid()),
+            name="eflash_loader_worker_%d" % worker.index,
+        )
+        worker.process.daemon = True
+        worker.process.start()
+        # only the worker writes, the pipe reads eof once it is gone
+        worker_conn.close()
+        worker.result_conn = result_conn
+
+    def _recycle_worker(self, worker):
+        # the old process finishes on its own, a fresh one takes its slot now
+        worker.job_queue.put(None)
+        self._retired.append(worker.process)
+        self.recycled += 1
+        self._start_worker(worker)
+
+    def submit(self, client_addr, client_data, listener=None):
+        # returns the job id, or None when the queue is full and the request
+        # is refused. without a listener the job logs and answers over udp to
+        # client_addr, with one its events and result are streamed to
+        # listener(kind, job_id, data), called from the dispatcher thread
+        with self._lock:
+            if len(self._pending) >= self.queue_size:
+                self.jobs_refused += 1
+                return None
+            self._job_id += 1
+            job = (self._job_id, get_request_port(client_data), client_addr, client_data, listener)
+            self._pending.append(job)
+            self._schedule()
+            return job[0]
+
+    def cancel(self, job_id):
+        # a waiting job is dropped, a running one is asked to stop and reports
+        # its result when it has. its worker is only terminated when the job
+        # does not stop within CANCEL_TIMEOUT
+        with self._lock:
+            for job in self._pending:
+                if job[0] == job_id:
+                    self._pending.remove(job)
+                    self.jobs_cancelled += 1
+                    self._report(job, False, "cancelled", None, 0, True)
+                    return True
+            for worker in self._workers:
+                if worker.job is not None and worker.job[0] == job_id:
+                    if worker.cancel_deadline is None:
+                        bflb_utils.printf("Cancel job {0} on worker {1}".format(job_id, worker.index))
+                        worker.cancel_deadline = time.time() + CANCEL_TIMEOUT
+                        worker.cancel_event.set()
+                        self.jobs_cancelled += 1
+                    return True
+        return False
+
+    def _schedule(self):
+        # called with the lock held
+        idle = [worker for worker in self._workers if worker.job is None]
+        if not idle or not self._pending:
+            return
+        waiting = collections.deque()
+        while self._pending and idle:
+            job = self._pending.popleft()
+            port = job[1]
+            if port is not None and port in self._busy_ports:
+                waiting.append(job)
+                continue
+            worker = idle[0]
+            owner = self._port_owner.get(port)
+            for item in idle:
+                if item.index == owner:
+                    worker = item
+                    break
+            idle.remove(worker)
+            if port is not None:
+                self._busy_ports[port] = worker.index
+                self._port_owner[port] = worker.index
+            worker.job = job
+            worker.busy_start = time.time()
+            worker.cancel_event.clear()
+            worker.job_queue.put((job[0], job[2], job[3], job[4] is not None))
+        waiting.extend(self._pending)
+        self._pending = waiting
+
+    def _report(self, job, ret, error, metrics, cost, cancelled=False):
+        # called with the lock held
+        if job[4] is not None:
+            job[4](
+                "result",
+                job[0],
+                {"success": ret, "error": error, "cancelled": cancelled, "cost": round(cost, 3), "metrics": metrics},
             )
-            bflb_utils.printf("Worker ID: {} finished unsuccessfully".format(tid))
-            udp_socket_result.close()
-            del eflash_loader_t
-            bflb_utils.printf("State: {0}/{1}".format(count_success.value, count_total.value))
 
-            return False
+    def _finish_job(self, worker, ret, error=None, metrics=None, cancelled=False):
+        # called with the lock held
+        job = worker.job
+        if worker.cancel_deadline is not None:
+            worker.cancel_deadline = None
+            ret, error, cancelled = False, "cancelled", True
+        cost = time.time() - worker.busy_start
+        if job[1] is not None:
+            self._busy_ports.pop(job[1], None)
+        worker.busy_time += cost
+        worker.job = None
+        worker.jobs += 1
+        self.jobs_total += 1
+        if ret:
+            self.jobs_success += 1
+        bflb_utils.printf("State: {0}/{1}".format(self.jobs_success, self.jobs_total))
+        self._report(job, ret, error, metrics, cost, cancelled)
+
+    def _check_workers(self):
+        # called with the lock held, replaces workers that died under a job
+        # and terminates the ones whose cancelled job did not stop in time
+        for worker in self._workers:
+            if worker.process.is_alive():
+                if worker.cancel_deadline is None or time.time() < worker.cancel_deadline:
+                    continue
+                bflb_utils.printf("Worker {0} did not stop, terminate it".format(worker.index))
+                worker.process.terminate()
+                self._retired.append(worker.process)
+                if worker.job[2] is not None:
+                    send_result(worker.job[2], False)
+                self._finish_job(worker, False, "cancelled", None, True)
+                self._start_worker(worker)
+                continue
+            bflb_utils.printf("Worker {0} exited with code {1}".format(worker.index, worker.process.exitcode))
+            if worker.job is not None:
+                if worker.job[2] is not None:
+                    send_result(worker.job[2], False)
+                self._finish_job(worker, False, "worker exited")
+            self._start_worker(worker)
+        self._retired = [process for process in self._retired if process.is_alive()]
+
+    def _dispatch(self):
+        # liveness is checked on its own clock, a busy result queue must not
+        # hide a worker that died under a job
+        next_check = time.time() + WORKER_CHECK_INTERVAL
+        while self._running:
+            with self._lock:
+                conns = [worker.result_conn for worker in self._workers]
+            items = []
+            for conn in multiprocessing.connection.wait(conns, max(next_check - time.time(), 0)):
+                try:
+                    items.append(conn.recv())
+                except (EOFError, OSError):
+                    # the worker is gone, it is replaced by the next check
+                    next_check = 0
+            with self._lock:
+                if not self._running:
+                    break
+                for item in items:
+                    kind, index, job_id, data = item
+                    worker = self._workers[index]
+                    # messages of a cancelled job may still arrive from its old process
+                    if worker.job is not None and worker.job[0] == job_id:
+                        if kind == "events":
+                            if worker.job[4] is not None:
+                                worker.job[4]("events", job_id, data)
+                        else:
+                            ret, error, metrics, cost = data
+                            if metrics is not None:
+                                # the server aggregates the counters of all ports
+                                self.metrics.merge(metrics)
+                                bflb_utils.printf("Metrics collected from {0}".format(worker.job[1]))
+                            self._finish_job(worker, ret, error, metrics)
+                            if self.max_jobs and worker.jobs >= self.max_jobs:
+                                self._recycle_worker(worker)
+                if time.time() >= next_check:
+                    self._check_workers()
+                    next_check = time.time() + WORKER_CHECK_INTERVAL
+                self._schedule()
+
+    def get_status(self):
+        with self._lock:
+            now = time.time()
+            uptime = max(now - self.start_time, 1e-6)
+            workers = []
+            busy_time = 0.0
+            for worker in self._workers:
+                worker_busy = worker.busy_time
+                if worker.job is not None:
+                    worker_busy += now - worker.busy_start
+                busy_time += worker_busy
+                workers.append(
+                    {
+                        "index": worker.index,
+                        "pid": worker.process.pid,
+                        "port": worker.job[1] if worker.job is not None else None,
+                        "jobs": worker.jobs,
+                        "utilization": round(worker_busy / uptime, 4),
+                    }
+                )
+            return {
+                "workers": len(self._workers),
+                "busy": len([worker for worker in self._workers if worker.job is not None]),
+                "queue_depth": len(self._pending),
+                "queue_size": self.queue_size,
+                "utilization": round(busy_time / uptime / len(self._workers), 4),
+                "jobs_total": self.jobs_total,
+                "jobs_success": self.jobs_success,
+                "jobs_refused": self.jobs_refused,
+                "jobs_cancelled": self.jobs_cancelled,
+                "recycled": self.recycled,
+                "uptime": round(uptime, 3),
+                "worker_list": workers,
+            }
+
+    def to_json(self):
+        return json.dumps(self.get_status(), indent=1)
+
+    def get_metrics(self, fmt="prometheus"):
+        # job metrics of all workers followed by the pool gauges
+        status = self.get_status()
+        with self._lock:
+            if fmt == "json":
+                data = self.metrics.to_dict()
+                data["pool"] = status
+                return json.dumps(data, indent=1)
+            data = self.metrics.to_prometheus()
+        return data + self.to_prometheus(status)
+
+    def to_prometheus(self, status=None):
+        if status is None:
+            status = self.get_status()
+        lines = []
+        for name, key, kind in (
+            ("bflb_pool_workers", "workers", "gauge"),
+            ("bflb_pool_busy_workers", "busy", "gauge"),
+            ("bflb_pool_queue_depth", "queue_depth", "gauge"),
+            ("bflb_pool_queue_size", "queue_size", "gauge"),
+            ("bflb_pool_utilization", "utilization", "gauge"),
+            ("bflb_pool_jobs_total", "jobs_total", "counter"),
+            ("bflb_pool_jobs_success_total", "jobs_success", "counter"),
+            ("bflb_pool_jobs_refused_total", "jobs_refused", "counter"),
+            ("bflb_pool_jobs_cancelled_total", "jobs_cancelled", "counter"),
+            ("bflb_pool_recycled_total", "recycled", "counter"),
+        ):
+            lines.append("# TYPE %s %s" % (name, kind))
+            lines.append("%s %s" % (name, status[key]))
+        return "\n".join(lines) + "\n"
+
+    def close(self, timeout=5):
+        with self._lock:
+            self._running = False
+            for worker in self._workers:
+                worker.job_queue.put(None)
+        self._dispatcher.join(timeout)
+        for process in [worker.process for worker in self._workers] + self._retired:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
@@ -29,6 +29,8 @@ try:
 except ImportError:
     from libs import bflb_path
 from libs import bflb_utils
+from libs import bflb_cfg_codec
+from libs import bflb_chip_registry
 from libs.bflb_utils import app_path, chip_path, convert_path
 from libs.bflb_configobj import BFConfigParser
 
@@ -57,54 +59,14 @@ def bootheader_update_flash_pll_crc(bootheader_data, chiptype):
     return bootheader_data
 
 
-def get_int_mask(pos, length):
-    ones = "1" * 32
-    zeros = "0" * 32
-    mask = ones[0 : 32 - pos - length] + zeros[0:length] + ones[0:pos]
-    return int(mask, 2)
-
-
 def update_data_from_cfg(config_keys, config_file, section):
     bflb_utils.printf("Updating data according to <{0}[{1}]>".format(config_file, section))
     cfg = BFConfigParser()
     cfg.read(config_file)
-    # get finally data len
-    filelen = 0
-    for key in config_keys:
-        offset = int(config_keys.get(key)["offset"], 10)
-        if offset > filelen:
-            filelen = offset
-    filelen += 4
-    bflb_utils.printf("created file len: ", filelen)
-    data = bytearray(filelen)
-    data_mask = bytearray(filelen)
-    # bflb_utils.printf(binascii.hexlify(data))
-    for key in cfg.options(section):
-        if config_keys.get(key) is None:
-            bflb_utils.printf(key, " does not exist")
-            continue
-        # bflb_utils.printf(key)
-        val = cfg.get(section, key)
-        if val.startswith("0x"):
-            val = int(val, 16)
-        else:
-            val = int(val, 10)
-        # bflb_utils.printf(val)
-        offset = int(config_keys.get(key)["offset"], 10)
-        pos = int(config_keys.get(key)["pos"], 10)
-        bitlen = int(config_keys.get(key)["bitlen"], 10)
-
-        oldval = bflb_utils.bytearray_to_int(bflb_utils.bytearray_reverse(data[offset : offset + 4]))
-        oldval_mask = bflb_utils.bytearray_to_int(bflb_utils.bytearray_reverse(data_mask[offset : offset + 4]))
-        newval = (oldval & get_int_mask(pos, bitlen)) + (val << pos)
-        if val != 0:
-            newval_mask = oldval_mask | (~get_int_mask(pos, bitlen))
-        else:
-            newval_mask = oldval_mask
-        # bflb_utils.printf(newval, binascii.hexlify(bflb_utils.int_to_4bytearray_l(newval)))
-        data[offset : offset + 4] = bflb_utils.int_to_4bytearray_l(newval)
-        data_mask[offset : offset + 4] = bflb_utils.int_to_4bytearray_l(newval_mask)
-    # bflb_utils.printf(binascii.hexlify(data))
+    # table is compiled once and reused for every chip/section
+    codec = bflb_cfg_codec.compile_cfg_keys(config_keys)
+    bflb_utils.printf("created file len: ", codec.length)
+    data, data_mask = codec.pack(codec.values_from_cfg(cfg, section))
     return data, data_mask
 
 
@@ -112,8 +74,8 @@ def bootheader_create_do(chipname, chiptype, config_file, section, output_file=N
     efuse_bootheader_path = os.path.join(chip_path, chipname, "efuse_bootheader")
     try:
         bflb_utils.printf("create bootheader using ", config_file)
-        sub_module = __import__("libs." + chiptype, fromlist=[chiptype])
-        bh_data, tmp = update_data_from_cfg(sub_module.bootheader_cfg_keys.bootheader_cfg_keys, config_file, section)
+        chip = bflb_chip_registry.get_chip(chiptype)
+        bh_data, tmp = update_data_from_cfg(chip.bootheader_cfg_keys.bootheader_cfg_keys, config_file, section)
         bh_data = bootheader_update_flash_pll_crc(bh_data, chiptype)
         if output_file is None:
             fp = open(efuse_bootheader_path + "/" + section.lower().replace("_cfg", ".bin"), "wb+")
@@ -218,8 +180,8 @@ def efuse_create_process(chipname, chiptype, config_file, output_file=None):
         shutil.copyfile(eflash_loader_path + "/eflash_loader_cfg.conf", cfg_file)
     cfg = BFConfigParser()
     cfg.read(cfg_file)
-    sub_module = __import__("libs." + chiptype, fromlist=[chiptype])
-    efuse_data, mask = update_data_from_cfg(sub_module.efuse_cfg_keys.efuse_cfg_keys, config_file, "EFUSE_CFG")
+    chip = bflb_chip_registry.get_chip(chiptype)
+    efuse_data, mask = update_data_from_cfg(chip.efuse_cfg_keys.efuse_cfg_keys, config_file, "EFUSE_CFG")
     if output_file is None:
         filedir = efuse_bootheader_path + "/efusedata.bin"
     else:
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+#  Copyright (C) 2016- BOUFFALO LAB (NANJING) CO., LTD.
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+
+import os
+import json
+import hashlib
+import tempfile
+import threading
+
+from libs import bflb_utils
+from libs.bflb_utils import app_path
+from libs.bflb_configobj import BFConfigParser
+
+FLASH_INDEX_DIR = os.path.join(app_path, "cache", "flash")
+FLASH_INDEX_VERSION = 1
+
+
+class BflbFlashIndex(object):
+    # jedec id -> flash conf index for the utils/flash/<chip>/ directories.
+    # an index holds the conf names of every id and the FLASH_CFG options of
+    # every conf, it is kept in memory and in <cache_dir>/<dir hash>.json and
+    # is rebuilt when the directory mtime changes. a conf edited in place is
+    # caught by its own mtime when its options are asked for
+    def __init__(self, cache_dir=FLASH_INDEX_DIR):
+        self._cache_dir = cache_dir
+        self._lock = threading.Lock()
+        self._indexes = {}
+        self.builds = 0
+
+    def _index_path(self, cfg_dir):
+        key = hashlib.sha256(os.path.abspath(cfg_dir).encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self._cache_dir, key + ".json")
+
+    @staticmethod
+    def _read_conf(path):
+        cfg = BFConfigParser()
+        cfg.read(path)
+        if "FLASH_CFG" not in cfg.sections():
+            return []
+        return [[key, cfg.get("FLASH_CFG", key)] for key in cfg.options("FLASH_CFG")]
+
+    def _build(self, cfg_dir, mtime_ns, old):
+        ids = {}
+        confs = {}
+        old_confs = old["confs"] if old else {}
+        for home, dirs, files in os.walk(cfg_dir):
+            for filename in files:
+                if not filename.endswith(".conf"):
+                    continue
+                ids.setdefault(filename.split("_")[-1][: -len(".conf")], []).append(filename)
+                try:
+                    file_mtime_ns = os.stat(os.path.join(home, filename)).st_mtime_ns
+                except OSError:
+                    continue
+                item = old_confs.get(filename)
+                if item is None or item["mtime_ns"] != file_mtime_ns:
+                    item = {"mtime_ns": file_mtime_ns, "options": self._read_conf(os.path.join(home, filename))}
+                confs[filename] = item
+        self.builds += 1
+        return {"version": FLASH_INDEX_VERSION, "dir": cfg_dir, "mtime_ns": mtime_ns, "ids": ids, "confs": confs}
+
+    def _save(self, cfg_dir, index):
+        try:
+            os.makedirs(self._cache_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self._cache_dir, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w") as fp:
+                    json.dump(index, fp)
+                os.replace(tmp_path, self._index_path(cfg_dir))
+            except Exception:
+                os.remove(tmp_path)
+                raise
+        except (IOError, OSError) as e:
+            bflb_utils.printf("flash index write failed: ", e)
+
+    def _load(self, cfg_dir):
+        cfg_dir = os.path.normpath(cfg_dir)
+        try:
+            mtime_ns = os.stat(cfg_dir).st_mtime_ns
+        except OSError:
+            return None
+        with self._lock:
+            index = self._indexes.get(cfg_dir)
+            if index is not None and index["mtime_ns"] == mtime_ns:
+                return index
+            if index is None:
+                try:
+                    with open(self._index_path(cfg_dir), "r") as fp:
+                        index = json.load(fp)
+                    if index.get("version") != FLASH_INDEX_VERSION or index.get("dir") != cfg_dir:
+                        index = None
+                except (IOError, OSError, ValueError):
+                    index = None
+            if index is None or index["mtime_ns"] != mtime_ns:
+                index = self._build(cfg_dir, mtime_ns, index)
+                self._save(cfg_dir, index)
+            self._indexes[cfg_dir] = index
+            return index
+
+    def get_conf_names(self, cfg_dir, flash_id):
+        index = self._load(cfg_dir)
+        if index is None:
+            return []
+        return index["ids"].get(flash_id, [])
+
+    def get_suitable_conf_name(self, cfg_dir, flash_id):
+        conf_files = self.get_conf_names(cfg_dir, flash_id)
+        if len(conf_files) > 1:
+            bflb_utils.printf("Flash id duplicate and alternative is:")
+            for i in range(len(conf_files)):
+                tmp = conf_files[i].split(".")[0]
+                bflb_utils.printf("%d:%s" % (i + 1, tmp))
+            return conf_files[-1]
+        elif len(conf_files) == 1:
+            return conf_files[0]
+        else:
+            return ""
+
+    def get_flash_cfg(self, config_file):
+        # FLASH_CFG options of a conf as [key, value] pairs in file order
+        cfg_dir, filename = os.path.split(config_file)
+        index = self._load(cfg_dir)
+        try:
+            file_mtime_ns = os.stat(config_file).st_mtime_ns
+        except OSError:
+            file_mtime_ns = None
+        if index is not None:
+            with self._lock:
+                item = index["confs"].get(filename)
+                if item is not None and item["mtime_ns"] == file_mtime_ns:
+                    return item["options"]
+        return self._read_conf(config_file)
+
+
+_flash_index = None
+
+
+def get_flash_index(cache_dir=None):
+    global _flash_index
+    if _flash_index is None:
+        _flash_index = BflbFlashIndex(cache_dir or FLASH_INDEX_DIR)
+    return _flash_index
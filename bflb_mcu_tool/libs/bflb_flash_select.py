@@ -24,39 +24,20 @@ import re
 
 import config as gol
 from libs import bflb_utils
+from libs import bflb_flash_index
+from libs import bflb_chip_registry
+from libs import bflb_cfg_codec
 from libs.bflb_utils import app_path, chip_path, conf_sign
 from libs.bflb_configobj import BFConfigParser
 
 
-def get_int_mask(pos, length):
-    ones = "1" * 32
-    zeros = "0" * 32
-    mask = ones[0 : 32 - pos - length] + zeros[0:length] + ones[0:pos]
-    return int(mask, 2)
-
-
 def get_suitable_file_name(cfg_dir, flash_id):
-    conf_files = []
-    for home, dirs, files in os.walk(cfg_dir):
-        for filename in files:
-            if filename.split("_")[-1] == flash_id + ".conf":
-                conf_files.append(filename)
-
-    if len(conf_files) > 1:
-        bflb_utils.printf("Flash id duplicate and alternative is:")
-        for i in range(len(conf_files)):
-            tmp = conf_files[i].split(".")[0]
-            bflb_utils.printf("%d:%s" % (i + 1, tmp))
-        return conf_files[i]
-    elif len(conf_files) == 1:
-        return conf_files[0]
-    else:
-        return ""
+    return bflb_flash_index.get_flash_index().get_suitable_conf_name(cfg_dir, flash_id)
 
 
 def get_supported_flash(chiptype):
-    sub_module = __import__("libs." + chiptype, fromlist=[chiptype])
-    return sub_module.flash_select_do.get_supported_flash_do()
+    chip = bflb_chip_registry.get_chip(chiptype)
+    return chip.flash_select_do.get_supported_flash_do()
 
 
 def check_basic_flash_cfg(cfg_file, section):
@@ -77,51 +58,17 @@ def check_basic_flash_cfg(cfg_file, section):
 
 
 def update_flash_para_from_cfg(config_keys, config_file):
-    section = "FLASH_CFG"
-    cfg = BFConfigParser()
-    cfg.read(config_file)
-    # get finally data len
-    filelen = 0
-    offset = 0
-    min_offset = 0xFFFFFFFF
-    max_offset = 0
+    codec = bflb_cfg_codec.compile_cfg_keys(config_keys)
     flash_crc_offset = 0
     crc_offset = 0
-    if config_keys.get("crc32") is not None:
-        crc_offset = int(config_keys.get("crc32")["offset"], 10)
-    if config_keys.get("flashcfg_crc32") is not None:
-        flash_crc_offset = int(config_keys.get("flashcfg_crc32")["offset"], 10)
-    for key in cfg.options(section):
-        if config_keys.get(key) is None:
-            continue
-        offset = int(config_keys.get(key)["offset"], 10)
-        if offset < min_offset:
-            min_offset = offset
-        if offset > max_offset:
-            max_offset = offset
-    filelen = max_offset - min_offset + 4
-    data = bytearray(filelen)
-    # bflb_utils.printf(binascii.hexlify(data))
-    for key in cfg.options(section):
-        if config_keys.get(key) is None:
-            bflb_utils.printf(key, " does not exist")
-            continue
-        # bflb_utils.printf(key)
-        val = cfg.get(section, key)
-        if val.startswith("0x"):
-            val = int(val, 16)
-        else:
-            val = int(val, 10)
-        # bflb_utils.printf(val)
-        offset = int(config_keys.get(key)["offset"], 10) - min_offset
-        pos = int(config_keys.get(key)["pos"], 10)
-        bitlen = int(config_keys.get(key)["bitlen"], 10)
-
-        oldval = bflb_utils.bytearray_to_int(bflb_utils.bytearray_reverse(data[offset : offset + 4]))
-        newval = (oldval & get_int_mask(pos, bitlen)) + (val << pos)
-        # bflb_utils.printf(newval, binascii.hexlify(bflb_utils.int_to_4bytearray_l(newval)))
-        data[offset : offset + 4] = bflb_utils.int_to_4bytearray_l(newval)
-    # bflb_utils.printf(binascii.hexlify(data))
+    if codec.has_key("crc32"):
+        crc_offset = codec.offset("crc32")
+    if codec.has_key("flashcfg_crc32"):
+        flash_crc_offset = codec.offset("flashcfg_crc32")
+    # data only covers the words between the first and last field of the section
+    values = codec.values_from_items(bflb_flash_index.get_flash_index().get_flash_cfg(config_file))
+    min_offset, filelen = codec.span([key for key, val in values])
+    data, tmp = codec.pack(values, min_offset, filelen)
     return min_offset, filelen, data, flash_crc_offset, crc_offset
 
 
@@ -130,12 +77,12 @@ def update_flash_cfg_data_do(chipname, chiptype, flash_id):
         cfg_dir = app_path + "/utils/flash/" + chipname + "/"
     else:
         cfg_dir = app_path + "/utils/flash/" + gol.flash_dict[chipname] + "/"
-    sub_module = __import__("libs." + chiptype, fromlist=[chiptype])
-    # conf_name = sub_module.flash_select_do.get_suitable_file_name(cfg_dir, flash_id)
+    chip = bflb_chip_registry.get_chip(chiptype)
+    # conf_name = chip.flash_select_do.get_suitable_file_name(cfg_dir, flash_id)
     conf_name = get_suitable_file_name(cfg_dir, flash_id)
     if os.path.isfile(cfg_dir + conf_name) is False:
         return None, None, None, None, None
-    return update_flash_para_from_cfg(sub_module.bootheader_cfg_keys.bootheader_cfg_keys, cfg_dir + conf_name)
+    return update_flash_para_from_cfg(chip.bootheader_cfg_keys.bootheader_cfg_keys, cfg_dir + conf_name)
 
 
 def update_flash_cfg_data(chipname, chiptype, flash_id, cfg, bh_cfg_file, cfg_key):
@@ -145,7 +92,6 @@ def update_flash_cfg_data(chipname, chiptype, flash_id, cfg, bh_cfg_file, cfg_ke
     magic_code = int(magic_code, 16)
     flash_magic_code = cfg2.get(cfg_key, "flashcfg_magic_code")
     flash_magic_code = int(flash_magic_code, 16)
-    sub_module = __import__("libs." + chiptype, fromlist=[chiptype])
     offset, flash_cfg_len, data, flash_crc_offset, crc_offset = update_flash_cfg_data_do(chipname, chiptype, flash_id)
 
     para_file = cfg.get("FLASH_CFG", "flash_para")
@@ -171,10 +117,10 @@ def update_flash_cfg_data(chipname, chiptype, flash_id, cfg, bh_cfg_file, cfg_ke
 
 
 def update_flash_cfg(chipname, chiptype, flash_id, file=None, create=False, section=None):
-    sub_module = __import__("libs." + chiptype, fromlist=[chiptype])
+    chip = bflb_chip_registry.get_chip(chiptype)
     if check_basic_flash_cfg(file, section):
         return True
-    if sub_module.flash_select_do.update_flash_cfg_do(chipname, chiptype, flash_id, file, create, section) is False:
+    if chip.flash_select_do.update_flash_cfg_do(chipname, chiptype, flash_id, file, create, section) is False:
         return False
     return True
 
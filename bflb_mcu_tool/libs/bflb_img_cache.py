@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+#  Copyright (C) 2016- BOUFFALO LAB (NANJING) CO., LTD.
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+
+from libs import bflb_utils
+from libs import bflb_version
+from libs.bflb_utils import app_path
+from libs.bflb_configobj import BFConfigParser
+
+IMG_CACHE_DIR = os.path.join(app_path, "cache", "img")
+IMG_CACHE_MAX_SIZE = 1024 * 1024 * 1024
+# cfg options naming files that img_create_do writes
+IMG_CACHE_OUTPUT_OPTIONS = ["bootinfo_file", "img_file", "whole_img_file", "efuse_file", "efuse_mask_file"]
+# cfg options that are written but are also read as input
+IMG_CACHE_INOUT_OPTIONS = ["efuse_file", "efuse_mask_file"]
+# read by img_create_do in security mode for the efuse encryption key
+IMG_CACHE_KEY_FILES = [os.path.join(app_path, "cfg.bin")]
+
+
+class BflbImgCache(object):
+    # image build cache for img_create. the key is a sha256 over the img create
+    # cfg, every input file it names, the create options and key material. an
+    # entry is a directory <key>/ with the output files and a manifest of where
+    # they go, lru order is kept in the directory mtime like the xz cache
+    def __init__(self, cache_dir=IMG_CACHE_DIR, max_size=IMG_CACHE_MAX_SIZE):
+        self._cache_dir = cache_dir
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        # path -> (size, mtime_ns, sha256) so unchanged inputs are not hashed again
+        self._file_hashes = {}
+        self.hits = 0
+        self.misses = 0
+
+    def file_hash(self, path):
+        st = os.stat(path)
+        with self._lock:
+            item = self._file_hashes.get(path)
+        if item and item[0] == st.st_size and item[1] == st.st_mtime_ns:
+            return item[2]
+        sh = hashlib.sha256()
+        with open(path, "rb") as fp:
+            while True:
+                data = fp.read(1024 * 1024)
+                if not data:
+                    break
+                sh.update(data)
+        digest = sh.hexdigest()
+        with self._lock:
+            self._file_hashes[path] = (st.st_size, st.st_mtime_ns, digest)
+        return digest
+
+    @staticmethod
+    def cfg_files(cfg, section, option):
+        files = []
+        for item in cfg.get(section, option).replace("|", " ").split(" "):
+            item = item.strip().strip('"')
+            if item and item != "UNUSED":
+                files.append(item)
+        return files
+
+    def outputs(self, cfg):
+        outputs = []
+        for section in cfg.sections():
+            for option in IMG_CACHE_OUTPUT_OPTIONS:
+                if not cfg.has_option(section, option):
+                    continue
+                for file in self.cfg_files(cfg, section, option):
+                    outputs.append(file)
+                    if option == "img_file":
+                        outputs.append(file.replace(".bin", "_withhash.bin"))
+        return sorted(set(outputs))
+
+    def make_key(self, chiptype, args, config_file, kwargs):
+        # returns None when an input can not be read, the build then runs uncached
+        cfg = BFConfigParser()
+        cfg.read(config_file)
+        sh = hashlib.sha256()
+        params = {
+            "version": bflb_version.version_text,
+            "chiptype": chiptype,
+            "args": sorted((k, str(v)) for k, v in vars(args).items() if k != "nocache"),
+            "kwargs": sorted((k, str(v)) for k, v in kwargs.items()),
+        }
+        sh.update(json.dumps(params, sort_keys=True).encode("utf-8"))
+        for section in sorted(cfg.sections()):
+            for option in sorted(cfg.options(section)):
+                value = cfg.get(section, option)
+                sh.update(("[%s]%s=%s\n" % (section, option, value)).encode("utf-8"))
+                if option in IMG_CACHE_OUTPUT_OPTIONS and option not in IMG_CACHE_INOUT_OPTIONS:
+                    continue
+                for file in self.cfg_files(cfg, section, option):
+                    if not os.path.isfile(file):
+                        continue
+                    try:
+                        sh.update(("%s:%s\n" % (file, self.file_hash(file))).encode("utf-8"))
+                    except (IOError, OSError) as e:
+                        bflb_utils.printf("img cache skipped, can not read ", file, ": ", e)
+                        return None, []
+        for file in IMG_CACHE_KEY_FILES:
+            if not os.path.isfile(file):
+                sh.update(("%s:-\n" % file).encode("utf-8"))
+                continue
+            try:
+                sh.update(("%s:%s\n" % (file, self.file_hash(file))).encode("utf-8"))
+            except (IOError, OSError) as e:
+                bflb_utils.printf("img cache skipped, can not read ", file, ": ", e)
+                return None, []
+        return sh.hexdigest(), self.outputs(cfg)
+
+    def _entry_path(self, key):
+        return os.path.join(self._cache_dir, key)
+
+    def restore(self, key):
+        entry = self._entry_path(key)
+        try:
+            with open(os.path.join(entry, "manifest.json"), "r") as fp:
+                manifest = json.load(fp)
+            for name, path in manifest["files"]:
+                dirname = os.path.dirname(path)
+                if dirname:
+                    os.makedirs(dirname, exist_ok=True)
+                fd, tmp_path = tempfile.mkstemp(dir=dirname or ".", suffix=".tmp")
+                os.close(fd)
+                shutil.copyfile(os.path.join(entry, name), tmp_path)
+                os.replace(tmp_path, path)
+            # touch entry to keep it at the head of the lru
+            os.utime(entry, None)
+        except (IOError, OSError, ValueError, KeyError):
+            with self._lock:
+                self.misses += 1
+            return False
+        with self._lock:
+            self.hits += 1
+        return True
+
+    def snapshot(self, outputs):
+        state = {}
+        for path in outputs:
+            try:
+                st = os.stat(path)
+                state[path] = (st.st_size, st.st_mtime_ns)
+            except OSError:
+                state[path] = None
+        return state
+
+    def store(self, key, outputs, before):
+        # keep the outputs the build wrote, files it left alone are not restored
+        files = []
+        for path in outputs:
+            if os.path.isfile(path) and self.snapshot([path])[path] != before.get(path):
+                files.append(path)
+        if not files:
+            return False
+        entry = self._entry_path(key)
+        try:
+            os.makedirs(self._cache_dir, exist_ok=True)
+            tmp_entry = tempfile.mkdtemp(dir=self._cache_dir, suffix=".tmp")
+            try:
+                manifest = {"files": []}
+                for i, path in enumerate(files):
+                    name = "%d_%s" % (i, os.path.basename(path))
+                    shutil.copyfile(path, os.path.join(tmp_entry, name))
+                    manifest["files"].append([name, path])
+                with open(os.path.join(tmp_entry, "manifest.json"), "w") as fp:
+                    json.dump(manifest, fp)
+                if os.path.isdir(entry):
+                    shutil.rmtree(entry, ignore_errors=True)
+                os.replace(tmp_entry, entry)
+            except Exception:
+                shutil.rmtree(tmp_entry, ignore_errors=True)
+                raise
+        except (IOError, OSError) as e:
+            bflb_utils.printf("img cache write failed: ", e)
+            return False
+        self.evict()
+        return True
+
+    def evict(self):
+        entries = []
+        total = 0
+        try:
+            names = os.listdir(self._cache_dir)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self._cache_dir, name)
+            if name.endswith(".tmp") or not os.path.isdir(path):
+                continue
+            size = 0
+            try:
+                for file in os.listdir(path):
+                    size += os.path.getsize(os.path.join(path, file))
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            entries.append((mtime, size, path))
+            total += size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self._max_size:
+                break
+            # already evicted by another process is fine too
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def build(self, build_fun, chiptype, args, config_file, kwargs):
+        # run build_fun() unless an entry for the same inputs exists
+        key, outputs = self.make_key(chiptype, args, config_file, kwargs)
+        if key is None:
+            return build_fun()
+        if self.restore(key):
+            bflb_utils.printf("Image restored from cache ", key[:16])
+            return True
+        before = self.snapshot(outputs)
+        res = build_fun()
+        if res is True:
+            self.store(key, outputs, before)
+        return res
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+
+_img_cache = None
+
+
+def get_img_cache(cache_dir=None, max_size=None):
+    global _img_cache
+    if _img_cache is None:
+        _img_cache = BflbImgCache(cache_dir or IMG_CACHE_DIR, max_size or IMG_CACHE_MAX_SIZE)
+    return _img_cache
@@ -32,6 +32,8 @@ except ImportError:
     from libs import bflb_path
 from libs import bflb_utils
 from libs import bflb_efuse_boothd_create
+from libs import bflb_img_cache
+from libs import bflb_chip_registry
 from libs.bflb_utils import app_path, chip_path, set_error_code, convert_path
 from libs.bflb_configobj import BFConfigParser
 
@@ -215,31 +217,31 @@ def compress_dir_iot(chipname, outdir, efuse_load=False):
 
 
 def get_img_offset(chiptype="bl60x", bootheader_data=None):
-    sub_module = __import__("libs." + chiptype, fromlist=[chiptype])
-    return sub_module.img_create_do.img_create_get_img_offset(bootheader_data)
+    chip = bflb_chip_registry.get_chip(chiptype)
+    return chip.img_create_do.img_create_get_img_offset(bootheader_data)
 
 
 def encrypt_loader_bin(chiptype, file, sign, encrypt, key, iv, publickey, privatekey, **kwargs):
-    sub_module = __import__("libs." + chiptype, fromlist=[chiptype])
-    return sub_module.img_create_do.encrypt_loader_bin_do(file, sign, encrypt, key, iv, publickey, privatekey, **kwargs)
+    chip = bflb_chip_registry.get_chip(chiptype)
+    return chip.img_create_do.encrypt_loader_bin_do(file, sign, encrypt, key, iv, publickey, privatekey, **kwargs)
 
 
 def create_sp_media_image_file(config, chiptype="bl60x", cpu_type=None, security=False, **kwargs):
-    sub_module = __import__("libs." + chiptype, fromlist=[chiptype])
-    sub_module.img_create_do.create_sp_media_image(config, cpu_type, security, **kwargs)
+    chip = bflb_chip_registry.get_chip(chiptype)
+    chip.img_create_do.create_sp_media_image(config, cpu_type, security, **kwargs)
 
 
 def create_security_efuse(chiptype, key, sel):
-    sub_module = __import__("libs." + chiptype, fromlist=[chiptype])
+    chip = bflb_chip_registry.get_chip(chiptype)
 
     if chiptype == "bl808" or chiptype == "bl616" or chiptype == "bl628":
         efuse_data = bytearray(256)
         mask_data = bytearray(256)
-        img_update_efuse_fun = sub_module.img_create_do.img_update_efuse_group0
+        img_update_efuse_fun = chip.img_create_do.img_update_efuse_group0
     else:
         efuse_data = bytearray(128)
         mask_data = bytearray(128)
-        img_update_efuse_fun = sub_module.img_create_do.img_update_efuse
+        img_update_efuse_fun = chip.img_create_do.img_update_efuse
 
     efuse_data, mask_data = img_update_efuse_fun(None, 0, None, 0, None, sel, key, True)
     for num in range(0, len(efuse_data)):
@@ -250,13 +252,20 @@ def create_security_efuse(chiptype, key, sel):
 
 
 def img_create(args, chipname="bl60x", chiptype="bl60x", img_dir=None, config_file=None, **kwargs):
-    sub_module = __import__("libs." + chiptype, fromlist=[chiptype])
+    chip = bflb_chip_registry.get_chip(chiptype)
     img_dir_path = os.path.join(chip_path, chipname, "img_create_iot")
-    if img_dir is None:
-        res = sub_module.img_create_do.img_create_do(args, img_dir_path, config_file, **kwargs)
-    else:
-        res = sub_module.img_create_do.img_create_do(args, img_dir, config_file, **kwargs)
-    return res
+    if img_dir is not None:
+        img_dir_path = img_dir
+
+    def build():
+        return chip.img_create_do.img_create_do(args, img_dir_path, config_file, **kwargs)
+
+    if getattr(args, "nocache", False):
+        return build()
+    # same cfg, input files and keys give the same images, restore them instead
+    if config_file is None:
+        config_file = img_dir_path + "/img_create_cfg.ini"
+    return bflb_img_cache.get_img_cache().build(build, chiptype, args, config_file, kwargs)
 
 
 def run():
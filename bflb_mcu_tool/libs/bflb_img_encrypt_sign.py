@@ -33,6 +33,7 @@ except ImportError:
 import config as gol
 from libs import bflb_utils
 from libs import bflb_img_create
+from libs import bflb_chip_registry
 
 
 class BflbImgEncryptSign(object):
@@ -53,8 +54,8 @@ class BflbImgEncryptSign(object):
             whole_flash_data = bytearray(fp.read())
 
         encrypt_ota_data = bytearray(0)
-        sub_module = __import__("libs." + self.chiptype, fromlist=[self.chiptype])
-        if sub_module.partition_cfg_do.bootheader_magic_code != bflb_utils.bytearray_to_int(whole_flash_data[0:4]):
+        chip = bflb_chip_registry.get_chip(self.chiptype)
+        if chip.partition_cfg_do.bootheader_magic_code != bflb_utils.bytearray_to_int(whole_flash_data[0:4]):
             bflb_utils.printf("bootheader bin magic check failed", binascii.hexlify(whole_flash_data[0:4]))
             return False
         efuse_data = bytearray(128)
@@ -85,28 +86,28 @@ class BflbImgEncryptSign(object):
             + (bflb_utils.bytearray_to_int(whole_flash_data[img_len_offset + 3 : img_len_offset + 4]) << 24)
         )
         pt_data = whole_flash_data[0xE000:0xF000]
-        entry_type, entry_addr, entry_len = sub_module.partition_cfg_do.parse_pt_data(pt_data)
+        entry_type, entry_addr, entry_len = chip.partition_cfg_do.parse_pt_data(pt_data)
         bflb_utils.printf(entry_type, entry_addr, entry_len)
         (
             whole_flash_data[: boot2_len + boot2_addr],
             efuse_data,
             img_len,
-        ) = sub_module.img_create_do.create_encryptandsign_flash_data(
+        ) = chip.img_create_do.create_encryptandsign_flash_data(
             whole_flash_data[0 : boot2_len + boot2_addr], boot2_addr, key, iv, publickey, privatekey, **kwargs
         )
         for i, val in enumerate(entry_type):
             if entry_addr[i] > len(whole_flash_data):
                 continue
-            if sub_module.partition_cfg_do.bootheader_magic_code != bflb_utils.bytearray_to_int(
+            if chip.partition_cfg_do.bootheader_magic_code != bflb_utils.bytearray_to_int(
                 whole_flash_data[entry_addr[i] : entry_addr[i] + 4]
             ):
                 continue
-            if val == sub_module.partition_cfg_do.fireware_name:
+            if val == chip.partition_cfg_do.fireware_name:
                 (
                     whole_flash_data[entry_addr[i] : entry_addr[i] + entry_len[i]],
                     efuse_data,
                     img_len,
-                ) = sub_module.img_create_do.create_encryptandsign_flash_data(
+                ) = chip.img_create_do.create_encryptandsign_flash_data(
                     whole_flash_data[entry_addr[i] : entry_addr[i] + entry_len[i]],
                     0x1000,
                     key,
@@ -116,12 +117,12 @@ class BflbImgEncryptSign(object):
                     **kwargs,
                 )
                 encrypt_ota_data = whole_flash_data[entry_addr[i] : entry_addr[i] + 0x1000 + img_len]
-            if val == sub_module.partition_cfg_do.mfg_name:
+            if val == chip.partition_cfg_do.mfg_name:
                 (
                     whole_flash_data[entry_addr[i] : entry_addr[i] + entry_len[i]],
                     efuse_data,
                     img_len,
-                ) = sub_module.img_create_do.create_encryptandsign_flash_data(
+                ) = chip.img_create_do.create_encryptandsign_flash_data(
                     whole_flash_data[entry_addr[i] : entry_addr[i] + entry_len[i]],
                     0x1000,
                     key,
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+#  Copyright (C) 2016- BOUFFALO LAB (NANJING) CO., LTD.
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+
+import os
+import sys
+import json
+import mmap
+import time
+import shutil
+import argparse
+import tempfile
+
+from libs import bflb_utils
+
+LAYOUT_COPY_SIZE = 1024 * 1024
+LAYOUT_MAP_SUFFIX = ".map"
+
+
+class BflbImgLayout(object):
+    # flash image made of pieces (files or data) placed at offsets. the image
+    # is assembled straight into a memory mapped output file, gaps get the
+    # erased flash value in bulk and a region map of the populated ranges is
+    # written next to it. later pieces overwrite earlier ones like slice
+    # assignment into a bytearray did
+    def __init__(self, length=0, fill=0xFF):
+        self._length = length
+        self._fill = fill
+        self._pieces = []
+
+    def add_file(self, offset, file, name=None):
+        size = os.path.getsize(file)
+        self._pieces.append((offset, size, file, None, name or os.path.basename(file)))
+        return size
+
+    def add_data(self, offset, data, name=None):
+        self._pieces.append((offset, len(data), None, bytes(data), name or "data"))
+        return len(data)
+
+    def reset(self, length=0):
+        # an image that already carries its bootinfo replaces everything placed so far
+        self._length = length
+        self._pieces = []
+
+    @property
+    def length(self):
+        length = self._length
+        for offset, size, file, data, name in self._pieces:
+            length = max(length, offset + size)
+        return length
+
+    def regions(self):
+        # merged (start, end) ranges that hold piece data, the rest is fill
+        ranges = sorted((offset, offset + size) for offset, size, file, data, name in self._pieces if size)
+        merged = []
+        for start, end in ranges:
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        return [tuple(item) for item in merged]
+
+    def gaps(self):
+        gaps = []
+        pos = 0
+        for start, end in self.regions():
+            if start > pos:
+                gaps.append((pos, start))
+            pos = end
+        if pos < self.length:
+            gaps.append((pos, self.length))
+        return gaps
+
+    def write(self, output_file, sparse=False, region_map=True):
+        # sparse leaves gaps as holes of the file system, only for readers of the region map
+        length = self.length
+        with open(output_file, "wb+") as fp:
+            fp.truncate(length)
+            if length:
+                mm = mmap.mmap(fp.fileno(), length)
+                try:
+                    if not sparse:
+                        fill_block = bytes([self._fill]) * min(LAYOUT_COPY_SIZE, length)
+                        for start, end in self.gaps():
+                            for pos in range(start, end, len(fill_block)):
+                                cur_len = min(len(fill_block), end - pos)
+                                mm[pos : pos + cur_len] = fill_block[:cur_len]
+                    for offset, size, file, data, name in self._pieces:
+                        if data is not None:
+                            mm[offset : offset + size] = data
+                            continue
+                        with open(file, "rb") as src:
+                            pos = offset
+                            while True:
+                                chunk = src.read(LAYOUT_COPY_SIZE)
+                                if not chunk:
+                                    break
+                                mm[pos : pos + len(chunk)] = chunk
+                                pos += len(chunk)
+                    mm.flush()
+                finally:
+                    mm.close()
+        if region_map:
+            self.write_region_map(output_file, sparse)
+        return length
+
+    def write_region_map(self, output_file, sparse=False):
+        region_map = {
+            "length": self.length,
+            "fill": self._fill,
+            "sparse": sparse,
+            "regions": [[start, end] for start, end in self.regions()],
+            "pieces": [[offset, offset + size, name] for offset, size, file, data, name in self._pieces],
+        }
+        with open(output_file + LAYOUT_MAP_SUFFIX, "w") as fp:
+            json.dump(region_map, fp, indent=1)
+
+
+def read_file_head(file, size=4):
+    with open(file, "rb") as fp:
+        return fp.read(size)
+
+
+def load_region_map(file):
+    # region map of a file written by BflbImgLayout, None if missing or stale
+    map_file = file + LAYOUT_MAP_SUFFIX
+    try:
+        if os.path.getmtime(map_file) < os.path.getmtime(file):
+            return None
+        with open(map_file, "r") as fp:
+            region_map = json.load(fp)
+        if region_map["length"] != os.path.getsize(file):
+            return None
+        return region_map
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+
+
+def region_map_segments(file, file_len, block_size):
+    # (offset, length) runs to send for file, regions grown to block_size so
+    # every gap left out is whole erased blocks. None without a usable map
+    region_map = load_region_map(file)
+    if region_map is None or region_map["length"] != file_len or region_map["fill"] != 0xFF:
+        return None
+    segments = []
+    for start, end in region_map["regions"]:
+        start = start // block_size * block_size
+        end = min(file_len, (end + block_size - 1) // block_size * block_size)
+        if segments and start <= segments[-1][0] + segments[-1][1]:
+            segments[-1] = (segments[-1][0], max(segments[-1][0] + segments[-1][1], end) - segments[-1][0])
+        else:
+            segments.append((start, end - start))
+    return segments
+
+
+def run(argv):
+    parser = argparse.ArgumentParser(description="image layout check and benchmark")
+    parser.add_argument("--size", dest="size", default=16 * 1024 * 1024, type=int, help="whole image size")
+    parser.add_argument("--dir", dest="dir", help="work dir, a temporary one is used and removed if not set")
+    args = parser.parse_args(argv)
+    if args.dir:
+        os.makedirs(args.dir, exist_ok=True)
+        return layout_check(args)
+    args.dir = tempfile.mkdtemp(prefix="layout_test_")
+    try:
+        return layout_check(args)
+    finally:
+        shutil.rmtree(args.dir, ignore_errors=True)
+
+
+def layout_check(args):
+    bootinfo = os.path.join(args.dir, "bootinfo.bin")
+    img = os.path.join(args.dir, "img.bin")
+    output = os.path.join(args.dir, "whole_img.bin")
+    with open(bootinfo, "wb") as fp:
+        fp.write(os.urandom(0x300))
+    img_len = args.size // 2
+    with open(img, "wb") as fp:
+        fp.write(os.urandom(img_len))
+    img_addr = args.size - img_len
+
+    # the bytearray assembly bind_img used to do
+    start = time.time()
+    whole_img_data = bytearray(img_addr + img_len)
+    for i in range(len(whole_img_data)):
+        whole_img_data[i] = 0xFF
+    with open(bootinfo, "rb") as fp:
+        data = fp.read()
+    whole_img_data[0 : len(data)] = data
+    with open(img, "rb") as fp:
+        data = fp.read()
+    whole_img_data[img_addr : img_addr + len(data)] = data
+    ref_cost = time.time() - start
+
+    start = time.time()
+    layout = BflbImgLayout(img_addr)
+    layout.add_file(0, bootinfo)
+    layout.add_file(img_addr, img)
+    layout.write(output)
+    cost = time.time() - start
+    with open(output, "rb") as fp:
+        same = fp.read() == whole_img_data
+    bflb_utils.printf("%-12s%12s%12s" % ("function", "time(ms)", "MB/s"))
+    for name, cost in (("bytearray", ref_cost), ("layout", cost)):
+        bflb_utils.printf("%-12s%12.1f%12.1f" % (name, cost * 1000, args.size / cost / 1024 / 1024))
+    bflb_utils.printf("output %s" % ("same" if same else "DIFFERENT"))
+    bflb_utils.printf("regions %s" % layout.regions())
+    bflb_utils.printf("segments %s" % region_map_segments(output, layout.length, 4096))
+    return same
+
+
+if __name__ == "__main__":
+    sys.exit(0 if run(sys.argv[1:]) else 1)
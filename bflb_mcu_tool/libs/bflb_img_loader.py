@@ -34,8 +34,8 @@ from libs import bflb_utils
 from libs import bflb_security
 from libs import bflb_img_create
 from libs import bflb_interface_uart
-from libs import bflb_interface_sdio
-from libs import bflb_interface_jlink
+from libs import bflb_metrics
+from libs import bflb_chip_registry
 from libs.bflb_configobj import BFConfigParser
 import config as gol
 
@@ -46,34 +46,38 @@ try:
 except ImportError:
     th_sign = False
 
-try:
-    from PySide2 import QtCore
-
-    qt_sign = True
-except ImportError:
-    qt_sign = False
-
 
 class BflbImgLoader(object):
-    def __init__(self, chiptype="bl60x", chipname="bl60x", interface="uart", createcfg=None):
+    def __init__(
+        self, chiptype="bl60x", chipname="bl60x", interface="uart", createcfg=None, cmd_metrics=None, session=None
+    ):
         self.bflb_boot_if = None
         self._imge_fp = None
         self._segcnt = 0
         self._chip_type = chiptype
         self._chip_name = chipname
+        self._chip = bflb_chip_registry.get_chip(chiptype)
         self._create_cfg = createcfg
         self._key = ""
         self._iv = ""
         self._publickey = ""
         self._privatekey = ""
         self.bl616_a0 = False
+        self._session = session
+        if cmd_metrics is None:
+            cmd_metrics = session.metrics if session is not None else bflb_metrics.BflbCmdMetrics()
+        self._cmd_metrics = cmd_metrics
 
         if interface == "uart":
-            self.bflb_boot_if = bflb_interface_uart.BflbUartPort()
+            self.bflb_boot_if = bflb_interface_uart.BflbUartPort(session=session)
         elif interface == "sdio":
-            self.bflb_boot_if = bflb_interface_sdio.BflbSdioPort()
+            from libs import bflb_interface_sdio
+
+            self.bflb_boot_if = bflb_interface_sdio.BflbSdioPort(session=session)
         elif interface == "jlink":
-            self.bflb_boot_if = bflb_interface_jlink.BflbJLinkPort()
+            from libs import bflb_interface_jlink
+
+            self.bflb_boot_if = bflb_interface_jlink.BflbJLinkPort(session=session)
 
         self._bootrom_cmds = {
             "get_chip_id": {"cmd_id": "05", "data_len": "0000", "callback": None},
@@ -150,24 +154,9 @@ class BflbImgLoader(object):
             if len(read_data) != read_len:
                 bflb_utils.printf("read error, expected len = ", read_len, ", read len = ", len(read_data))
                 return bytearray(0)
-            if section == "load_boot_header":
-                tmp = bflb_utils.bytearray_reverse(read_data[120:124])
-                self._segcnt = bflb_utils.bytearray_to_int(tmp)
-                bflb_utils.printf("segcnt is ", self._segcnt)
-            elif section == "808_load_boot_header":
-                tmp = bflb_utils.bytearray_reverse(read_data[140:144])
-                self._segcnt = bflb_utils.bytearray_to_int(tmp)
-                bflb_utils.printf("segcnt is ", self._segcnt)
-            elif section == "628_load_boot_header":
-                tmp = bflb_utils.bytearray_reverse(read_data[136:140])
-                self._segcnt = bflb_utils.bytearray_to_int(tmp)
-                bflb_utils.printf("segcnt is ", self._segcnt)
-            elif section == "616_load_boot_header":
-                tmp = bflb_utils.bytearray_reverse(read_data[132:136])
-                self._segcnt = bflb_utils.bytearray_to_int(tmp)
-                bflb_utils.printf("segcnt is ", self._segcnt)
-            elif section == "702l_load_boot_header":
-                tmp = bflb_utils.bytearray_reverse(read_data[120:124])
+            if section == self._chip.boot_header_section and self._chip.segcnt_offset is not None:
+                offset = self._chip.segcnt_offset
+                tmp = bflb_utils.bytearray_reverse(read_data[offset : offset + 4])
                 self._segcnt = bflb_utils.bytearray_to_int(tmp)
                 bflb_utils.printf("segcnt is ", self._segcnt)
             if section == "load_signature" or section == "load_signature2":
@@ -194,17 +183,20 @@ class BflbImgLoader(object):
         tmp = bflb_utils.int_to_2bytearray_l(len(read_data))
         data = cmd_id + bytearray(1) + tmp + read_data
 
-        if self._chip_type == "bl702" and section == "run_image":
-            sub_module = __import__("libs." + self._chip_type, fromlist=[self._chip_type])
-            data = sub_module.chiptype_patch.img_load_create_predata_before_run_img()
+        if section == "run_image" and self._chip.run_image_predata is not None:
+            data = bytearray(self._chip.run_image_predata)
         baudrate_tmp = self.bflb_boot_if.if_get_baudrate()
         if baudrate:
             self.bflb_boot_if.if_set_baudrate(baudrate)
+        start_time = time.perf_counter()
         self.bflb_boot_if.if_write(data)
         if section == "get_boot_info" or section == "load_seg_header" or section == "get_chip_id":
             res, data_read = self.bflb_boot_if.if_deal_response()
         else:
             res = self.bflb_boot_if.if_deal_ack(dmy_data=False)
+        self._cmd_metrics.record(
+            "bootrom", section, time.perf_counter() - start_time, len(data), len(data_read) if data_read else 0, res
+        )
         if res.startswith("OK") is True:
             pass
         else:
@@ -424,9 +416,12 @@ class BflbImgLoader(object):
                 + bootinfo[24:26]
             )
         bflb_utils.printf("========= chip id: ", chipid, " =========")
-        if qt_sign and th_sign and QtCore.QThread.currentThread().objectName():
+        if self._session is not None:
+            self._session.chipid = chipid
+        qt_core = bflb_utils.get_qt_module("QtCore")
+        if qt_core is not None and th_sign and qt_core.QThread.currentThread().objectName():
             with mutex:
-                num = str(QtCore.QThread.currentThread().objectName())
+                num = str(qt_core.QThread.currentThread().objectName())
                 gol.list_chipid[int(num) - 1] = chipid
                 if chipid is not None:
                     gol.list_chipid_check[int(num) - 1] = chipid
@@ -530,20 +525,7 @@ class BflbImgLoader(object):
             self._imge_fp.read(0xD0)
 
         # start to process load flow
-        if self._chip_type == "bl808":
-            ret, dmy = self.boot_process_one_section("808_load_boot_header", 0)
-        elif self._chip_type == "bl628":
-            ret, dmy = self.boot_process_one_section("628_load_boot_header", 0)
-        elif self._chip_type == "bl616" or self._chip_type == "wb03":
-            ret, dmy = self.boot_process_one_section("616_load_boot_header", 0)
-        elif self._chip_type == "bl702l":
-            ret, dmy = self.boot_process_one_section("702l_load_boot_header", 0)
-        elif self._chip_type == "bl616l":
-            ret, dmy = self.boot_process_one_section("616l_load_boot_header", 0)
-        elif self._chip_type == "bl616d":
-            ret, dmy = self.boot_process_one_section("616d_load_boot_header", 0)
-        else:
-            ret, dmy = self.boot_process_one_section("load_boot_header", 0)
+        ret, dmy = self.boot_process_one_section(self._chip.boot_header_section, 0)
         if ret.startswith("OK") is False:
             return ret, bootinfo
         if sign_384:
@@ -31,13 +31,15 @@ try:
 except ImportError:
     from libs import bflb_path
 from libs import bflb_utils
+from libs import bflb_chip_registry
 from libs.bflb_utils import app_path
 
 dir_dll = os.path.join(app_path, "utils/cklink")
 
 
 class BflbCKLinkPort(object):
-    def __init__(self, vid=0, pid=0):
+    def __init__(self, vid=0, pid=0, session=None):
+        self._session = session
         self._speed = 5000
         self._rx_timeout = 10000
         self._cklink_shake_hand_addr = "20000000"
@@ -57,16 +59,18 @@ class BflbCKLinkPort(object):
         self._password = password
 
     def if_init(self, device, sn, rate, chiptype="bl808", chipname="bl808"):
+        if self._session is not None:
+            self._session.port = str(device)
         if self._inited is False:
             dev = device.split("|")
             vid = int(dev[0].replace("0x", ""), 16)
             pid = int(dev[1].replace("0x", ""), 16)
             serial = str(sn)
             bflb_utils.printf("SN is " + serial)
-            sub_module = __import__("libs." + chiptype, fromlist=[chiptype])
-            self._cklink_shake_hand_addr = sub_module.cklink_load_cfg.cklink_shake_hand_addr
-            self._cklink_data_addr = sub_module.cklink_load_cfg.cklink_data_addr
-            self._cklink_run_addr = sub_module.cklink_load_cfg.cklink_run_addr
+            load_cfg = bflb_chip_registry.get_chip(chiptype).cklink
+            self._cklink_shake_hand_addr = load_cfg.shake_hand_addr
+            self._cklink_data_addr = load_cfg.data_addr
+            self._cklink_run_addr = load_cfg.run_addr
             self._cklink_vid = vid
             self._cklink_pid = pid
             self._speed = rate
@@ -35,6 +35,7 @@ try:
 except ImportError:
     from libs import bflb_path
 from libs import bflb_utils
+from libs import bflb_chip_registry
 from libs.bflb_utils import app_path
 
 python_version = struct.calcsize("P") * 8
@@ -48,7 +49,8 @@ path_dylib = os.path.join(app_path, "utils/jlink", "libjlinkarm.dylib")
 
 
 class BflbJLinkPort(object):
-    def __init__(self):
+    def __init__(self, session=None):
+        self._session = session
         self._speed = 5000
         self._rx_timeout = 10000
         self._jlink_shake_hand_addr = "20000000"
@@ -64,12 +66,12 @@ class BflbJLinkPort(object):
         self._password = password
 
     def if_init(self, device, rate, chiptype="bl60x", chipname="bl60x"):
+        if self._session is not None:
+            self._session.port = str(device)
         if self._inited is False:
-            # jlink_cfg_module = __import__(chiptype + ".jlink_load_cfg")
-            # jlink_cfg_module = __import__("libs." + chiptype + ".jlink_load_cfg", fromlist=["jlink_load_cfg"])
-            sub_module = __import__("libs." + chiptype, fromlist=[chiptype])
-            self._jlink_shake_hand_addr = sub_module.jlink_load_cfg.jlink_shake_hand_addr
-            self._jlink_data_addr = sub_module.jlink_load_cfg.jlink_data_addr
+            load_cfg = bflb_chip_registry.get_chip(chiptype).jlink
+            self._jlink_shake_hand_addr = load_cfg.shake_hand_addr
+            self._jlink_data_addr = load_cfg.data_addr
             if sys.platform.startswith("win"):
                 obj_dll = pylink.Library(dllpath=path_dll)
                 self._jlink = pylink.JLink(lib=obj_dll)
@@ -87,15 +89,15 @@ class BflbJLinkPort(object):
                 self._jlink.open(serial_no=int(device))
             else:
                 self._jlink.open()
-            tif_set = sub_module.jlink_load_cfg.jlink_set_tif
+            tif_set = load_cfg.set_tif
             self._jlink.set_tif(tif_set)
             self._speed = rate
-            core_type = sub_module.jlink_load_cfg.jlink_core_type
+            core_type = load_cfg.core_type
             self._jlink.connect(core_type, rate)
             self._inited = True
             self._chiptype = chiptype
             self._chipname = chipname
-            self._jlink_run_addr = sub_module.jlink_load_cfg.jlink_run_addr
+            self._jlink_run_addr = load_cfg.run_addr
             self._device = device
 
     def if_clear_buf(self):
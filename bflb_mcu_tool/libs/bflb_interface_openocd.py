@@ -32,6 +32,7 @@ try:
 except ImportError:
     from libs import bflb_path
 from libs import bflb_utils
+from libs import bflb_chip_registry
 from libs.bflb_utils import app_path
 
 openocd_path = os.path.join(app_path, "utils/openocd", "openocd.exe")
@@ -111,7 +112,8 @@ class ThreadOpenocdServer(threading.Thread):
 
 
 class BflbOpenocdPort(object):
-    def __init__(self):
+    def __init__(self, session=None):
+        self._session = session
         self._speed = 5000
         self._rx_timeout = 10000
         self._openocd_shake_hand_addr = "20000000"
@@ -127,12 +129,13 @@ class BflbOpenocdPort(object):
         self._password = password
 
     def if_init(self, device, sn, rate, chiptype="bl60x", chipname="bl60x"):
+        if self._session is not None:
+            self._session.port = str(device)
         if self._inited is False:
-            sub_module = __import__("libs." + chiptype, fromlist=[chiptype])
-            self._openocd_shake_hand_addr = sub_module.openocd_load_cfg.openocd_shake_hand_addr
-            self._openocd_data_addr = sub_module.openocd_load_cfg.openocd_data_addr
-            # tif_set = sub_module.openocd_load_cfg.openocd_set_tif
-            self._openocd_run_addr = sub_module.openocd_load_cfg.openocd_run_addr
+            load_cfg = bflb_chip_registry.get_chip(chiptype).openocd
+            self._openocd_shake_hand_addr = load_cfg.shake_hand_addr
+            self._openocd_data_addr = load_cfg.data_addr
+            self._openocd_run_addr = load_cfg.run_addr
             self._speed = rate
             self._inited = True
             self._chiptype = chiptype
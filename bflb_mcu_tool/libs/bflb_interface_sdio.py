@@ -36,7 +36,8 @@ from libs import bflb_utils
 
 
 class BflbSdioPort(object):
-    def __init__(self):
+    def __init__(self, session=None):
+        self._session = session
         self._speed = 5000
         self._rx_timeout = 10000
         self._inited = False
@@ -51,6 +52,8 @@ class BflbSdioPort(object):
         self._password = password
 
     def if_init(self, device, rate, chiptype="bl60x", chipname="bl60x"):
+        if self._session is not None:
+            self._session.port = str(device)
         if self._inited is False:
             host = socket.gethostname()
             # send_address is server address
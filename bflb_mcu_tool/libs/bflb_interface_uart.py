@@ -60,7 +60,8 @@ def task_retry(max_retry_count: int = 5, time_interval: int = 1):
 
 
 class BflbUartPort(object):
-    def __init__(self):
+    def __init__(self, session=None):
+        self._session = session
         self._device = "COM1"
         self._baudrate = 115200
         self._isp_baudrate = 2000000
@@ -82,6 +83,8 @@ class BflbUartPort(object):
 
     @task_retry(max_retry_count=2, time_interval=1)
     def if_init(self, device, rate, chiptype="bl602", chipname="bl602", **kwargs):
+        if self._session is not None:
+            self._session.port = device
         if self._ser is None:
             self._baudrate = rate
 
@@ -177,8 +180,12 @@ class BflbUartPort(object):
     def if_get_rate(self):
         return self._baudrate
 
+    def _cancelled(self):
+        session = self._session or bflb_utils.get_session()
+        return session is not None and session.cancelled()
+
     def if_write(self, data_send):
-        if self._ser:
+        if self._ser and not self._cancelled():
             self._ser.write(data_send)
 
     def if_raw_read(self):
@@ -193,6 +200,8 @@ class BflbUartPort(object):
     def if_read(self, data_len):
         data = bytearray(0)
         received = 0
+        if self._cancelled():
+            return 0, data
         if self._ser:
             try:
                 while received < data_len:
@@ -433,8 +442,12 @@ class BflbUartPort(object):
                         bflb_utils.printf("power on tx and rx")
                         time.sleep(0.1)
                     else:
-                        self._ser.setDTR(0)
-                        bflb_utils.printf("default set DTR high")
+                        try:
+                            self._ser.setDTR(0)
+                            bflb_utils.printf("default set DTR high")
+                        except (IOError, OSError):
+                            # pty has no modem control lines
+                            pass
                         time.sleep(0.1)
                     if do_reset is True and blusbserialwriteflag is not True:
                         # MP_TOOL_V3 reset high to make boot pin high
@@ -765,7 +778,10 @@ class BflbUartPort(object):
     def if_close(self):
         if self._ser:
             try:
-                self._ser.setDTR(1)
+                try:
+                    self._ser.setDTR(1)
+                except (IOError, OSError):
+                    pass
                 self._ser.close()
                 self._ser = None
             except Exception as e:
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+#  Copyright (C) 2016- BOUFFALO LAB (NANJING) CO., LTD.
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+import os
+import json
+import time
+import bisect
+
+from libs import bflb_utils
+
+# upper bounds of the latency histogram buckets, the last bucket is +Inf
+LATENCY_BUCKETS_MS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+class BflbCmdStat(object):
+    __slots__ = ("count", "retries", "tx_bytes", "rx_bytes", "latency_sum", "latency_max", "buckets", "errors")
+
+    def __init__(self):
+        self.count = 0
+        self.retries = 0
+        self.tx_bytes = 0
+        self.rx_bytes = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.errors = {}
+
+    def percentile(self, percent):
+        # estimated from the bucket upper bounds
+        target = self.count * percent / 100.0
+        total = 0
+        for i, num in enumerate(self.buckets):
+            total += num
+            if num and total >= target:
+                if i < len(LATENCY_BUCKETS_MS):
+                    return min(LATENCY_BUCKETS_MS[i], self.latency_max)
+                return self.latency_max
+        return 0.0
+
+
+class BflbCmdMetrics(object):
+    # per command counters of one job, kept in plain python types so that
+    # recording a command costs a dict lookup and a bisect
+    def __init__(self):
+        self._stats = {}
+        self.start_time = time.time()
+
+    def reset(self):
+        self._stats.clear()
+        self.start_time = time.time()
+
+    def record(self, layer, cmd, latency, tx_bytes, rx_bytes, res, retries=0):
+        key = (layer, cmd)
+        stat = self._stats.get(key)
+        if stat is None:
+            stat = BflbCmdStat()
+            self._stats[key] = stat
+        latency_ms = latency * 1000
+        stat.count += 1
+        stat.retries += retries
+        stat.tx_bytes += tx_bytes
+        stat.rx_bytes += rx_bytes
+        stat.latency_sum += latency_ms
+        if latency_ms > stat.latency_max:
+            stat.latency_max = latency_ms
+        stat.buckets[bisect.bisect_left(LATENCY_BUCKETS_MS, latency_ms)] += 1
+        if not res or not (res.startswith("OK") or res.startswith("PD")):
+            if res and res.startswith("FL") and len(res) >= 6:
+                code = res[2:6]
+            else:
+                code = res[0:2] if res else "none"
+            stat.errors[code] = stat.errors.get(code, 0) + 1
+
+    def to_dict(self):
+        commands = []
+        for (layer, cmd), stat in sorted(self._stats.items()):
+            commands.append(
+                {
+                    "layer": layer,
+                    "cmd": cmd,
+                    "count": stat.count,
+                    "retries": stat.retries,
+                    "tx_bytes": stat.tx_bytes,
+                    "rx_bytes": stat.rx_bytes,
+                    "latency_sum_ms": round(stat.latency_sum, 3),
+                    "latency_max_ms": round(stat.latency_max, 3),
+                    "buckets": list(stat.buckets),
+                    "errors": dict(stat.errors),
+                }
+            )
+        return {
+            "start_time": self.start_time,
+            "duration": round(time.time() - self.start_time, 3),
+            "buckets_ms": list(LATENCY_BUCKETS_MS),
+            "commands": commands,
+        }
+
+    def merge(self, data):
+        # add the counters of another job, data comes from to_dict()
+        if list(data.get("buckets_ms", [])) != list(LATENCY_BUCKETS_MS):
+            bflb_utils.printf("metrics bucket layout mismatch, skip merge")
+            return False
+        for item in data["commands"]:
+            key = (item["layer"], item["cmd"])
+            stat = self._stats.get(key)
+            if stat is None:
+                stat = BflbCmdStat()
+                self._stats[key] = stat
+            stat.count += item["count"]
+            stat.retries += item["retries"]
+            stat.tx_bytes += item["tx_bytes"]
+            stat.rx_bytes += item["rx_bytes"]
+            stat.latency_sum += item["latency_sum_ms"]
+            stat.latency_max = max(stat.latency_max, item["latency_max_ms"])
+            for i, num in enumerate(item["buckets"]):
+                stat.buckets[i] += num
+            for code, num in item["errors"].items():
+                stat.errors[code] = stat.errors.get(code, 0) + num
+        return True
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=1)
+
+    def to_prometheus(self, labels=None):
+        extra = ""
+        if labels:
+            extra = "".join([',%s="%s"' % (key, value) for key, value in sorted(labels.items())])
+        lines = [
+            "# HELP bflb_cmd_latency_ms command round trip latency",
+            "# TYPE bflb_cmd_latency_ms histogram",
+        ]
+        counters = []
+        for (layer, cmd), stat in sorted(self._stats.items()):
+            label = 'layer="%s",cmd="%s"%s' % (layer, cmd, extra)
+            total = 0
+            for i, num in enumerate(stat.buckets):
+                total += num
+                le = str(LATENCY_BUCKETS_MS[i]) if i < len(LATENCY_BUCKETS_MS) else "+Inf"
+                lines.append('bflb_cmd_latency_ms_bucket{%s,le="%s"} %d' % (label, le, total))
+            lines.append("bflb_cmd_latency_ms_sum{%s} %.3f" % (label, stat.latency_sum))
+            lines.append("bflb_cmd_latency_ms_count{%s} %d" % (label, stat.count))
+            counters.append(("bflb_cmd_tx_bytes_total", label, stat.tx_bytes))
+            counters.append(("bflb_cmd_rx_bytes_total", label, stat.rx_bytes))
+            counters.append(("bflb_cmd_retries_total", label, stat.retries))
+            for code, num in sorted(stat.errors.items()):
+                counters.append(("bflb_cmd_errors_total", label + ',code="%s"' % code, num))
+        for name in ("bflb_cmd_tx_bytes_total", "bflb_cmd_rx_bytes_total", "bflb_cmd_retries_total"):
+            lines.append("# TYPE %s counter" % name)
+            lines.extend(["%s{%s} %d" % (item[0], item[1], item[2]) for item in counters if item[0] == name])
+        lines.append("# TYPE bflb_cmd_errors_total counter")
+        lines.extend(["%s{%s} %d" % item for item in counters if item[0] == "bflb_cmd_errors_total"])
+        return "\n".join(lines) + "\n"
+
+    def save(self, path, labels=None):
+        # the file extension selects the format, .prom or .json
+        try:
+            dirname = os.path.dirname(path)
+            if dirname and not os.path.exists(dirname):
+                os.makedirs(dirname)
+            if path.endswith(".prom"):
+                data = self.to_prometheus(labels)
+            else:
+                data = self.to_json()
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as fp:
+                fp.write(data)
+            os.replace(tmp_path, path)
+            return True
+        except Exception as e:
+            bflb_utils.printf("save metrics failed: ", e)
+            return False
+
+    def report(self):
+        if not self._stats:
+            return
+        bflb_utils.printf(
+            "%-32s %6s %7s %9s %9s %9s %10s %s"
+            % ("cmd", "count", "retry", "avg(ms)", "p95(ms)", "max(ms)", "bytes", "errors")
+        )
+        for (layer, cmd), stat in sorted(self._stats.items()):
+            errors = ",".join(["%s:%d" % (code, num) for code, num in sorted(stat.errors.items())])
+            bflb_utils.printf(
+                "%-32s %6d %7d %9.2f %9.2f %9.2f %10d %s"
+                % (
+                    layer + "." + cmd,
+                    stat.count,
+                    stat.retries,
+                    stat.latency_sum / stat.count,
+                    stat.percentile(95),
+                    stat.latency_max,
+                    stat.tx_bytes + stat.rx_bytes,
+                    errors,
+                )
+            )
@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+#  Copyright (C) 2016- BOUFFALO LAB (NANJING) CO., LTD.
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+import re
+import sys
+import lzma
+import time
+import struct
+import random
+import argparse
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from libs import bflb_utils
+from libs.bflb_utils import swap_rd_rs2, read32le, write32le
+
+# first byte of a jal (0xEF) or auipc (0x17/0x97) instruction
+riscv_candidate_re = re.compile(b"[\x17\x97\xef]")
+
+
+def riscv_code_reference(buffer, size, now_pos, is_encoder):
+    # byte by byte filter, kept as the reference for the faster versions
+    i = 0
+    while i + 8 <= size:
+        pc = now_pos + i
+        inst = read32le(buffer, i)
+        if (inst & 0xDFF) == 0x0EF:
+            addr = (
+                ((inst & 0x80000000) >> 11)
+                | ((inst & 0x7FE00000) >> 20)
+                | ((inst & 0x00100000) >> 9)
+                | (inst & 0x000FF000)
+            )
+            if not is_encoder:
+                pc = 0 - pc
+            addr += pc
+            inst &= 0xFFF
+            inst |= ((addr & 0x100000) << 11) | ((addr & 0x0007FE) << 20) | ((addr & 0x000800) << 9) | (addr & 0x0FF000)
+            write32le(buffer, i, inst)
+            i += 2
+        elif (inst & 0x7F) == 0x17:
+            inst2 = read32le(buffer, i + 4)
+            if not ((inst2 & 0x5B) == 0x03 or (inst2 & 0x707F) == 0x67 or (inst2 & 0x707F) == 0x13):
+                i += 8
+                continue
+            auipc_rd = (inst >> 7) & 0x1F
+            inst2_rs1 = (inst2 >> 15) & 0x1F
+            if auipc_rd != inst2_rs1:
+                i += 8
+                continue
+            is_s_type = (inst2 & 0x7B) == 0x23
+            if is_encoder and is_s_type:
+                inst2 = swap_rd_rs2(inst2)
+            if not is_s_type:
+                inst2_rd = (inst2 >> 7) & 0x1F
+                inst ^= inst2_rd << 7
+                inst2 ^= inst2_rd << 15
+            addr = (inst & 0xFFFFF000) + (inst2 >> 20) - ((inst2 >> 19) & 0x1000)
+            if not is_encoder:
+                pc = 0 - pc
+            addr += pc
+            inst &= 0xFFF
+            inst |= (addr + ((addr << 1) & 0x1000)) & 0xFFFFF000
+            inst2 &= 0x000FFFFF
+            inst2 |= addr << 20
+            if not is_encoder and is_s_type:
+                inst2 = swap_rd_rs2(inst2)
+            write32le(buffer, i, inst)
+            write32le(buffer, i + 4, inst2)
+            i += 6
+        i += 2
+    return i
+
+
+def riscv_auipc_accept(inst, inst2):
+    if not ((inst2 & 0x5B) == 0x03 or (inst2 & 0x707F) == 0x67 or (inst2 & 0x707F) == 0x13):
+        return False
+    return ((inst >> 7) & 0x1F) == ((inst2 >> 15) & 0x1F)
+
+
+def riscv_walk(positions, is_jal, size):
+    # the filter only moves forward in steps of 2, 4 (jal) or 8 (auipc), so the
+    # visited instructions are found by walking the candidate list alone
+    jal_list = []
+    auipc_list = []
+    cur = 0
+    for index, pos in enumerate(positions):
+        if pos < cur:
+            continue
+        if is_jal[index]:
+            jal_list.append(pos)
+            cur = pos + 4
+        else:
+            auipc_list.append(pos)
+            cur = pos + 8
+    if cur + 8 <= size:
+        cur += ((size - 8 - cur) // 2 + 1) * 2
+    return jal_list, auipc_list, cur
+
+
+def riscv_code_python(buffer, size, now_pos, is_encoder):
+    # candidates are found with a C level regex scan, only they are decoded
+    data = bytes(buffer[:size])
+    positions = []
+    is_jal = []
+    for match in riscv_candidate_re.finditer(data, 0, max(size - 7, 0)):
+        pos = match.start()
+        if pos & 1:
+            continue
+        if data[pos] == 0xEF:
+            if data[pos + 1] & 0x0D:
+                continue
+            positions.append(pos)
+            is_jal.append(True)
+        else:
+            positions.append(pos)
+            is_jal.append(False)
+    jal_list, auipc_list, end = riscv_walk(positions, is_jal, size)
+    sign = 1 if is_encoder else -1
+    for pos in jal_list:
+        (inst,) = struct.unpack_from("<I", data, pos)
+        addr = (
+            ((inst & 0x80000000) >> 11)
+            | ((inst & 0x7FE00000) >> 20)
+            | ((inst & 0x00100000) >> 9)
+            | (inst & 0x000FF000)
+        )
+        addr += sign * (now_pos + pos)
+        inst &= 0xFFF
+        inst |= ((addr & 0x100000) << 11) | ((addr & 0x0007FE) << 20) | ((addr & 0x000800) << 9) | (addr & 0x0FF000)
+        struct.pack_into("<I", buffer, pos, inst & 0xFFFFFFFF)
+    for pos in auipc_list:
+        inst, inst2 = struct.unpack_from("<II", data, pos)
+        if not riscv_auipc_accept(inst, inst2):
+            continue
+        inst, inst2 = riscv_auipc_fix(inst, inst2, sign * (now_pos + pos), is_encoder)
+        struct.pack_into("<II", buffer, pos, inst, inst2)
+    return end
+
+
+def riscv_auipc_fix(inst, inst2, pc, is_encoder):
+    is_s_type = (inst2 & 0x7B) == 0x23
+    if is_encoder and is_s_type:
+        inst2 = swap_rd_rs2(inst2)
+    if not is_s_type:
+        inst2_rd = (inst2 >> 7) & 0x1F
+        inst ^= inst2_rd << 7
+        inst2 ^= inst2_rd << 15
+    addr = (inst & 0xFFFFF000) + (inst2 >> 20) - ((inst2 >> 19) & 0x1000)
+    addr += pc
+    inst &= 0xFFF
+    inst |= (addr + ((addr << 1) & 0x1000)) & 0xFFFFF000
+    inst2 &= 0x000FFFFF
+    inst2 |= addr << 20
+    if not is_encoder and is_s_type:
+        inst2 = swap_rd_rs2(inst2)
+    return inst & 0xFFFFFFFF, inst2 & 0xFFFFFFFF
+
+
+def riscv_code_numpy(buffer, size, now_pos, is_encoder):
+    # candidate search, auipc pair check and fix up run as array operations,
+    # only the walk over the candidates is a python loop
+    if size < 8:
+        return 0
+    data = np.frombuffer(bytes(buffer[:size]), dtype=np.uint8)
+    b0 = data[0 : size - 7 : 2]
+    b1 = data[1 : size - 6 : 2]
+    jal = (b0 == 0xEF) & ((b1 & 0x0D) == 0)
+    auipc = (b0 & 0x7F) == 0x17
+    positions = np.flatnonzero(jal | auipc) * 2
+    jal_list, auipc_list, end = riscv_walk(positions.tolist(), jal[positions // 2].tolist(), size)
+    out = np.frombuffer(buffer, dtype=np.uint8)
+    sign = 1 if is_encoder else -1
+
+    def read32(pos):
+        return (
+            data[pos].astype(np.int64)
+            | (data[pos + 1].astype(np.int64) << 8)
+            | (data[pos + 2].astype(np.int64) << 16)
+            | (data[pos + 3].astype(np.int64) << 24)
+        )
+
+    def write32(pos, value):
+        value = value & 0xFFFFFFFF
+        for k in range(4):
+            out[pos + k] = (value >> (8 * k)) & 0xFF
+
+    if jal_list:
+        pos = np.array(jal_list, dtype=np.int64)
+        inst = read32(pos)
+        addr = (
+            ((inst & 0x80000000) >> 11)
+            | ((inst & 0x7FE00000) >> 20)
+            | ((inst & 0x00100000) >> 9)
+            | (inst & 0x000FF000)
+        )
+        addr += sign * (now_pos + pos)
+        inst = (inst & 0xFFF) | (
+            ((addr & 0x100000) << 11) | ((addr & 0x0007FE) << 20) | ((addr & 0x000800) << 9) | (addr & 0x0FF000)
+        )
+        write32(pos, inst)
+    if auipc_list:
+        pos = np.array(auipc_list, dtype=np.int64)
+        inst = read32(pos)
+        inst2 = read32(pos + 4)
+        accept = (
+            ((inst2 & 0x5B) == 0x03) | ((inst2 & 0x707F) == 0x67) | ((inst2 & 0x707F) == 0x13)
+        ) & (((inst >> 7) & 0x1F) == ((inst2 >> 15) & 0x1F))
+        pos, inst, inst2 = pos[accept], inst[accept], inst2[accept]
+        is_s_type = (inst2 & 0x7B) == 0x23
+        if is_encoder:
+            inst2 = np.where(is_s_type, numpy_swap_rd_rs2(inst2), inst2)
+        inst2_rd = np.where(is_s_type, 0, (inst2 >> 7) & 0x1F)
+        inst ^= inst2_rd << 7
+        inst2 ^= inst2_rd << 15
+        addr = (inst & 0xFFFFF000) + (inst2 >> 20) - ((inst2 >> 19) & 0x1000)
+        addr += sign * (now_pos + pos)
+        inst = (inst & 0xFFF) | ((addr + ((addr << 1) & 0x1000)) & 0xFFFFF000)
+        inst2 = (inst2 & 0x000FFFFF) | ((addr << 20) & 0xFFFFFFFF)
+        if not is_encoder:
+            inst2 = np.where(is_s_type, numpy_swap_rd_rs2(inst2), inst2)
+        write32(pos, inst)
+        write32(pos + 4, inst2)
+    return end
+
+
+def numpy_swap_rd_rs2(inst):
+    rd = (inst >> 7) & 0x1F
+    rs2 = (inst >> 20) & 0x1F
+    return (inst & 0xFE0FF07F) | (rd << 20) | (rs2 << 7)
+
+
+def riscv_code(buffer, size, now_pos, is_encoder, use_numpy=None):
+    if use_numpy is None:
+        use_numpy = np is not None
+    if use_numpy:
+        return riscv_code_numpy(buffer, size, now_pos, is_encoder)
+    return riscv_code_python(buffer, size, now_pos, is_encoder)
+
+
+class BflbRiscvCoder(object):
+    # streaming filter, update() returns the bytes that are final and keeps
+    # the unfinished tail (at most 7 bytes) for the next chunk
+    def __init__(self, is_encoder=True, now_pos=0, use_numpy=None):
+        self._is_encoder = is_encoder
+        self._now_pos = now_pos
+        self._use_numpy = use_numpy
+        self._buffer = bytearray()
+
+    def update(self, data):
+        self._buffer += data
+        end = riscv_code(self._buffer, len(self._buffer), self._now_pos, self._is_encoder, self._use_numpy)
+        out = bytes(self._buffer[:end])
+        del self._buffer[:end]
+        self._now_pos += end
+        return out
+
+    def flush(self):
+        out = bytes(self._buffer)
+        self._now_pos += len(out)
+        self._buffer = bytearray()
+        return out
+
+
+def riscv_xz_compress_stream(chunks, filters=None, check=lzma.CHECK_CRC32):
+    # bcj filtered data is fed to the compressor chunk by chunk
+    if filters is None:
+        filters = [{"id": lzma.FILTER_LZMA2, "dict_size": 32768}]
+    coder = BflbRiscvCoder(True)
+    compressor = lzma.LZMACompressor(check=check, filters=filters)
+    for chunk in chunks:
+        data = compressor.compress(coder.update(chunk))
+        if data:
+            yield data
+    yield compressor.compress(coder.flush()) + compressor.flush()
+
+
+def riscv_test_data(size, seed=0):
+    # random 16/32 bit instruction stream with jal and auipc pairs mixed in
+    rnd = random.Random(seed)
+    data = bytearray()
+    while len(data) < size:
+        kind = rnd.random()
+        if kind < 0.05:
+            data += struct.pack("<I", (rnd.getrandbits(20) << 12) | (rnd.getrandbits(5) << 7) | 0xEF)
+        elif kind < 0.10:
+            rd = rnd.getrandbits(5)
+            data += struct.pack("<I", (rnd.getrandbits(20) << 12) | (rd << 7) | 0x17)
+            op = rnd.choice((0x03, 0x13, 0x67, 0x23))
+            data += struct.pack(
+                "<I", (rnd.getrandbits(12) << 20) | (rd << 15) | (rnd.getrandbits(3) << 12) | (rnd.getrandbits(5) << 7) | op
+            )
+        elif kind < 0.5:
+            data += struct.pack("<H", rnd.getrandbits(16) & 0xFFFC)
+        else:
+            data += struct.pack("<I", rnd.getrandbits(32) | 0x3)
+    return bytearray(data[:size])
+
+
+def benchmark(data, chunk_size=65536):
+    results = []
+    for is_encoder in (True, False):
+        name = "encode" if is_encoder else "decode"
+        ref = bytearray(data)
+        start = time.time()
+        ref_end = riscv_code_reference(ref, len(ref), 0, is_encoder)
+        ref_cost = time.time() - start
+        results.append((name + " reference", ref_cost, True))
+        impls = [("python", False)]
+        if np is not None:
+            impls.append(("numpy", True))
+        for impl, use_numpy in impls:
+            buf = bytearray(data)
+            start = time.time()
+            end = riscv_code(buf, len(buf), 0, is_encoder, use_numpy)
+            cost = time.time() - start
+            results.append((name + " " + impl, cost, buf == ref and end == ref_end))
+            coder = BflbRiscvCoder(is_encoder, use_numpy=use_numpy)
+            out = bytearray()
+            start = time.time()
+            for i in range(0, len(data), chunk_size):
+                out += coder.update(data[i : i + chunk_size])
+            out += coder.flush()
+            cost = time.time() - start
+            results.append((name + " " + impl + " stream", cost, out == ref))
+    bflb_utils.printf("========= riscv bcj benchmark =========")
+    bflb_utils.printf("size: %d, numpy: %s" % (len(data), np is not None))
+    bflb_utils.printf("%-28s%12s%12s%10s" % ("function", "time(ms)", "MB/s", "same"))
+    for name, cost, same in results:
+        speed = len(data) / cost / 1024 / 1024 if cost > 0 else 0
+        bflb_utils.printf("%-28s%12.1f%12.1f%10s" % (name, cost * 1000, speed, "yes" if same else "NO"))
+    return all([item[2] for item in results])
+
+
+def run(argv):
+    parser = argparse.ArgumentParser(description="riscv bcj filter benchmark")
+    parser.add_argument("--file", dest="file", help="riscv image to filter, default is generated data")
+    parser.add_argument("--size", dest="size", default=4 * 1024 * 1024, type=int, help="generated data size")
+    parser.add_argument("--chunk", dest="chunk", default=65536, type=int, help="stream chunk size")
+    args = parser.parse_args(argv)
+    if args.file:
+        with open(args.file, "rb") as fp:
+            data = bytearray(fp.read())
+    else:
+        data = riscv_test_data(args.size)
+    return benchmark(data, args.chunk)
+
+
+if __name__ == "__main__":
+    sys.exit(0 if run(sys.argv[1:]) else 1)
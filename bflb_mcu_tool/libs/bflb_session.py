@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+#  Copyright (C) 2016- BOUFFALO LAB (NANJING) CO., LTD.
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+
+import os
+import functools
+import threading
+import contextlib
+import collections
+
+from libs import bflb_utils
+from libs import bflb_metrics
+from libs.bflb_utils import app_path
+
+
+class BflbSession(object):
+    # state of one device job: log, error code, command metrics and the device
+    # it talks to. activate() binds the session to the calling thread, printf,
+    # set_error_code and local_log_* of everything running under the job then
+    # use it instead of the module globals of bflb_utils, so jobs for several
+    # devices can run on threads of one process
+    def __init__(self, name="", listener=None, udp_client=None, cmd_metrics=None):
+        self.name = name
+        # called with every log line of the job
+        self.listener = listener
+        # udp address the log is sent to when the udp log is enabled
+        self.udp_client = udp_client
+        if cmd_metrics is None:
+            cmd_metrics = bflb_metrics.BflbCmdMetrics()
+        self.metrics = cmd_metrics
+        self.error_code = "FFFF"
+        # device identity, filled in by the interface and the loader
+        self.port = ""
+        self.chipid = None
+        self.macaddr = ""
+        self.log_en = True
+        self.log_data = collections.deque()
+        self._log_spill = None
+        self._log_spill_lock = threading.Lock()
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        # asks the job to stop, may be called from any thread. the uart
+        # interface fails every transfer of a cancelled job, so the loader
+        # leaves through its normal error paths
+        self._cancelled.set()
+
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def set_error_code(self, num_str):
+        # the first error of the job is kept, "FFFF" starts over
+        if self.error_code == "FFFF" or num_str == "FFFF":
+            self.error_code = num_str
+
+    def get_error_code_msg(self):
+        return "ErrorCode: " + self.error_code + ", ErrorMsg: " + bflb_utils.eflash_loader_error_code[self.error_code]
+
+    def log(self, data):
+        if self.log_en is True:
+            self.log_data.append(data)
+            if len(self.log_data) > bflb_utils.local_log_limit:
+                self._log_evict()
+        if self.listener is not None:
+            self.listener(data.strip())
+
+    def _log_evict(self):
+        if self._log_spill is None:
+            with self._log_spill_lock:
+                if self._log_spill is None:
+                    try:
+                        self._log_spill = bflb_utils.LocalLogSpill(os.path.join(app_path, "log"))
+                    except Exception as e:
+                        print(e)
+        while len(self.log_data) > bflb_utils.local_log_limit:
+            try:
+                line = self.log_data.popleft()
+            except IndexError:
+                break
+            if self._log_spill is not None:
+                self._log_spill.put(line)
+
+    def log_clear(self):
+        spill = self._log_spill
+        self._log_spill = None
+        self.log_data.clear()
+        if spill is not None:
+            try:
+                os.remove(spill.close())
+            except OSError:
+                pass
+
+    def log_enable(self, en=False):
+        self.log_en = en is True
+        if not self.log_en:
+            self.log_clear()
+
+    def log_save(self, local_path="log", key_word=""):
+        if self.log_en is True:
+            spill = self._log_spill
+            self._log_spill = None
+            bflb_utils.local_log_write(os.path.join(app_path, local_path), key_word, spill, list(self.log_data))
+        self.log_clear()
+
+    @contextlib.contextmanager
+    def activate(self):
+        prev = bflb_utils.set_session(self)
+        try:
+            yield self
+        finally:
+            bflb_utils.set_session(prev)
+
+
+def bind_session(func):
+    # method decorator, runs the method with self._session bound to the thread
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        session = self._session
+        if session is None or bflb_utils.get_session() is session:
+            return func(self, *args, **kwargs)
+        with session.activate():
+            return func(self, *args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+#  Copyright (C) 2016- BOUFFALO LAB (NANJING) CO., LTD.
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+# cli entry points and the budget their cold import has to stay within
+STARTUP_TARGETS = ["core.bflb_mcu_tool", "libs.bflb_eflash_loader"]
+STARTUP_BUDGET_MS = 150
+
+app_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_importtime(output):
+    # "import time: self [us] | cumulative | imported package" lines of -X importtime
+    result = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        fields = line[len("import time:") :].split("|")
+        if len(fields) != 3:
+            continue
+        name = fields[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        result.append((name.strip(), depth, int(fields[0]), int(fields[1])))
+    return result
+
+
+def measure(target):
+    env = dict(os.environ)
+    # a cold start of an installed tool still has its bytecode cached
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    code = "import sys; sys.path.insert(0, %r); import %s" % (app_path, target)
+    start = time.time()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=app_path,
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    wall = (time.time() - start) * 1000
+    if proc.returncode != 0:
+        raise RuntimeError("import %s failed:\n%s" % (target, proc.stderr[-2000:]))
+    entries = parse_importtime(proc.stderr)
+    cost = 0
+    for name, depth, self_us, cumulative_us in entries:
+        if name == target and depth == 0:
+            cost = cumulative_us / 1000
+    return cost, wall, entries
+
+
+def run(argv):
+    parser = argparse.ArgumentParser(description="cli startup time benchmark")
+    parser.add_argument("--target", dest="targets", action="append", help="module to import, can be repeated")
+    parser.add_argument("--budget", dest="budget", default=STARTUP_BUDGET_MS, type=float, help="budget in ms")
+    parser.add_argument("--repeat", dest="repeat", default=5, type=int, help="runs per target, median is used")
+    parser.add_argument("--top", dest="top", default=10, type=int, help="slowest imports listed per target")
+    args = parser.parse_args(argv)
+    ok = True
+    for target in args.targets or STARTUP_TARGETS:
+        # first run writes the bytecode cache and is not counted
+        measure(target)
+        costs = []
+        walls = []
+        for i in range(args.repeat):
+            cost, wall, entries = measure(target)
+            costs.append(cost)
+            walls.append(wall)
+        cost = sorted(costs)[len(costs) // 2]
+        wall = sorted(walls)[len(walls) // 2]
+        state = "ok" if cost <= args.budget else "OVER BUDGET"
+        print("%s: import %.1f ms, process %.1f ms, budget %.1f ms %s" % (target, cost, wall, args.budget, state))
+        entries = sorted(entries, key=lambda item: item[3], reverse=True)
+        for name, depth, self_us, cumulative_us in entries[: args.top]:
+            print("    %-48s%10.1f%10.1f" % (name, self_us / 1000, cumulative_us / 1000))
+        if cost > args.budget:
+            ok = False
+    return ok
+
+
+if __name__ == "__main__":
+    sys.exit(0 if run(sys.argv[1:]) else 1)
@@ -29,31 +29,17 @@ import struct
 import random
 import socket
 import threading
-import datetime
 import hashlib
 import argparse
 import traceback
 import platform
 import codecs
+import queue
+import atexit
+import tempfile
+import collections
 from glob import glob
 
-import pylink
-from serial import Serial
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.primitives import padding, hashes, serialization
-
-try:
-    from PySide2 import QtCore
-
-    qt_sign = True
-except ImportError:
-    qt_sign = False
-
-try:
-    from serial.tools.list_ports import comports
-except ImportError:
-    pass
-
 # Get app path
 if getattr(sys, "frozen", False):
     app_path = os.path.dirname(sys.executable)
@@ -83,10 +69,28 @@ udp_clinet_dict = {}
 udp_send_log = False
 udp_log_local_echo = False
 udp_socket_server = None
+# thread id -> function taking each log line, lets a job stream its own log
+log_listener_dict = {}
+# BflbSession of the job running on a thread (libs/bflb_session.py), its log,
+# error code and udp client are used instead of the module globals below
+session_local = threading.local()
 error_code_num = "FFFF"
 error_code_num_task = ["FFFF"] * 66
 local_log_en = True
-local_log_data = ""
+# lines kept in memory, older lines are spilled to disk by a writer thread
+local_log_data = collections.deque()
+local_log_limit = 20000
+local_log_spill = None
+local_log_spill_lock = threading.Lock()
+
+LOG_DEBUG = 10
+LOG_INFO = 20
+LOG_WARNING = 30
+LOG_ERROR = 40
+log_level = LOG_INFO
+log_level_names = {"debug": LOG_DEBUG, "info": LOG_INFO, "warning": LOG_WARNING, "error": LOG_ERROR}
+log_time_cache = (-1, "")
+replace_name_cache = [None, None]
 
 # all in hex mode
 if conf_sign:
@@ -459,56 +463,10 @@ def read32le(buf, index):
 
 
 def riscv_code(buffer, size, now_pos, is_encoder):
-    i = 0
-    while i + 8 <= size:
-        pc = now_pos + i
-        inst = read32le(buffer, i)
-        if (inst & 0xDFF) == 0x0EF:
-            addr = (
-                ((inst & 0x80000000) >> 11)
-                | ((inst & 0x7FE00000) >> 20)
-                | ((inst & 0x00100000) >> 9)
-                | (inst & 0x000FF000)
-            )
-            if not is_encoder:
-                pc = 0 - pc
-            addr += pc
-            inst &= 0xFFF
-            inst |= ((addr & 0x100000) << 11) | ((addr & 0x0007FE) << 20) | ((addr & 0x000800) << 9) | (addr & 0x0FF000)
-            write32le(buffer, i, inst)
-            i += 2
-        elif (inst & 0x7F) == 0x17:
-            inst2 = read32le(buffer, i + 4)
-            if not ((inst2 & 0x5B) == 0x03 or (inst2 & 0x707F) == 0x67 or (inst2 & 0x707F) == 0x13):
-                i += 8
-                continue
-            auipc_rd = (inst >> 7) & 0x1F
-            inst2_rs1 = (inst2 >> 15) & 0x1F
-            if auipc_rd != inst2_rs1:
-                i += 8
-                continue
-            is_s_type = (inst2 & 0x7B) == 0x23
-            if is_encoder and is_s_type:
-                inst2 = swap_rd_rs2(inst2)
-            if not is_s_type:
-                inst2_rd = (inst2 >> 7) & 0x1F
-                inst ^= inst2_rd << 7
-                inst2 ^= inst2_rd << 15
-            addr = (inst & 0xFFFFF000) + (inst2 >> 20) - ((inst2 >> 19) & 0x1000)
-            if not is_encoder:
-                pc = 0 - pc
-            addr += pc
-            inst &= 0xFFF
-            inst |= (addr + ((addr << 1) & 0x1000)) & 0xFFFFF000
-            inst2 &= 0x000FFFFF
-            inst2 |= addr << 20
-            if not is_encoder and is_s_type:
-                inst2 = swap_rd_rs2(inst2)
-            write32le(buffer, i, inst)
-            write32le(buffer, i + 4, inst2)
-            i += 6
-        i += 2
-    return i
+    # the filter lives in bflb_riscv_bcj, numpy is used when it is installed
+    from libs import bflb_riscv_bcj
+
+    return bflb_riscv_bcj.riscv_code(buffer, size, now_pos, is_encoder)
 
 
 def riscv_encode(bytedata):
@@ -529,75 +487,246 @@ def convert_path(path: str) -> str:
     return path.replace(r"\/".replace(os.sep, ""), os.sep)
 
 
-def printf(*args):
-    data = ""
-    for arg in args:
-        data += str(arg)
+class LocalLogSpill(object):
+    def __init__(self, log_dir):
+        if not os.path.exists(log_dir):
+            os.makedirs(log_dir)
+        fd, self.path = tempfile.mkstemp(prefix="spill_", suffix=".tmp", dir=log_dir)
+        self._fp = os.fdopen(fd, "w", encoding="utf-8")
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._write_thread, daemon=True)
+        self._thread.start()
+
+    def put(self, line):
+        self._queue.put(line)
+
+    def _write_thread(self):
+        running = True
+        while running:
+            lines = [self._queue.get()]
+            while True:
+                try:
+                    lines.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in lines:
+                lines = lines[: lines.index(None)]
+                running = False
+            if lines:
+                self._fp.write("\n".join(lines) + "\n")
+        self._fp.close()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        return self.path
+
+
+def set_log_level(level):
+    global log_level
+    if isinstance(level, str):
+        level = log_level_names.get(level.lower(), LOG_INFO)
+    log_level = level
+
+
+def log_time():
+    # the time string only changes once per second
+    global log_time_cache
+    now = time.time()
+    sec = int(now)
+    cache = log_time_cache
+    if cache[0] != sec:
+        cache = (sec, time.strftime("[%H:%M:%S", time.localtime(sec)))
+        log_time_cache = cache
+    return "%s.%03d] - " % (cache[1], int((now - sec) * 1000))
+
+
+def replace_name(data):
+    # only run the replace list on lines that contain one of the names
+    if replace_name_cache[0] is not cgc.replace_name_list:
+        keys = "|".join([re.escape(key) for key in cgc.replace_name_list.keys()])
+        replace_name_cache[1] = re.compile(keys) if keys else None
+        replace_name_cache[0] = cgc.replace_name_list
+    if replace_name_cache[1] is None or replace_name_cache[1].search(data) is None:
+        return data
+    for key, value in cgc.replace_name_list.items():
+        data = data.replace(key, value)
+    return data
+
+
+def get_qt_module(name):
+    # qt is only used when the gui has already loaded it, the cli never imports it
+    for binding in ("PySide2", "PySide6"):
+        module = sys.modules.get(binding + "." + name)
+        if module is not None:
+            return module
+    return None
+
+
+def printf(*args, level=LOG_INFO):
+    if level < log_level:
+        return
+    if len(args) == 1:
+        data = str(args[0])
+    else:
+        data = "".join([str(arg) for arg in args])
     # print(data.title())
     # print(data.capitalize())
     if data:
         if conf_sign:
-            for key, value in cgc.replace_name_list.items():
-                data = data.replace(key, value)
-        now_time = datetime.datetime.now().strftime("[%H:%M:%S.%f")[:-3] + "] - "
-        data = now_time + data
-
-        # save log
-        global local_log_en
-        global local_log_data
-        if local_log_en is True:
-            local_log_data += data + "\n"
+            data = replace_name(data)
+        data = log_time() + data
+
+        session = get_session()
+        if session is not None:
+            session.log(data)
         else:
-            local_log_data = ""
+            # save log
+            if local_log_en is True:
+                local_log_data.append(data)
+                if len(local_log_data) > local_log_limit:
+                    local_log_evict()
+
+            if log_listener_dict:
+                listener = log_listener_dict.get(str(threading.get_ident()))
+                if listener is not None:
+                    listener(data.strip())
 
         if udp_send_log:
             tid = str(threading.get_ident())
             if udp_log_local_echo:
                 print("[{0}]{1}".format(tid, data.strip()))
             try:
-                if tid in udp_clinet_dict:
-                    udp_socket_server.sendto((data.strip() + "\r\n").encode("utf-8"), udp_clinet_dict[tid])  # .lower()
+                udp_client = udp_clinet_dict.get(tid)
+                if session is not None and session.udp_client is not None:
+                    udp_client = session.udp_client
+                if udp_client is not None:
+                    udp_socket_server.sendto((data.strip() + "\r\n").encode("utf-8"), udp_client)  # .lower()
             except Exception as e:
                 print(e)
         else:
-            if qt_sign and QtCore.QThread.currentThread().objectName():
-                print("[Task{0}]{1}".format(QtCore.QThread.currentThread().objectName(), data.strip()))
+            qt_core = get_qt_module("QtCore")
+            if qt_core is not None and qt_core.QThread.currentThread().objectName():
+                print("[Task{0}]{1}".format(qt_core.QThread.currentThread().objectName(), data.strip()))
             else:
                 print(data.strip())
     sys.stdout.flush()
 
 
+def logf(level, fmt, *args):
+    # the message is only formatted if the level passes the filter
+    if level < log_level:
+        return
+    if args:
+        fmt = fmt % args
+    printf(fmt, level=level)
+
+
+def local_log_evict():
+    global local_log_spill
+    if local_log_spill is None:
+        with local_log_spill_lock:
+            if local_log_spill is None:
+                try:
+                    local_log_spill = LocalLogSpill(os.path.join(app_path, "log"))
+                except Exception as e:
+                    print(e)
+    while len(local_log_data) > local_log_limit:
+        try:
+            line = local_log_data.popleft()
+        except IndexError:
+            break
+        if local_log_spill is not None:
+            local_log_spill.put(line)
+
+
+def local_log_clear():
+    global local_log_spill
+    spill = local_log_spill
+    local_log_spill = None
+    local_log_data.clear()
+    if spill is not None:
+        try:
+            os.remove(spill.close())
+        except OSError:
+            pass
+
+
+atexit.register(local_log_clear)
+
+
+def local_log_set_limit(lines):
+    global local_log_limit
+    local_log_limit = max(int(lines), 1)
+
+
 def local_log_enable(en=False):
     global local_log_en
-    global local_log_data
+    session = get_session()
+    if session is not None:
+        session.log_enable(en)
+        return
     if en is True:
         local_log_en = True
     else:
         local_log_en = False
+        local_log_clear()
+
+
+def local_log_write(log_dir, key_word, spill, lines):
+    # spilled lines first, then the ones still in memory
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+    try:
+        rq = time.strftime("%Y%m%d%H%M%S", time.localtime(time.time()))
+        log_name = rq + "_" + key_word + ".log"
+        log_path = os.path.join(log_dir, log_name)
+        mode = "w"
+        if spill is not None:
+            shutil.move(spill.close(), log_path)
+            mode = "a"
+        with codecs.open(log_path, mode, encoding="utf-8") as fp:
+            if lines:
+                fp.write("\n".join(lines) + "\n")
+    except Exception as e:
+        printf(e)
+        traceback.print_exc(limit=5, file=sys.stdout)
 
 
 def local_log_save(local_path="log", key_word=""):
-    global local_log_en
-    global local_log_data
+    global local_log_spill
+    session = get_session()
+    if session is not None:
+        session.log_save(local_path, key_word)
+        return
     log_dir = os.path.join(app_path, local_path)
     if not os.path.exists(log_dir):
         os.makedirs(log_dir)
     if local_log_en is True:
-        try:
-            rq = time.strftime("%Y%m%d%H%M%S", time.localtime(time.time()))
-            log_name = rq + "_" + key_word + ".log"
-            log_path = os.path.join(log_dir, log_name)
-            with codecs.open(log_path, "w", encoding="utf-8") as fp:
-                fp.write(local_log_data)
-        except Exception as e:
-            printf(e)
-            traceback.print_exc(limit=5, file=sys.stdout)
-    local_log_data = ""
+        spill = local_log_spill
+        local_log_spill = None
+        local_log_write(log_dir, key_word, spill, list(local_log_data))
+    local_log_clear()
+
+
+def get_session():
+    return getattr(session_local, "session", None)
+
+
+def set_session(session):
+    # bind session to the calling thread, returns the one bound before
+    prev = get_session()
+    session_local.session = session
+    return prev
 
 
 def set_error_code(num_str, task=None):
     global error_code_num
     global error_code_num_task
+    session = get_session()
+    if session is not None:
+        session.set_error_code(num_str)
+        return
     if task is not None:
         if len(error_code_num_task) == 0:
             for _ in range(66):
@@ -616,6 +745,9 @@ def set_error_code(num_str, task=None):
 def get_error_code(task=None):
     global error_code_num
     global error_code_num_task
+    session = get_session()
+    if session is not None:
+        return session.error_code
     if task is not None:
         return error_code_num_task[task]
     return error_code_num
@@ -637,6 +769,9 @@ def get_error_code_msg(task=None):
     return '{"ErrorCode": "' + error_code_num + \
         '", "ErrorMsg":"' + eflash_loader_error_code[error_code_num] + '"}'
     """
+    session = get_session()
+    if session is not None:
+        return session.get_error_code_msg()
     if task is not None:
         return (
             "ErrorCode: "
@@ -662,6 +797,14 @@ def remove_udp_client(tid):
     del udp_clinet_dict[tid]
 
 
+def add_log_listener(tid, listener):
+    log_listener_dict[tid] = listener
+
+
+def remove_log_listener(tid):
+    log_listener_dict.pop(tid, None)
+
+
 def str_endian_switch(string):
     s = string[6:8] + string[4:6] + string[2:4] + string[0:2]
     return s
@@ -784,6 +927,8 @@ def img_create_sha256_data(data_bytearray):
 
 # encrypt image, mainly segdata
 def img_create_encrypt_data(data_bytearray, key_bytearray, iv_bytearray, flash_img):
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
     if flash_img == 0:
         # 创建 AES-CBC加密器
         cipher = Cipher(algorithms.AES(key_bytearray), modes.CBC(iv_bytearray))
@@ -801,6 +946,8 @@ def img_create_encrypt_data(data_bytearray, key_bytearray, iv_bytearray, flash_i
 
 # decrypt image, mainly segdata
 def img_create_decrypt_data(data_bytearray, key_bytearray, iv_bytearray, flash_img):
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
     if flash_img == 0:
         # 创建 AES-CBC解密器
         cipher = Cipher(algorithms.AES(key_bytearray), modes.CBC(iv_bytearray))
@@ -816,38 +963,17 @@ def img_create_decrypt_data(data_bytearray, key_bytearray, iv_bytearray, flash_i
     return plaintext
 
 
+# encrypt a file chunk by chunk, returns sha256 of the encrypted file
+def img_create_encrypt_file(src_file, dst_file, key_bytearray, iv_bytearray, flash_img, jobs=1):
+    from libs import bflb_aes_stream
+
+    return bflb_aes_stream.img_stream_encrypt_file(src_file, dst_file, key_bytearray, iv_bytearray, flash_img, jobs)
+
+
 def img_create_encrypt_data_xts(data_bytearray, key_bytearray, iv_bytearray, encrypt):
-    counter = binascii.hexlify(iv_bytearray[4:16]).decode()
-    # data unit number default value is 0
-    data_unit_number = 0
-
-    key = (key_bytearray[0:16], key_bytearray[16:32])
-    if encrypt == 2 or encrypt == 3:
-        key = (key_bytearray, key_bytearray)
-    total_len = len(data_bytearray)
-    ciphertext = bytearray(0)
-    deal_len = 0
-
-    while deal_len < total_len:
-        data_unit_number = str(hex(data_unit_number)).replace("0x", "")
-        data_unit_number_to_str = str(data_unit_number)
-        right_justify_str = data_unit_number_to_str.rjust(8, "0")
-        reverse_data_unit_number_str = string_number_reverse(right_justify_str)
-        tweak = reverse_data_unit_number_str + counter
-        tweak = hexstr_to_bytearray("0" * (32 - len(tweak)) + tweak)
-        cipher = Cipher(algorithms.AES(key), modes.XTS(tweak))
-        encryptor = cipher.encryptor()
-        if 32 + deal_len <= total_len:
-            cur_block = data_bytearray[0 + deal_len : 32 + deal_len]
-            ciphertext += encryptor.update(cur_block) + encryptor.finalize()
-        else:
-            cur_block = data_bytearray[0 + deal_len : 16 + deal_len] + bytearray(16)
-            ciphertext += (encryptor.update(cur_block) + encryptor.finalize())[0:16]
-        deal_len += 32
-        data_unit_number = int(data_unit_number, 16)
-        data_unit_number += 1
+    from libs import bflb_aes_xts
 
-    return ciphertext
+    return bflb_aes_xts.img_create_encrypt_data_xts(data_bytearray, key_bytearray, iv_bytearray, encrypt)
 
 
 def get_security_key():
@@ -859,6 +985,8 @@ def get_security_key():
 
 
 def get_aes_encrypted_security_key(cfg):
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
     # b"BOUFFALOLABKEY\x00\x00"
     key_hex = "424f554646414c4f4c41424b45590000"
     # b"BOUFFALOLABIV\x00\x00\x00"
@@ -944,6 +1072,8 @@ def get_serial_ports():
 
 
 def serial_enumerate():
+    from serial.tools.list_ports import comports
+
     prog_ports = []
     sdio_ports = []
     sdio_file_ser_dict = {}
@@ -1006,6 +1136,8 @@ def serial_enumerate():
 
 def pylink_enumerate():
     try:
+        import pylink
+
         if sys.platform == "win32":
             obj_dll = pylink.Library(dllpath=path_dll)
             obj = pylink.JLink(lib=obj_dll)
@@ -1021,6 +1153,8 @@ def pylink_enumerate():
 
 
 def cklink_openocd_enumerate():
+    from serial.tools.list_ports import comports
+
     ports_cklink = []
     ports_openocd = []
     if sys.platform.startswith("win"):
@@ -1067,6 +1201,7 @@ def image_create_parser_init():
     parser.add_argument("-c", "--cpu", dest="cpu", help="cpu type: cpu0 cpu1 or all")
     parser.add_argument("-g", "--group", dest="group", help="group type")
     parser.add_argument("-s", "--signer", dest="signer", help="signer")
+    parser.add_argument("--nocache", dest="nocache", action="store_true", help="always rebuild, skip image cache")
     return parser
 
 
@@ -1094,6 +1229,7 @@ def eflash_loader_parser_init():
     parser.add_argument("--mac", dest="mac", nargs="?", const=True, default=False)
     parser.add_argument("--file", dest="file", help="file to store read data or file to write")
     parser.add_argument("--skip", dest="skip", help="skip write file to flash")
+    parser.add_argument("--delta", dest="delta", action="store_true", help="only write sectors that differ from flash")
     parser.add_argument("--packet", dest="packet", help=" import packet to replace burn file")
     parser.add_argument("--efusefile", dest="efusefile", help="efuse file to write efuse")
     parser.add_argument("--data", dest="data", help="data to write")
@@ -1114,6 +1250,11 @@ def eflash_loader_parser_init():
     parser.add_argument("--privatekey", dest="privatekey", help="signature private key")
     parser.add_argument("--ecdh", dest="ecdh", action="store_true", help="open ecdh function")
     parser.add_argument("--echo", dest="echo", action="store_true", help="open local log echo")
+    parser.add_argument("--workers", dest="workers", help="eflash loader server worker processes")
+    parser.add_argument("--worker_jobs", dest="worker_jobs", help="jobs before a server worker is recycled")
+    parser.add_argument("--queue_size", dest="queue_size", help="eflash loader server job queue size")
+    parser.add_argument("--tcp", dest="tcp", action="store_true", help="eflash loader server also takes tcp jobs")
+    parser.add_argument("--unix", dest="unix", help="eflash loader server unix socket for jobs")
     parser.add_argument("-a", "--auto", dest="auto", action="store_true", help="auto flash")
     parser.add_argument("--dac_value", dest="dac_value", help="dac value")
     parser.add_argument("--dac_addr", dest="dac_addr", help="dac address")
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+#  Copyright (C) 2016- BOUFFALO LAB (NANJING) CO., LTD.
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+import os
+import lzma
+import json
+import hashlib
+import tempfile
+import threading
+
+from libs import bflb_utils
+from libs.bflb_utils import app_path
+
+XZ_CACHE_DIR = os.path.join(app_path, "cache", "xz")
+XZ_CACHE_MAX_SIZE = 256 * 1024 * 1024
+
+
+class BflbXzCache(object):
+    # content addressed cache of xz compressed payloads
+    # entries are <sha256>.xz files, lru order is kept in file mtime so that
+    # several processes can share one directory without a lock
+    def __init__(self, cache_dir=XZ_CACHE_DIR, max_size=XZ_CACHE_MAX_SIZE):
+        self._cache_dir = cache_dir
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(data, filters, check):
+        sh = hashlib.sha256()
+        sh.update(data)
+        sh.update(json.dumps({"filters": filters, "check": check}, sort_keys=True).encode("utf-8"))
+        return sh.hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self._cache_dir, key + ".xz")
+
+    def get(self, key):
+        path = self._entry_path(key)
+        try:
+            with open(path, "rb") as fp:
+                data = fp.read()
+            # touch entry to keep it at the head of the lru
+            os.utime(path, None)
+        except (IOError, OSError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, key, data):
+        try:
+            os.makedirs(self._cache_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self._cache_dir, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as fp:
+                    fp.write(data)
+                os.replace(tmp_path, self._entry_path(key))
+            except Exception:
+                os.remove(tmp_path)
+                raise
+        except (IOError, OSError) as e:
+            bflb_utils.printf("xz cache write failed: ", e)
+            return False
+        self.evict()
+        return True
+
+    def evict(self):
+        entries = []
+        total = 0
+        try:
+            names = os.listdir(self._cache_dir)
+        except OSError:
+            return
+        for name in names:
+            if not name.endswith(".xz"):
+                continue
+            path = os.path.join(self._cache_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self._max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # already evicted by another process
+                pass
+            total -= size
+
+    def compress(self, data, filters, check=lzma.CHECK_CRC32):
+        key = self.make_key(data, filters, check)
+        xz_data = self.get(key)
+        if xz_data is None:
+            xz_data = lzma.compress(data, check=check, filters=filters)
+            self.put(key, xz_data)
+        return xz_data
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+
+_xz_caches = {}
+_xz_caches_lock = threading.Lock()
+
+
+def get_xz_cache(cache_dir=None, max_size=None):
+    # one cache per directory, the size limit of the latest caller wins
+    cache_dir = os.path.abspath(cache_dir or XZ_CACHE_DIR)
+    with _xz_caches_lock:
+        xz_cache = _xz_caches.get(cache_dir)
+        if xz_cache is None:
+            xz_cache = BflbXzCache(cache_dir)
+            _xz_caches[cache_dir] = xz_cache
+        xz_cache._max_size = max_size or XZ_CACHE_MAX_SIZE
+    return xz_cache
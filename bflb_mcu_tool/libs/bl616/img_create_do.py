@@ -8,11 +8,12 @@ import codecs
 
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import padding, hashes, serialization
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.primitives.asymmetric import ec
-from cryptography.hazmat.primitives.asymmetric.utils import decode_dss_signature, encode_dss_signature
+from cryptography.hazmat.primitives.asymmetric.utils import decode_dss_signature, encode_dss_signature, Prehashed
 
 from libs import bflb_utils
+from libs import bflb_aes_xts
+from libs import bflb_aes_stream
 from libs.bflb_utils import img_create_sha256_data, img_create_encrypt_data
 from libs.bflb_configobj import BFConfigParser
 from libs.bl616.flash_select_do import create_flashcfg_table
@@ -328,10 +329,7 @@ def img_create_get_img_start_addr(bootheader_data):
 
 # get whole group img data
 def img_create_flash_default_data(length):
-    datas = bytearray(length)
-    for i in range(length):
-        datas[i] = 0xFF
-    return datas
+    return bytearray(b"\xff") * length
 
 
 def img_get_file_data(files):
@@ -472,41 +470,11 @@ def reverse_iv(need_reverse_iv_bytearray):
 
 
 def img_create_encrypt_data_xts(data_bytearray, key_bytearray, iv_bytearray, encrypt):
-    counter = binascii.hexlify(iv_bytearray[4:16]).decode()
-    # data unit number default value is 0
-    data_unit_number = 0
-
-    key = key_bytearray[0:16] + key_bytearray[16:32]
-    if encrypt == 2 or encrypt == 3:
-        key = key_bytearray + key_bytearray
-    total_len = len(data_bytearray)
-    ciphertext = bytearray(0)
-    deal_len = 0
-
-    while deal_len < total_len:
-        data_unit_number = str(hex(data_unit_number)).replace("0x", "")
-        data_unit_number_to_str = str(data_unit_number)
-        right_justify_str = data_unit_number_to_str.rjust(8, "0")
-        reverse_data_unit_number_str = bflb_utils.string_number_reverse(right_justify_str)
-        tweak = reverse_data_unit_number_str + counter
-        tweak = bflb_utils.hexstr_to_bytearray("0" * (32 - len(tweak)) + tweak)
-        cipher = Cipher(algorithms.AES(key), modes.XTS(tweak))
-        encryptor = cipher.encryptor()
-        if 32 + deal_len <= total_len:
-            cur_block = data_bytearray[0 + deal_len : 32 + deal_len]
-            ciphertext += encryptor.update(cur_block) + encryptor.finalize()
-        else:
-            cur_block = data_bytearray[0 + deal_len : 16 + deal_len] + bytearray(16)
-            ciphertext += (encryptor.update(cur_block) + encryptor.finalize())[0:16]
-        deal_len += 32
-        data_unit_number = int(data_unit_number, 16)
-        data_unit_number += 1
-
-    return ciphertext
+    return bflb_aes_xts.img_create_encrypt_data_xts(data_bytearray, key_bytearray, iv_bytearray, encrypt)
 
 
 # sign image(hash code)
-def img_create_sign_data(data_bytearray, privatekey_file_uecc, publickey_file, flag=0):
+def img_create_sign_data(data_bytearray, privatekey_file_uecc, publickey_file, flag=0, prehashed=False):
     try:
         if flag:
             n = 64
@@ -544,7 +512,11 @@ def img_create_sign_data(data_bytearray, privatekey_file_uecc, publickey_file, f
         bflb_utils.printf("Public key: ", binascii.hexlify(pk_data))
         pk_hash = img_create_sha256_data(pk_data)
         bflb_utils.printf("Public key hash=", binascii.hexlify(pk_hash))
-        signature = sk.sign(data_bytearray, ec.ECDSA(hashes.SHA256()))
+        if prehashed:
+            # data_bytearray is already the sha256 of the data to sign
+            signature = sk.sign(data_bytearray, ec.ECDSA(Prehashed(hashes.SHA256())))
+        else:
+            signature = sk.sign(data_bytearray, ec.ECDSA(hashes.SHA256()))
         r, s = decode_dss_signature(signature)
         signature = r.to_bytes(32, "big") + s.to_bytes(32, "big")
         bflb_utils.printf("Signature=", binascii.hexlify(signature))
@@ -697,6 +669,7 @@ def img_creat_process(group_type, flash_img, cfg, security=False, **kwargs):
         return "FAIL", data_tohash
     data_toencrypt = bytearray(0)
     data_encrypted = 0
+    fw_reader = None
     if flash_img == 0:
         i = 0
         seg_header_list = []
@@ -750,6 +723,13 @@ def img_creat_process(group_type, flash_img, cfg, security=False, **kwargs):
         seg_cnt = cnt
     else:
         if segdata_file:
+            fw_reader = bflb_aes_stream.BflbGroupImgReader(boot_entry, segdata_file)
+            if fw_reader.length == 0 or fw_reader.read(0, 4) == bflb_utils.int_to_4bytearray_l(0x504E4642):
+                # img that already have bootheader is split in memory below
+                fw_reader = None
+            else:
+                seg_cnt = fw_reader.length
+        if segdata_file and fw_reader is None:
             seg_data = img_get_one_group_img(boot_entry, segdata_file)
             if seg_data:
                 padding_size = 0
@@ -781,7 +761,7 @@ def img_creat_process(group_type, flash_img, cfg, security=False, **kwargs):
                 seg_cnt = len(data_toencrypt)
 
     # do encrypt
-    if encrypt:
+    if encrypt and fw_reader is None:
         unencrypt_mfg_data = bytearray(0)
         if seg_cnt >= 0x2000:
             if data_toencrypt[0x1000:0x1004] == bytearray("0mfg".encode("utf-8")):
@@ -796,10 +776,35 @@ def img_creat_process(group_type, flash_img, cfg, security=False, **kwargs):
             data_toencrypt = data_toencrypt[0:0x1000] + unencrypt_mfg_data + data_toencrypt[0x2000:]
     # get fw data
     fw_data = bytearray(0)
-    data_tohash += data_toencrypt
-    fw_data = data_toencrypt
-    # hash fw img
-    hash = img_create_sha256_data(data_tohash)
+    if fw_reader is not None:
+        # encrypt and hash fw chunk by chunk straight into its files
+        fw_file_name = cfg.get(cfg_section, "img_file")
+        encrypt_mode = None
+        stream_key = None
+        stream_iv = None
+        if encrypt:
+            encrypt_mode = bflb_aes_stream.img_stream_mode(flash_img, xts_mode)
+            stream_key = encrypt_key
+            stream_iv = encrypt_iv
+            if xts_mode:
+                stream_key = bflb_aes_xts.img_create_xts_key(encrypt_key, encrypt)
+        jobs, chunk_size = bflb_aes_stream.img_stream_cfg(cfg, cfg_section)
+        seg_cnt, hash, fw_data_hash = bflb_aes_stream.img_stream_encrypt(
+            fw_reader,
+            fw_file_name,
+            encrypt_mode,
+            stream_key,
+            stream_iv,
+            data_tohash,
+            fw_file_name.replace(".bin", "_withhash.bin"),
+            jobs,
+            chunk_size,
+        )
+    else:
+        data_tohash += data_toencrypt
+        fw_data = data_toencrypt
+        # hash fw img
+        hash = img_create_sha256_data(data_tohash)
     bflb_utils.printf("Image hash is ", binascii.hexlify(hash))
     # add signautre
     signature = bytearray(0)
@@ -807,10 +812,12 @@ def img_creat_process(group_type, flash_img, cfg, security=False, **kwargs):
     if sign == 1:
         if "privatekey_str" in kwargs and "publickey_str" in kwargs and kwargs["privatekey_str"]:
             pk_data, pk_hash, signature = img_create_sign_data(
-                data_tohash, kwargs["privatekey_str"], kwargs["publickey_str"], 1
+                hash, kwargs["privatekey_str"], kwargs["publickey_str"], 1, True
             )
         else:
-            pk_data, pk_hash, signature = img_create_sign_data(data_tohash, privatekey_file_uecc, publickey_file)
+            pk_data, pk_hash, signature = img_create_sign_data(
+                hash, privatekey_file_uecc, publickey_file, prehashed=True
+            )
         pk_data = pk_data + bflb_utils.get_crc32_bytearray(pk_data)
 
     flash_cfg_addr = len(bootheader_data + pk_data + signature + aesiv_data)
@@ -833,13 +840,14 @@ def img_creat_process(group_type, flash_img, cfg, security=False, **kwargs):
         with open(bootinfo_file_name, "wb+") as fp:
             bootinfo = bootheader_data + pk_data + signature + aesiv_data + flash_cfg_list + flash_cfg_table
             fp.write(bootinfo)
-        fw_file_name = cfg.get(cfg_section, "img_file")
-        with open(fw_file_name, "wb+") as fp:
-            fp.write(fw_data)
-        # add create fw with hash
-        fw_data_hash = img_create_sha256_data(fw_data)
-        with open(fw_file_name.replace(".bin", "_withhash.bin"), "wb+") as fp:
-            fp.write(fw_data + fw_data_hash)
+        if fw_reader is None:
+            fw_file_name = cfg.get(cfg_section, "img_file")
+            with open(fw_file_name, "wb+") as fp:
+                fp.write(fw_data)
+            # add create fw with hash
+            fw_data_hash = img_create_sha256_data(fw_data)
+            with open(fw_file_name.replace(".bin", "_withhash.bin"), "wb+") as fp:
+                fp.write(fw_data + fw_data_hash)
         # update efuse
         if encrypt:
             flash_encrypt_type = 0
@@ -5,28 +5,15 @@ import csv
 
 import config as gol
 from libs import bflb_utils
+from libs import bflb_flash_index
+from libs import bflb_cfg_codec
 from libs.bflb_utils import app_path, conf_sign
 from libs.bflb_configobj import BFConfigParser
 from libs.bl702l.bootheader_cfg_keys import bootheader_cfg_keys as flash_cfg_keys
 
 
 def get_suitable_file_name(cfg_dir, flash_id):
-    conf_files = []
-    for home, dirs, files in os.walk(cfg_dir):
-        for filename in files:
-            if filename.split("_")[-1] == flash_id + ".conf":
-                conf_files.append(filename)
-
-    if len(conf_files) > 1:
-        bflb_utils.printf("Flash id duplicate and alternative is:")
-        for i in range(len(conf_files)):
-            tmp = conf_files[i].split(".")[0]
-            bflb_utils.printf("%d:%s" % (i + 1, tmp))
-        return conf_files[i]
-    elif len(conf_files) == 1:
-        return conf_files[0]
-    else:
-        return ""
+    return bflb_flash_index.get_flash_index().get_suitable_conf_name(cfg_dir, flash_id)
 
 
 def update_flash_cfg_do(chipname, chiptype, flash_id, file=None, create=False, section=None):
@@ -66,39 +53,13 @@ def get_supported_flash_do():
     return flash_type
 
 
-def get_int_mask(pos, length):
-    ones = "1" * 32
-    zeros = "0" * 32
-    mask = ones[0 : 32 - pos - length] + zeros[0:length] + ones[0:pos]
-    return int(mask, 2)
-
-
 def create_flashcfg_data_from_cfg(cfg_len, cfgfile):
     section = "FLASH_CFG"
     cfg = BFConfigParser()
     cfg.read(cfgfile)
-    data = bytearray(cfg_len)
-    min_offset = int(flash_cfg_keys.get("io_mode")["offset"], 10)
-
-    for key in cfg.options(section):
-        if flash_cfg_keys.get(key) is None:
-            bflb_utils.printf(key + " not exist")
-            continue
-        # bflb_utils.printf(key)
-        val = cfg.get(section, key)
-        if val.startswith("0x"):
-            val = int(val, 16)
-        else:
-            val = int(val, 10)
-        # bflb_utils.printf(val)
-        offset = int(flash_cfg_keys.get(key)["offset"], 10) - min_offset
-        pos = int(flash_cfg_keys.get(key)["pos"], 10)
-        bitlen = int(flash_cfg_keys.get(key)["bitlen"], 10)
-
-        oldval = bflb_utils.bytearray_to_int(bflb_utils.bytearray_reverse(data[offset : offset + 4]))
-        newval = (oldval & get_int_mask(pos, bitlen)) + (val << pos)
-        # bflb_utils.printf(newval,binascii.hexlify(bflb_utils.int_to_4bytearray_l(newval)))
-        data[offset : offset + 4] = bflb_utils.int_to_4bytearray_l(newval)
+    codec = bflb_cfg_codec.compile_cfg_keys(flash_cfg_keys)
+    values = codec.values_from_cfg(cfg, section, warning="%s not exist")
+    data, tmp = codec.pack(values, codec.offset("io_mode"), cfg_len)
     crcarray = bflb_utils.get_crc32_bytearray(data)
     data = bflb_utils.int_to_4bytearray_l(0x47464346) + data + crcarray
     return data
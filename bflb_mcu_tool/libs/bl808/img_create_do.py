@@ -2,17 +2,20 @@
 
 import os
 import sys
+import time
 import hashlib
 import binascii
 import codecs
+import concurrent.futures
 
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import padding, hashes, serialization
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.primitives.asymmetric import ec
-from cryptography.hazmat.primitives.asymmetric.utils import decode_dss_signature, encode_dss_signature
+from cryptography.hazmat.primitives.asymmetric.utils import decode_dss_signature, encode_dss_signature, Prehashed
 
 from libs import bflb_utils
+from libs import bflb_aes_xts
+from libs import bflb_aes_stream
 from libs.bflb_utils import img_create_sha256_data, img_create_encrypt_data
 from libs.bflb_configobj import BFConfigParser
 from libs.bl808.flash_select_do import create_flashcfg_table
@@ -571,10 +574,7 @@ def img_create_get_img_start_addr(bootheader_data):
 
 # get whole group img data
 def img_create_flash_default_data(length):
-    datas = bytearray(length)
-    for i in range(length):
-        datas[i] = 0xFF
-    return datas
+    return bytearray(b"\xff") * length
 
 
 def img_get_file_data(files):
@@ -715,41 +715,11 @@ def reverse_iv(need_reverse_iv_bytearray):
 
 
 def img_create_encrypt_data_xts(data_bytearray, key_bytearray, iv_bytearray, encrypt):
-    counter = binascii.hexlify(iv_bytearray[4:16]).decode()
-    # data unit number default value is 0
-    data_unit_number = 0
-
-    key = key_bytearray[0:16] + key_bytearray[16:32]
-    if encrypt == 2 or encrypt == 3:
-        key = key_bytearray + key_bytearray
-    total_len = len(data_bytearray)
-    ciphertext = bytearray(0)
-    deal_len = 0
-
-    while deal_len < total_len:
-        data_unit_number = str(hex(data_unit_number)).replace("0x", "")
-        data_unit_number_to_str = str(data_unit_number)
-        right_justify_str = data_unit_number_to_str.rjust(8, "0")
-        reverse_data_unit_number_str = bflb_utils.string_number_reverse(right_justify_str)
-        tweak = reverse_data_unit_number_str + counter
-        tweak = bflb_utils.hexstr_to_bytearray("0" * (32 - len(tweak)) + tweak)
-        cipher = Cipher(algorithms.AES(key), modes.XTS(tweak))
-        encryptor = cipher.encryptor()
-        if 32 + deal_len <= total_len:
-            cur_block = data_bytearray[0 + deal_len : 32 + deal_len]
-            ciphertext += encryptor.update(cur_block) + encryptor.finalize()
-        else:
-            cur_block = data_bytearray[0 + deal_len : 16 + deal_len] + bytearray(16)
-            ciphertext += (encryptor.update(cur_block) + encryptor.finalize())[0:16]
-        deal_len += 32
-        data_unit_number = int(data_unit_number, 16)
-        data_unit_number += 1
-
-    return ciphertext
+    return bflb_aes_xts.img_create_encrypt_data_xts(data_bytearray, key_bytearray, iv_bytearray, encrypt)
 
 
 # sign image(hash code)
-def img_create_sign_data(data_bytearray, privatekey_file_uecc, publickey_file, flag=0):
+def img_create_sign_data(data_bytearray, privatekey_file_uecc, publickey_file, flag=0, prehashed=False):
     try:
         if flag:
             n = 64
@@ -787,7 +757,11 @@ def img_create_sign_data(data_bytearray, privatekey_file_uecc, publickey_file, f
         bflb_utils.printf("Public key: ", binascii.hexlify(pk_data))
         pk_hash = img_create_sha256_data(pk_data)
         bflb_utils.printf("Public key hash=", binascii.hexlify(pk_hash))
-        signature = sk.sign(data_bytearray, ec.ECDSA(hashes.SHA256()))
+        if prehashed:
+            # data_bytearray is already the sha256 of the data to sign
+            signature = sk.sign(data_bytearray, ec.ECDSA(Prehashed(hashes.SHA256())))
+        else:
+            signature = sk.sign(data_bytearray, ec.ECDSA(hashes.SHA256()))
         r, s = decode_dss_signature(signature)
         signature = r.to_bytes(32, "big") + s.to_bytes(32, "big")
         bflb_utils.printf("Signature=", binascii.hexlify(signature))
@@ -887,6 +861,10 @@ def img_creat_process(group_type, flash_img, cfg, security=False, **kwargs):
     else:
         bflb_utils.printf("group type wrong")
         return "FAIL", data_tohash
+    efuse_updates = kwargs.pop("efuse_updates", None)
+    if efuse_updates is not None:
+        # efusedata is shared by both groups, the caller applies the updates in group order
+        img_update_efuse_fun = lambda cfg, *args: efuse_updates.append(args)
     # get segdata to deal with
     segheader_file = []
     if flash_img == 0:
@@ -947,6 +925,7 @@ def img_creat_process(group_type, flash_img, cfg, security=False, **kwargs):
         return "FAIL", data_tohash
     data_toencrypt = bytearray(0)
     data_encrypted = 0
+    fw_reader = None
     if flash_img == 0:
         i = 0
         seg_header_list = []
@@ -1001,6 +980,13 @@ def img_creat_process(group_type, flash_img, cfg, security=False, **kwargs):
         seg_cnt = cnt
     else:
         if segdata_file:
+            fw_reader = bflb_aes_stream.BflbGroupImgReader(boot_entry, segdata_file)
+            if fw_reader.length == 0 or fw_reader.read(0, 4) == bflb_utils.int_to_4bytearray_l(0x504E4642):
+                # img that already have bootheader is split in memory below
+                fw_reader = None
+            else:
+                seg_cnt = fw_reader.length
+        if segdata_file and fw_reader is None:
             seg_data = img_get_one_group_img(boot_entry, segdata_file)
             padding_size = 0
             if len(seg_data) % encrypt_blk_size != 0:
@@ -1031,7 +1017,7 @@ def img_creat_process(group_type, flash_img, cfg, security=False, **kwargs):
             seg_cnt = len(data_toencrypt)
 
     # do encrypt
-    if encrypt:
+    if encrypt and fw_reader is None:
         unencrypt_mfg_data = bytearray(0)
         if seg_cnt >= 0x2000:
             if data_toencrypt[0x1000:0x1004] == bytearray("0mfg".encode("utf-8")):
@@ -1046,10 +1032,35 @@ def img_creat_process(group_type, flash_img, cfg, security=False, **kwargs):
             data_toencrypt = data_toencrypt[0:0x1000] + unencrypt_mfg_data + data_toencrypt[0x2000:]
     # get fw data
     fw_data = bytearray(0)
-    data_tohash += data_toencrypt
-    fw_data = data_toencrypt
-    # hash fw img
-    hash = img_create_sha256_data(data_tohash)
+    if fw_reader is not None:
+        # encrypt and hash fw chunk by chunk straight into its files
+        fw_file_name = cfg.get(cfg_section, "img_file")
+        encrypt_mode = None
+        stream_key = None
+        stream_iv = None
+        if encrypt:
+            encrypt_mode = bflb_aes_stream.img_stream_mode(flash_img, xts_mode)
+            stream_key = encrypt_key
+            stream_iv = encrypt_iv
+            if xts_mode:
+                stream_key = bflb_aes_xts.img_create_xts_key(encrypt_key, encrypt)
+        jobs, chunk_size = bflb_aes_stream.img_stream_cfg(cfg, cfg_section)
+        seg_cnt, hash, fw_data_hash = bflb_aes_stream.img_stream_encrypt(
+            fw_reader,
+            fw_file_name,
+            encrypt_mode,
+            stream_key,
+            stream_iv,
+            data_tohash,
+            fw_file_name.replace(".bin", "_withhash.bin"),
+            jobs,
+            chunk_size,
+        )
+    else:
+        data_tohash += data_toencrypt
+        fw_data = data_toencrypt
+        # hash fw img
+        hash = img_create_sha256_data(data_tohash)
     bflb_utils.printf("Image hash is ", binascii.hexlify(hash))
     # add signautre
     signature = bytearray(0)
@@ -1057,10 +1068,12 @@ def img_creat_process(group_type, flash_img, cfg, security=False, **kwargs):
     if sign == 1:
         if "privatekey_str" in kwargs and "publickey_str" in kwargs and kwargs["privatekey_str"]:
             pk_data, pk_hash, signature = img_create_sign_data(
-                data_tohash, kwargs["privatekey_str"], kwargs["publickey_str"], 1
+                hash, kwargs["privatekey_str"], kwargs["publickey_str"], 1, True
             )
         else:
-            pk_data, pk_hash, signature = img_create_sign_data(data_tohash, privatekey_file_uecc, publickey_file)
+            pk_data, pk_hash, signature = img_create_sign_data(
+                hash, privatekey_file_uecc, publickey_file, prehashed=True
+            )
         pk_data = pk_data + bflb_utils.get_crc32_bytearray(pk_data)
 
     flash_cfg_addr = len(bootheader_data + pk_data + pk_data + signature + signature + aesiv_data)
@@ -1092,13 +1105,14 @@ def img_creat_process(group_type, flash_img, cfg, security=False, **kwargs):
                 + flash_cfg_table
             )
             fp.write(bootinfo)
-        fw_file_name = cfg.get(cfg_section, "img_file")
-        with open(fw_file_name, "wb+") as fp:
-            fp.write(fw_data)
-        # add create fw with hash
-        fw_data_hash = img_create_sha256_data(fw_data)
-        with open(fw_file_name.replace(".bin", "_withhash.bin"), "wb+") as fp:
-            fp.write(fw_data + fw_data_hash)
+        if fw_reader is None:
+            fw_file_name = cfg.get(cfg_section, "img_file")
+            with open(fw_file_name, "wb+") as fp:
+                fp.write(fw_data)
+            # add create fw with hash
+            fw_data_hash = img_create_sha256_data(fw_data)
+            with open(fw_file_name.replace(".bin", "_withhash.bin"), "wb+") as fp:
+                fp.write(fw_data + fw_data_hash)
         # update efuse
         if encrypt:
             flash_encrypt_type = 0
@@ -1162,6 +1176,54 @@ def img_creat_process(group_type, flash_img, cfg, security=False, **kwargs):
     return "OK", data_tohash
 
 
+def img_creat_process_worker(group_type, flash_img, config_file, security, kwargs):
+    start_time = time.time()
+    cfg = BFConfigParser()
+    cfg.read(config_file)
+    efuse_updates = []
+    ret, data_tohash = img_creat_process(group_type, flash_img, cfg, security, efuse_updates=efuse_updates, **kwargs)
+    return group_type, ret, efuse_updates, time.time() - start_time
+
+
+def img_create_group_used(cfg, cfg_section):
+    for files in cfg.get(cfg_section, "segdata_file").split("|"):
+        if files.strip() and files.strip() != "UNUSED":
+            return True
+    return False
+
+
+def img_create_groups_parallel(flash_img, config_file, cfg, security, **kwargs):
+    # group0 and group1 only share efusedata, build both at once and apply the
+    # efuse updates in group order afterwards so the files equal a serial build
+    start_time = time.time()
+    results = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=2) as executor:
+        tasks = [
+            executor.submit(img_creat_process_worker, "group0", flash_img, config_file, False, kwargs),
+            executor.submit(img_creat_process_worker, "group1", flash_img, config_file, security, {}),
+        ]
+        for task in tasks:
+            group_type, ret, efuse_updates, cost = task.result()
+            results[group_type] = (ret, efuse_updates, cost)
+    for group_type, img_update_efuse_fun in (
+        ("group0", img_update_efuse_group0),
+        ("group1", img_update_efuse_group1),
+    ):
+        ret, efuse_updates, cost = results[group_type]
+        if ret == "OK":
+            for args in efuse_updates:
+                img_update_efuse_fun(cfg, *args)
+    img_create_time_report(results, time.time() - start_time)
+    return results["group0"][0], results["group1"][0]
+
+
+def img_create_time_report(results, total):
+    bflb_utils.printf("%-10s%-8s%12s" % ("group", "result", "time(ms)"))
+    for group_type in sorted(results.keys()):
+        bflb_utils.printf("%-10s%-8s%12.1f" % (group_type, results[group_type][0], results[group_type][-1] * 1000))
+    bflb_utils.printf("%-10s%-8s%12.1f" % ("total", "", total * 1000))
+
+
 def img_create_do(args, img_dir_path=None, config_file=None, **kwargs):
     bflb_utils.printf("Image create path: ", img_dir_path)
     if config_file is None:
@@ -1194,13 +1256,29 @@ def img_create_do(args, img_dir_path=None, config_file=None, **kwargs):
 
     # deal image creation
     ret0 = ret1 = "OK"
-    if group_type == "group0":
+    parallel = True
+    if cfg.has_option("Img_Group0_Cfg", "parallel_groups"):
+        parallel = cfg.get("Img_Group0_Cfg", "parallel_groups") != "false"
+    if (
+        group_type == "all"
+        and parallel
+        and img_create_group_used(cfg, "Img_Group0_Cfg")
+        and img_create_group_used(cfg, "Img_Group1_Cfg")
+    ):
+        ret0, ret1 = img_create_groups_parallel(flash_img, config_file, cfg, security, **kwargs)
+    elif group_type == "group0":
         ret0, data_tohash0 = img_creat_process("group0", flash_img, cfg, security, **kwargs)
     elif group_type == "group1":
         ret1, data_tohash1 = img_creat_process("group1", flash_img, cfg, security)
     elif group_type == "all":
+        start_time = time.time()
         ret0, data_tohash0 = img_creat_process("group0", flash_img, cfg, False, **kwargs)
+        group0_time = time.time() - start_time
         ret1, data_tohash1 = img_creat_process("group1", flash_img, cfg, security)
+        img_create_time_report(
+            {"group0": (ret0, group0_time), "group1": (ret1, time.time() - start_time - group0_time)},
+            time.time() - start_time,
+        )
     else:
         img_creat_process("", flash_img, cfg, security)
 
@@ -86,6 +86,9 @@ setup(
         "pylink-square==0.5.0",
         "portalocker==2.0.0",
     ],
+    extras_require={
+        "numpy": ["numpy"],
+    },
     python_requires=">=3.6",
     zip_safe=False,
 )